@@ -1,27 +1,18 @@
-import boto.sqs.connection
+from functools import partial
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
+from app_settings import QUEUE_PREFIX
+from connection import resolve_in_parallel
 from registered_queue import RegisteredQueue, TimedOut, RestartLater
 
 
-# ensure settings are there
-if not getattr(settings, 'AWS_ACCESS_KEY_ID'):
-    raise ImproperlyConfigured('Missing setting "AWS_ACCESS_KEY_ID"')
-
-if not getattr(settings, 'AWS_SECRET_ACCESS_KEY'):
-    raise ImproperlyConfigured('Missing setting "AWS_SECRET_ACCESS_KEY"')
-
-if settings.DEBUG and not getattr(settings, 'SQS_QUEUE_PREFIX'):
+# ensure settings are there; transport (and boto) is loaded, and its
+# settings checked, when a queue is used for the first time
+if settings.DEBUG and not QUEUE_PREFIX:
     raise ImproperlyConfigured('Missing setting "SQS_QUEUE_PREFIX"')
 
-# Try to get regions, otherwise let to DefaultRegionName
-# TODO this is bad! never set settings on the fly, better provide an
-# app_settings.py with default values
-if not getattr(settings, 'AWS_REGION'):
-    settings.AWS_REGION = "us-east-1"
-
 
 # ============
 # registry
@@ -49,3 +40,23 @@ def receiver(queue_name=None, **kwargs):
 
 def send(queue_name, message=None, suffix=None, **kwargs):
     queues[queue_name].send(message, suffix, **kwargs)
+
+
+def send_many(queue_name, messages, suffix=None):
+    """Sends many messages at once, see RegisteredQueue.send_batch."""
+    return queues[queue_name].send_batch(messages, suffix)
+
+
+def resolve_queues(queue_names=None):
+    """Resolves URLs of registered queues and their suffixes in parallel.
+
+    Normally a queue is resolved the first time it is used.  Resolving
+    all of them up front saves the round trips later, e.g. in every
+    worker forked by runreceiver, which inherits the resolved URLs.
+    """
+    if queue_names is None:
+        queue_names = queues.keys()
+    resolve_in_parallel(
+        partial(queues[name].get_queue, suffix)
+        for name in queue_names
+        for suffix in (None, ) + tuple(queues[name].suffixes))
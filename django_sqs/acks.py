@@ -0,0 +1,166 @@
+import logging
+import threading
+import time
+
+from blobs import discard_blobs
+import metrics
+
+# SQS won't accept more than ten entries in a single batch request,
+# nor return more than ten messages from a single ReceiveMessage call
+MAX_BATCH_SIZE = 10
+
+# Fraction of the visibility timeout after which a waiting message is
+# deleted no matter how young the buffer is.
+VISIBILITY_SAFETY_FACTOR = 0.5
+
+
+class _NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+
+class AckBuffer(object):
+    """Collects processed messages and deletes them in batches.
+
+    Messages added with `add()' are deleted with DeleteMessageBatch
+    requests when `size' of them are waiting, or when the oldest one
+    has been waiting for `max_age' seconds.  A message is also deleted
+    as soon as half of its visibility timeout has passed since it was
+    received, so that it doesn't reappear in the queue while waiting.
+    Age-based flushes are done by a background thread.
+
+    `close()' flushes all waiting messages and stops the thread; it
+    must be called when the receive loop exits.
+    """
+
+    def __init__(self, queue, size=MAX_BATCH_SIZE, max_age=1,
+                 visibility_timeout=None, log=None):
+        if not 1 <= size <= MAX_BATCH_SIZE:
+            raise ValueError("delete batch size must be between 1 and %d,"
+                             " not %r" % (MAX_BATCH_SIZE, size))
+        self.queue = queue
+        self.size = size
+        self.max_age = max_age
+        self.visibility_timeout = visibility_timeout
+        if log is None:
+            log = logging.getLogger('django_sqs.acks')
+            log.addHandler(_NullHandler())
+        self._log = log
+        self._pending = []
+        self._deadline = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._flusher = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, message, received=None):
+        """Schedule `message' for deletion.
+
+        `received' is the time the message was received at; it
+        defaults to now.
+        """
+        now = time.time()
+        deadline = now + self.max_age
+        if self.visibility_timeout:
+            deadline = min(
+                deadline,
+                (received or now)
+                + self.visibility_timeout * VISIBILITY_SAFETY_FACTOR)
+        with self._cond:
+            if self._closed:
+                raise ValueError("%r is closed" % self)
+            self._pending.append(message)
+            if self._deadline is None or deadline < self._deadline:
+                self._deadline = deadline
+            flush_now = (len(self._pending) >= self.size
+                         or self._deadline <= now)
+            if not flush_now:
+                self._start_flusher()
+                self._cond.notify()
+        if flush_now:
+            self.flush()
+
+    def flush(self):
+        """Delete all waiting messages.
+
+        Returns a list of (message, error) pairs for messages that
+        could not be deleted.
+        """
+        with self._cond:
+            pending, self._pending, self._deadline = \
+                self._pending, [], None
+        return self._delete(pending)
+
+    def close(self):
+        """Flush waiting messages and stop the background thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        return self.flush()
+
+    def _start_flusher(self):
+        # called with self._cond held
+        if self._flusher is None:
+            self._flusher = threading.Thread(
+                target=self._run, name='django_sqs-ack-flusher')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._deadline is None:
+                        self._cond.wait()
+                        continue
+                    delay = self._deadline - time.time()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                if self._closed:
+                    return
+                pending, self._pending, self._deadline = \
+                    self._pending, [], None
+            self._delete(pending)
+
+    def _delete(self, messages):
+        return delete_messages(self.queue, messages, self._log)
+
+
+def delete_messages(queue, messages, log, discard=True):
+    """Delete `messages' from `queue' with DeleteMessageBatch requests.
+
+    Offloaded bodies of deleted messages are discarded, unless
+    `discard' is false.
+
+    Returns a list of (message, error) pairs for messages that could
+    not be deleted; errors are logged to `log'.
+    """
+    failures = []
+    name = metrics.queue_name(queue)
+    for i in range(0, len(messages), MAX_BATCH_SIZE):
+        batch = messages[i:i+MAX_BATCH_SIZE]
+        metrics.incr(name + '.api.DeleteMessageBatch')
+        try:
+            rv = queue.delete_message_batch(batch)
+        except Exception, e:
+            metrics.incr(name + '.api_errors.DeleteMessageBatch')
+            log.exception("Cannot delete %d messages" % len(batch))
+            failures.extend((m, str(e)) for m in batch)
+            continue
+        by_id = dict((m.id, m) for m in batch)
+        for error in rv.errors:
+            reason = "%s: %s" % (error.get('error_code'),
+                                 error.get('error_message'))
+            log.error("Cannot delete message %s: %s" % (
+                error.get('id'), reason))
+            failures.append((by_id.pop(error.get('id'), None), reason))
+        metrics.incr(name + '.deleted', len(by_id))
+        if discard:
+            discard_blobs(by_id.values())
+    return failures
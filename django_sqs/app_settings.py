@@ -0,0 +1,9 @@
+"""Settings used by several django_sqs modules, with their defaults.
+
+Defaults are provided here rather than by modifying Django settings.
+"""
+from django.conf import settings
+
+AWS_REGION = getattr(settings, 'AWS_REGION', None) or 'us-east-1'
+
+QUEUE_PREFIX = getattr(settings, 'SQS_QUEUE_PREFIX', None)
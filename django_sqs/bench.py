@@ -0,0 +1,385 @@
+"""Benchmark of sending and receiving messages.
+
+`Benchmark.run()' sends messages to a throwaway queue from a
+background thread, while receiving them with
+`RegisteredQueue.receive_loop()' like a receiver process does.  It
+reports throughput, end-to-end latency (from message's SentTimestamp
+to the receiver call), SQS requests per message, time to encode and
+decode a message, and peak memory use of the process.
+
+By default queues are kept in memory (see `transports.local'), so the
+results measure django_sqs itself and are reproducible; the
+configured transport can be benchmarked, too.  Results are plain
+dicts that can be saved as JSON and compared with `compare()'.
+"""
+import os
+import resource
+import tempfile
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import django.utils.simplejson as json
+
+import boto.sqs.message
+
+import metrics
+from message import JSONMessage, ModelInstanceMessage
+from registered_queue import RegisteredQueue
+import transports
+from transports.local import MemoryTransport, SQLiteTransport
+
+MESSAGE_CLASSES = {
+    'raw': boto.sqs.message.RawMessage,
+    'json': JSONMessage,
+    'model': ModelInstanceMessage,
+    }
+
+TRANSPORTS = ('memory', 'sqlite', 'configured')
+
+COST_TYPES = ('sleep', 'cpu')
+
+# Results compared by `compare()': key -> True if higher is better
+COMPARED = (
+    ('throughput', True),
+    ('send_rate', True),
+    ('latency_p50', False),
+    ('latency_p99', False),
+    ('api_calls_per_message', False),
+    ('encode_us', False),
+    ('decode_us', False),
+    ('peak_rss_kb', False),
+    )
+
+
+def percentile(values, p):
+    """Return `p'th percentile of `values' (nearest rank)."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(round(p / 100.0 * (len(values) - 1))),
+                      len(values) - 1)]
+
+
+def peak_rss():
+    """Peak resident set size of the process, in kilobytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if os.uname()[0] == 'Darwin':
+        rss /= 1024                     # bytes on Mac OS X
+    return rss
+
+
+class Benchmark(object):
+    """Sends `messages' messages to a new queue and receives them.
+
+    - `size': length of message body (of JSON payload for 'json'
+      message class); ignored for 'model', whose messages refer to
+      ContentType instances
+    - `message_class': 'raw', 'json' or 'model'
+    - `receiver_cost': seconds spent in receiver for each message,
+      sleeping or (with `cost_type' 'cpu') busy looping
+    - `batch_size', `wait_time_seconds', `concurrency',
+      `delete_batch_size': passed to RegisteredQueue and its
+      `receive_loop()'
+    - `batch_receiver': use a batch receiver, getting up to
+      `batch_size' messages per call
+    - `send_batch': send messages with SendMessageBatch requests
+    - `transport': 'memory', 'sqlite' (in a temporary database) or
+      'configured' (SQS_TRANSPORT, e.g. Amazon SQS)
+    """
+
+    def __init__(self, messages=1000, size=100, message_class='raw',
+                 receiver_cost=0, cost_type='sleep', batch_size=10,
+                 wait_time_seconds=1, concurrency=1, delete_batch_size=None,
+                 batch_receiver=False, send_batch=False,
+                 transport='memory', label=None):
+        if message_class not in MESSAGE_CLASSES:
+            raise ValueError("Unknown message class %r" % message_class)
+        if cost_type not in COST_TYPES:
+            raise ValueError("Unknown receiver cost type %r" % cost_type)
+        if transport not in TRANSPORTS:
+            raise ValueError("Unknown transport %r" % transport)
+        self.options = dict(
+            messages=messages, size=size, message_class=message_class,
+            receiver_cost=receiver_cost, cost_type=cost_type,
+            batch_size=batch_size, wait_time_seconds=wait_time_seconds,
+            concurrency=concurrency, delete_batch_size=delete_batch_size,
+            batch_receiver=batch_receiver, send_batch=send_batch,
+            transport=transport)
+        self.label = label
+        self._latencies = []
+        self._received = 0
+        self._lock = threading.Lock()
+
+    def make_bodies(self):
+        """Return list of bodies of messages to send."""
+        n = self.options['messages']
+        size = self.options['size']
+        message_class = self.options['message_class']
+        if message_class == 'model':
+            from django.contrib.contenttypes.models import ContentType
+            instances = list(ContentType.objects.all())
+            if not instances:
+                raise ValueError("No ContentType instances to send")
+            return [instances[i % len(instances)] for i in range(n)]
+        if message_class == 'json':
+            return [{'data': 'x' * size} for i in range(n)]
+        return ['x' * size] * n
+
+    def _cost(self, count=1):
+        cost = self.options['receiver_cost'] * count
+        if not cost:
+            return
+        if self.options['cost_type'] == 'sleep':
+            time.sleep(cost)
+        else:
+            deadline = time.time() + cost
+            while time.time() < deadline:
+                pass
+
+    def _record(self, messages):
+        now = time.time()
+        latencies = []
+        for m in messages:
+            try:
+                latencies.append(
+                    now - int(m.attributes['SentTimestamp']) / 1000.0)
+            except (KeyError, ValueError):
+                pass
+            m.get_body()
+        with self._lock:
+            self._latencies.extend(latencies)
+            self._received += len(messages)
+
+    def receiver(self, message):
+        if self.options['batch_receiver']:
+            self._record(message)
+            self._cost(len(message))
+        else:
+            self._record([message])
+            self._cost()
+
+    def _send(self, rq, bodies, errors):
+        if self.options['message_class'] == 'model':
+            key = 'instance'
+        else:
+            key = 'body'
+        sent = 0
+        try:
+            if self.options['send_batch']:
+                for i in range(0, len(bodies), 10):
+                    for m, error in rq.send_batch(
+                            [{key: body} for body in bodies[i:i+10]]):
+                        if error is None:
+                            sent += 1
+                        else:
+                            errors.append(error)
+                    self._started.set()
+            else:
+                for body in bodies:
+                    rq.send(**{key: body})
+                    sent += 1
+                    self._started.set()
+        except Exception, e:
+            errors.append(str(e))
+        self._sent = time.time()
+        self._started.set()
+        if errors:
+            # not all the messages will arrive: stop receiving once the
+            # sent ones have.  Receive loop forgets stop requests made
+            # before it started, so keep asking until it returns.
+            while not self._finished.isSet():
+                if self._received >= sent:
+                    rq.stop()
+                self._finished.wait(0.1)
+
+    def measure_codec(self, bodies, message_class):
+        """Return microseconds to encode and to decode a message."""
+        bodies = bodies[:1000]
+        start = time.time()
+        encoded = []
+        for body in bodies:
+            m = message_class()
+            m.set_body(body)
+            encoded.append(m.get_body_encoded())
+        encode_time = time.time() - start
+        start = time.time()
+        mm = []
+        for data in encoded:
+            m = message_class()
+            m.set_body(data)
+            m.endNode(None)
+            mm.append(m)
+        if hasattr(message_class, 'load_batch'):
+            message_class.load_batch(mm)
+        for m in mm:
+            m.get_body()
+        decode_time = time.time() - start
+        return (encode_time * 1e6 / len(bodies),
+                decode_time * 1e6 / len(bodies))
+
+    def _set_up_transport(self):
+        transport = self.options['transport']
+        self._sqlite_path = None
+        if transport == 'configured':
+            return
+        if transport == 'memory':
+            instance = MemoryTransport()
+        else:
+            fd, self._sqlite_path = tempfile.mkstemp(suffix='.sqlite3',
+                                                     prefix='sqs_bench')
+            os.close(fd)
+            instance = SQLiteTransport(self._sqlite_path)
+        self._saved_transport = transports.set_transport(instance)
+
+    def _tear_down_transport(self):
+        if self.options['transport'] != 'configured':
+            transports.set_transport(self._saved_transport)
+        if self._sqlite_path:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self._sqlite_path + suffix):
+                    os.unlink(self._sqlite_path + suffix)
+
+    def run(self):
+        """Run the benchmark and return dict of results."""
+        options = self.options
+        message_class = MESSAGE_CLASSES[options['message_class']]
+        bodies = self.make_bodies()
+        n = len(bodies)
+        encode_us, decode_us = self.measure_codec(bodies, message_class)
+
+        collector = metrics.InProcessCollector()
+        saved_collector = metrics.get_collector()
+        metrics.set_collector(collector)
+        self._set_up_transport()
+        try:
+            rq = RegisteredQueue(
+                'sqs_bench_%d' % os.getpid(), self.receiver,
+                message_class=message_class,
+                batch=options['batch_receiver'],
+                max_batch=options['batch_receiver'] and options['batch_size']
+                or None,
+                batch_size=options['batch_size'],
+                wait_time_seconds=options['wait_time_seconds'],
+                concurrency=options['concurrency'],
+                delete_batch_size=options['delete_batch_size'],
+                # sent messages have to reach the queue right away
+                outbox=False)
+            q = rq.get_queue()
+            self._latencies = []
+            self._received = 0
+            errors = []
+            sender = threading.Thread(target=self._send,
+                                      args=(rq, bodies, errors),
+                                      name='django_sqs-bench-sender')
+            self._started = threading.Event()
+            self._finished = threading.Event()
+            start = time.time()
+            sender.start()
+            # an empty queue would make receive loop sleep before
+            # polling again, which would skew the latency
+            self._started.wait()
+            try:
+                rq.receive_loop(message_limit=n)
+            finally:
+                self._finished.set()
+            elapsed = time.time() - start
+            sender.join()
+            send_time = self._sent - start
+            if options['transport'] == 'configured':
+                q.delete()
+        finally:
+            self._tear_down_transport()
+            metrics.set_collector(saved_collector)
+
+        counters = collector.summary()['counters']
+        api_calls = {}
+        for name, count in counters.items():
+            queue_name, _, action = name.partition('.api.')
+            if action:
+                api_calls[action] = float(count) / n
+        return {
+            'label': self.label,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'options': options,
+            'errors': errors,
+            'elapsed': elapsed,
+            'throughput': n / elapsed,
+            'send_rate': n / send_time,
+            'latency_p50': percentile(self._latencies, 50),
+            'latency_p99': percentile(self._latencies, 99),
+            'latency_max': max(self._latencies or [None]),
+            'api_calls': api_calls,
+            'api_calls_per_message': sum(api_calls.values()),
+            'encode_us': encode_us,
+            'decode_us': decode_us,
+            'peak_rss_kb': peak_rss(),
+            }
+
+
+def format_results(results):
+    """Return lines of text describing `results' of `Benchmark.run()'."""
+    def _ms(value):
+        if value is None:
+            return '-'
+        return '%.1f ms' % (value * 1000)
+    lines = [
+        "Messages:         %d (%s)" % (
+            results['options']['messages'],
+            ', '.join('%s=%s' % item
+                      for item in sorted(results['options'].items())
+                      if item[0] != 'messages')),
+        "Throughput:       %.1f messages/s" % results['throughput'],
+        "Send rate:        %.1f messages/s" % results['send_rate'],
+        "Latency:          p50 %s, p99 %s, max %s" % (
+            _ms(results['latency_p50']), _ms(results['latency_p99']),
+            _ms(results['latency_max'])),
+        "API calls:        %.3f per message (%s)" % (
+            results['api_calls_per_message'],
+            ', '.join('%s %.3f' % item
+                      for item in sorted(results['api_calls'].items()))),
+        "Encode/decode:    %.1f / %.1f us per message" % (
+            results['encode_us'], results['decode_us']),
+        "Peak RSS:         %d KB" % results['peak_rss_kb'],
+        ]
+    if results['errors']:
+        lines.append("Send errors:      %d (first: %s)" % (
+            len(results['errors']), results['errors'][0]))
+    return lines
+
+
+def compare(results, baseline):
+    """Return lines comparing `results' with `baseline' results.
+
+    Each compared value is shown with its relative change; changes
+    for the worse are marked with `!'.
+    """
+    lines = ["Compared with %s (%s):" % (baseline.get('label') or 'baseline',
+                                         baseline.get('time'))]
+    for key, higher_is_better in COMPARED:
+        old, new = baseline.get(key), results.get(key)
+        if old is None or new is None:
+            continue
+        if old:
+            change = (new - old) * 100.0 / old
+        else:
+            change = 0.0
+        worse = change < 0 if higher_is_better else change > 0
+        lines.append("%s %-22s %12.4g -> %12.4g (%+.1f%%)" % (
+            worse and abs(change) >= 5 and '!' or ' ', key, old, new, change))
+    return lines
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
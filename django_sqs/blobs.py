@@ -0,0 +1,289 @@
+"""Claim-check offloading of large message bodies to a blob store.
+
+A body longer than SQS_BLOB_THRESHOLD bytes is written to the blob
+store configured with SQS_BLOB_STORE, and only a short reference (the
+claim check) is sent to the queue.  Received claim checks are
+resolved lazily: the body is fetched when it is first needed, and can
+be read as a stream with `open_body()'.  The blob is deleted after the
+message has been deleted from the queue.
+"""
+import errno
+from importlib import import_module
+import logging
+import os
+from StringIO import StringIO
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from codec import decode, encode, is_encoded, register_codec, JSONCodec
+
+# Blob store: 'filesystem', 's3', dotted path of a BlobStore
+# subclass, or None to disable offloading
+BLOB_STORE = getattr(settings, 'SQS_BLOB_STORE', None)
+
+# Bodies longer than this many bytes are offloaded; SQS won't accept
+# more than 256KB
+BLOB_THRESHOLD = getattr(settings, 'SQS_BLOB_THRESHOLD', 256 * 1024)
+
+# Settings of built-in stores
+BLOB_DIRECTORY = getattr(settings, 'SQS_BLOB_DIRECTORY', None)
+BLOB_BUCKET = getattr(settings, 'SQS_BLOB_BUCKET', None)
+BLOB_PREFIX = getattr(settings, 'SQS_BLOB_PREFIX', 'django_sqs/')
+
+# Size of chunks read from a blob at once
+CHUNK_SIZE = 64 * 1024
+
+
+class _NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+_log = logging.getLogger('django_sqs.blobs')
+_log.addHandler(_NullHandler())
+
+
+class ClaimCheckCodec(JSONCodec):
+    name = 'claim'
+    tag = 'c'
+
+register_codec(ClaimCheckCodec())
+
+
+class BlobStore(object):
+    """Stores message bodies under unique keys."""
+
+    def put(self, data):
+        """Store `data' string, return its key."""
+        raise NotImplementedError
+
+    def open(self, key):
+        """Return a file-like object reading blob `key'."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Delete blob `key'; deleting a missing blob is not an error."""
+        raise NotImplementedError
+
+    def new_key(self):
+        return uuid.uuid4().hex
+
+
+class FileSystemBlobStore(BlobStore):
+    """Keeps blobs as files in `directory' (SQS_BLOB_DIRECTORY).
+
+    Useful for tests and development, or for a directory shared by
+    producers and consumers.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or BLOB_DIRECTORY
+        if not self.directory:
+            raise ImproperlyConfigured(
+                'Missing setting "SQS_BLOB_DIRECTORY"')
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def put(self, data):
+        key = self.new_key()
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        # write to a temporary file first, so that nobody reads a
+        # partially written blob
+        tmp = self.path('.%s.tmp' % key)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, self.path(key))
+        return key
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class S3BlobStore(BlobStore):
+    """Keeps blobs in S3 bucket `bucket' (SQS_BLOB_BUCKET), under
+    `prefix' (SQS_BLOB_PREFIX).
+
+    Blobs of messages that are never deleted (e.g. ones dropped by a
+    redrive policy) are left behind; an expiration rule for the
+    prefix takes care of them.
+    """
+
+    def __init__(self, bucket=None, prefix=None):
+        self.bucket_name = bucket or BLOB_BUCKET
+        if not self.bucket_name:
+            raise ImproperlyConfigured('Missing setting "SQS_BLOB_BUCKET"')
+        if prefix is None:
+            prefix = BLOB_PREFIX
+        self.prefix = prefix
+        self._pid = None
+        self._bucket = None
+
+    def get_bucket(self):
+        # HTTP connections must not be shared with a forked process
+        if self._bucket is None or self._pid != os.getpid():
+            import boto.s3.connection
+            connection = boto.s3.connection.S3Connection(
+                settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY)
+            self._bucket = connection.get_bucket(self.bucket_name,
+                                                 validate=False)
+            self._pid = os.getpid()
+        return self._bucket
+
+    def put(self, data):
+        key = self.new_key()
+        self.get_bucket().new_key(self.prefix + key) \
+            .set_contents_from_string(data)
+        return key
+
+    def open(self, key):
+        blob = self.get_bucket().get_key(self.prefix + key)
+        if blob is None:
+            raise IOError(errno.ENOENT, "No such blob", key)
+        return blob
+
+    def delete(self, key):
+        self.get_bucket().delete_key(self.prefix + key)
+
+
+_stores = {
+    'filesystem': FileSystemBlobStore,
+    's3': S3BlobStore,
+    }
+_store = None
+
+
+def get_store():
+    """Return configured BlobStore instance, or None if disabled."""
+    global _store
+    if _store is None and BLOB_STORE:
+        cls = _stores.get(BLOB_STORE)
+        if cls is None:
+            module_name, _, class_name = BLOB_STORE.rpartition('.')
+            try:
+                cls = getattr(import_module(module_name), class_name)
+            except (ImportError, AttributeError, ValueError), e:
+                raise ImproperlyConfigured(
+                    "Cannot load blob store %s: %s" % (BLOB_STORE, e))
+        _store = cls()
+    return _store
+
+
+def check_out(body, store=None, threshold=None):
+    """Return `body', or a claim check if it is too long.
+
+    Long body is stored in `store' (configured blob store by
+    default); without a store, body is always returned as it is.
+    """
+    store = store or get_store()
+    if threshold is None:
+        threshold = BLOB_THRESHOLD
+    size = len(body.encode('utf-8') if isinstance(body, unicode) else body)
+    if store is None or size <= threshold:
+        return body
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    key = store.put(body)
+    return encode({'key': key, 'size': size}, 'claim')
+
+
+def is_claim_check(body):
+    return is_encoded(body) and body[2] == ClaimCheckCodec.tag
+
+
+class ClaimCheckMixin(object):
+    """Resolves claim checks received instead of message bodies.
+
+    Mixed into message classes of received messages by
+    `claim_check_class()'.  Message body is fetched from the store and
+    decoded by the message class when `get_body()' is first called.
+    """
+    _claim = None
+    _claim_resolved = False
+
+    def decode(self, value):
+        self._claim = None
+        if is_claim_check(value):
+            try:
+                self._claim = decode(value)
+                self._claim_resolved = False
+                return None
+            except Exception, e:
+                # let the message class report it
+                _log.error("Cannot decode claim check: %s" % e)
+        return super(ClaimCheckMixin, self).decode(value)
+
+    @property
+    def blob_key(self):
+        """Key of message body's blob, or None if it wasn't offloaded."""
+        if self._claim is not None:
+            return self._claim['key']
+
+    def open_body(self):
+        """Return a file-like object reading encoded message body.
+
+        For an offloaded body this streams the blob, without loading
+        all of it into memory.
+        """
+        if self._claim is not None:
+            return get_store().open(self._claim['key'])
+        return StringIO(self.get_body_encoded())
+
+    def get_body(self):
+        if self._claim is not None and not self._claim_resolved:
+            f = self.open_body()
+            try:
+                chunks = []
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            finally:
+                f.close()
+            self._claim_resolved = True
+            self.set_body(super(ClaimCheckMixin, self).decode(
+                ''.join(chunks)))
+        return super(ClaimCheckMixin, self).get_body()
+
+    def discard_blob(self):
+        """Delete offloaded body's blob (after message was deleted)."""
+        if self._claim is None:
+            return
+        try:
+            get_store().delete(self._claim['key'])
+        except Exception:
+            _log.exception("Cannot delete blob %s" % self._claim['key'])
+
+
+_classes = {}
+
+
+def claim_check_class(message_class):
+    """Return subclass of `message_class' resolving claim checks."""
+    if issubclass(message_class, ClaimCheckMixin):
+        return message_class
+    if message_class not in _classes:
+        _classes[message_class] = type(
+            message_class.__name__, (ClaimCheckMixin, message_class), {})
+    return _classes[message_class]
+
+
+def discard_blobs(messages):
+    """Delete blobs of deleted `messages' that were offloaded."""
+    for m in messages:
+        if isinstance(m, ClaimCheckMixin):
+            m.discard_blob()
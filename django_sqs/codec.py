@@ -0,0 +1,278 @@
+"""Compact and compressed encodings of message bodies.
+
+An encoded body starts with a short header: FORMAT_MARKER, format
+version, codec tag and compression tag, e.g. `!1jz' for zlib-compressed
+JSON.  Decoding looks only at the header, so a consumer can read
+messages written with any registered codec and compression,
+regardless of its own settings.  Bodies without the header are legacy
+ones and are left to the message class to decode.
+
+SQS message body must be text, so binary payloads (binary codecs, or
+compressed ones) are base64-encoded; text payloads are sent as they
+are.  Message classes using codecs are in `django_sqs.message'.
+"""
+import base64
+import re
+import zlib
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import django.utils.simplejson as json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.block as lz4
+except ImportError:
+    try:
+        import lz4
+    except ImportError:
+        lz4 = None
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# Payloads longer than this many bytes are compressed
+COMPRESS_THRESHOLD = getattr(settings, 'SQS_COMPRESS_THRESHOLD', 1024)
+
+# Compression used by CodecMessage; None disables compression
+COMPRESSION = getattr(settings, 'SQS_COMPRESSION', 'zlib')
+
+FORMAT_MARKER = '!'
+FORMAT_VERSION = '1'
+HEADER_LENGTH = 4
+
+NO_COMPRESSION = '-'
+
+
+class DecodeError(ValueError):
+    """Raised when an encoded body can't be decoded."""
+    pass
+
+
+class Codec(object):
+    """Serializes values to strings.
+
+    Subclasses set `name', a single-character `tag' that identifies
+    the codec in the header, and `binary' if the output is not text.
+    """
+    name = None
+    tag = None
+    binary = True
+
+    def dumps(self, value):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    name = 'json'
+    tag = 'j'
+    binary = False
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """Codec using msgpack library, which must be installed."""
+    name = 'msgpack'
+    tag = 'm'
+
+    def dumps(self, value):
+        if msgpack is None:
+            raise ImproperlyConfigured("msgpack is required for %s codec"
+                                       % self.name)
+        return msgpack.packb(value)
+
+    def loads(self, data):
+        if msgpack is None:
+            raise ImproperlyConfigured("msgpack is required for %s codec"
+                                       % self.name)
+        return msgpack.unpackb(data)
+
+
+class ModelReferenceCodec(Codec):
+    """Writes a (`app_label.model' label, primary key) pair as text.
+
+    Integer keys are written as `LABEL#123', other keys as
+    `LABEL=KEY' (in UTF-8).  Labels (unlike content type ids) are the
+    same in every database, so producer and consumer don't need to
+    share one.
+    """
+    name = 'model'
+    tag = 'r'
+    binary = False
+
+    _reference = re.compile(r'^([^#=]*)([#=])(.*)$', re.DOTALL)
+
+    def dumps(self, value):
+        label, pk = value
+        if isinstance(pk, (int, long)):
+            return '%s#%d' % (label, pk)
+        return ('%s=%s' % (label, pk)).encode('utf-8')
+
+    def loads(self, data):
+        match = self._reference.match(data)
+        if match is None:
+            raise DecodeError("Invalid model reference %r" % data)
+        label, kind, pk = match.groups()
+        if kind == '#':
+            return label, int(pk)
+        return label, pk.decode('utf-8')
+
+
+class Compression(object):
+    """Compresses encoded payloads; `tag' identifies it in the header."""
+    name = None
+    tag = None
+
+    def compress(self, data):
+        raise NotImplementedError
+
+    def decompress(self, data):
+        raise NotImplementedError
+
+
+class ZlibCompression(Compression):
+    name = 'zlib'
+    tag = 'z'
+
+    def compress(self, data):
+        return zlib.compress(data)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class LZ4Compression(Compression):
+    """Fast compression using lz4 library, which must be installed."""
+    name = 'lz4'
+    tag = '4'
+
+    def compress(self, data):
+        if lz4 is None:
+            raise ImproperlyConfigured("lz4 is required for %s compression"
+                                       % self.name)
+        return lz4.compress(data)
+
+    def decompress(self, data):
+        if lz4 is None:
+            raise ImproperlyConfigured("lz4 is required for %s compression"
+                                       % self.name)
+        return lz4.decompress(data)
+
+
+_codecs = {}
+_compressions = {}
+
+
+def register_codec(codec):
+    """Make `codec' (a Codec instance) available by name and tag."""
+    _codecs[codec.name] = _codecs[codec.tag] = codec
+
+
+def register_compression(compression):
+    """Make `compression' (a Compression instance) available by name and tag."""
+    _compressions[compression.name] = _compressions[compression.tag] = \
+        compression
+
+for _codec in (JSONCodec(), MsgpackCodec(), ModelReferenceCodec()):
+    register_codec(_codec)
+for _compression in (ZlibCompression(), LZ4Compression()):
+    register_compression(_compression)
+
+
+def get_codec(codec):
+    """Return registered codec by name or tag; Codec instances pass through."""
+    if isinstance(codec, Codec):
+        return codec
+    try:
+        return _codecs[codec]
+    except KeyError:
+        raise ImproperlyConfigured("Unknown codec %r" % codec)
+
+
+def get_compression(compression):
+    """Like `get_codec', for compressions; None means no compression."""
+    if compression is None or isinstance(compression, Compression):
+        return compression
+    try:
+        return _compressions[compression]
+    except KeyError:
+        raise ImproperlyConfigured("Unknown compression %r" % compression)
+
+
+def is_encoded(body):
+    """True if `body' has been encoded by `encode()' (of any version)."""
+    return body[:1] == FORMAT_MARKER and body[1:2].isdigit() \
+        and len(body) >= HEADER_LENGTH
+
+
+def encode(value, codec='json', compression=None,
+           compress_threshold=COMPRESS_THRESHOLD):
+    """Encode `value' with `codec' into a message body.
+
+    If `compression' is given, payloads longer than
+    `compress_threshold' bytes are compressed, as long as it makes
+    them shorter.
+    """
+    codec = get_codec(codec)
+    compression = get_compression(compression)
+    data = codec.dumps(value)
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    binary = codec.binary
+    tag = NO_COMPRESSION
+    if compression is not None and len(data) > compress_threshold:
+        compressed = compression.compress(data)
+        if len(compressed) < len(data):
+            data, tag, binary = compressed, compression.tag, True
+    if binary:
+        data = base64.b64encode(data)
+    return FORMAT_MARKER + FORMAT_VERSION + codec.tag + tag + data
+
+
+def decode(body):
+    """Decode message body written by `encode()'.
+
+    Raises DecodeError if `body' is malformed, or if its codec or
+    compression is unknown.
+    """
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    if not is_encoded(body):
+        raise DecodeError("Not an encoded message body")
+    if body[1] != FORMAT_VERSION:
+        raise DecodeError("Unsupported format version %r" % body[1])
+    codec = _codecs.get(body[2])
+    if codec is None:
+        raise DecodeError("Unknown codec tag %r" % body[2])
+    compression = None
+    if body[3] != NO_COMPRESSION:
+        compression = _compressions.get(body[3])
+        if compression is None:
+            raise DecodeError("Unknown compression tag %r" % body[3])
+    data = body[HEADER_LENGTH:]
+    try:
+        if codec.binary or compression is not None:
+            data = base64.b64decode(data)
+        if compression is not None:
+            data = compression.decompress(data)
+        return codec.loads(data)
+    except (DecodeError, ImproperlyConfigured):
+        raise
+    except Exception, e:
+        raise DecodeError(str(e))
@@ -0,0 +1,84 @@
+"""Process-wide connections and queues, opened by the configured
+transport (see `transports').
+
+For Amazon SQS, connections are shared by all registered queues of a
+process and queue URLs are resolved only once.
+"""
+import logging
+import threading
+
+from django.conf import settings
+
+from transports import get_transport
+
+# Number of threads resolving queue URLs in parallel
+RESOLVE_THREADS = getattr(settings, 'SQS_RESOLVE_THREADS', 10)
+
+
+class _NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+_log = logging.getLogger('django_sqs.connection')
+_log.addHandler(_NullHandler())
+
+
+def get_connection(region_name=None):
+    """Return connection for `region_name' (default is AWS_REGION)."""
+    return get_transport().get_connection(region_name)
+
+
+def get_queue(queue_name, visibility_timeout=None, region_name=None):
+    """Return queue object for queue named `queue_name'.
+
+    Queue is created if it doesn't exist yet.
+    """
+    return get_transport().get_queue(queue_name, visibility_timeout,
+                                     region_name)
+
+
+def call_in_parallel(calls, threads=None):
+    """Call each of `calls' callables using a pool of threads.
+
+    Returns a list of (result, exception) pairs, in order of `calls';
+    exception is None if the call succeeded.
+    """
+    calls = list(calls)
+    results = [None] * len(calls)
+    pending = range(len(calls))
+    threads = min(threads or RESOLVE_THREADS, len(calls))
+    lock = threading.Lock()
+
+    def _run():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                i = pending.pop()
+            try:
+                results[i] = (calls[i](), None)
+            except Exception, e:
+                results[i] = (None, e)
+
+    pool = [threading.Thread(target=_run) for i in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return results
+
+
+def resolve_in_parallel(resolvers, threads=None):
+    """Call each of `resolvers' callables using a pool of threads.
+
+    Exceptions are logged, not raised: an unresolved queue will be
+    resolved again (and fail loudly) when it is used.
+    """
+    for rv, e in call_in_parallel(resolvers, threads):
+        if e is not None:
+            _log.error("Cannot resolve queue: %s" % e)
+
+
+def reset():
+    """Forget all connections and cached queue URLs."""
+    get_transport().reset()
@@ -0,0 +1,196 @@
+"""Cooperative receive engine running receivers in gevent greenlets.
+
+A single process polls many queues at once and processes many
+messages concurrently, switching between them whenever a receiver
+waits for network.  Requires gevent; `monkey_patch()' must be called
+before the engine is started, so that socket operations of boto,
+database drivers and receivers yield to other greenlets.
+"""
+import logging
+import time
+
+try:
+    import gevent
+    import gevent.lock
+    import gevent.monkey
+    import gevent.pool
+except ImportError:
+    gevent = None
+
+from django.core.exceptions import ImproperlyConfigured
+
+from registered_queue import (
+    MIN_POLL_PERIOD, POLL_PERIOD, check_batch_size, check_wait_time_seconds)
+from workers import close_connections
+
+# Default limit of messages processed at the same time
+DEFAULT_CONCURRENCY = 100
+
+
+class _NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+
+def _require_gevent():
+    if gevent is None:
+        raise ImproperlyConfigured(
+            "gevent is required for cooperative receive engine")
+
+
+def monkey_patch():
+    """Make standard library blocking calls cooperative.
+
+    Django's database connection registry is thread-local storage
+    created at import time, most likely before patching; it is
+    replaced with a fresh (now greenlet-local) one, so that every
+    greenlet gets its own connections.
+    """
+    _require_gevent()
+    close_connections()
+    gevent.monkey.patch_all()
+
+    import threading
+    from django.db import connections
+    if hasattr(connections, '_connections'):
+        connections._connections = threading.local()
+
+
+class CooperativeEngine(object):
+    """Receives messages from many queues in one process.
+
+    `queues' is a list of (registered_queue, suffix) pairs.  Every
+    queue is polled by its own greenlet; received messages are
+    processed by receivers in separate greenlets, at most
+    `concurrency' at a time across all queues.  Free processing slots
+    are reserved before a queue is polled, so that no message waits
+    invisible for a free slot.  Note that a poller waiting for messages
+    (e.g. with long polling) holds up to a batch worth of slots, so
+    `concurrency' should be well above number of queues times their
+    batch size.
+
+    Receivers are plain functions; they run concurrently with each
+    other as long as they block only on monkey-patched calls.  Each
+    greenlet uses its own database connections, which are closed
+    after every message.  Batch receivers get all messages of a
+    single poll at once, without waiting for more (`batch_wait' is
+    ignored).
+    """
+
+    def __init__(self, queues, concurrency=None):
+        _require_gevent()
+        self.queues = queues
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY
+        self._stopped = False
+        self._slots = None
+        self._remaining = None
+        self._log = logging.getLogger('django_sqs.cooperative')
+        self._log.addHandler(_NullHandler())
+
+    def stop(self):
+        """Stop polling; messages being processed are finished."""
+        self._stopped = True
+        # wake up loops waiting for their throttle
+        for rq, suffix in self.queues:
+            rq.stop()
+
+    def run(self, message_limit=None, batch_size=None,
+            wait_time_seconds=None):
+        """Receive messages until stopped.
+
+        If `message_limit' number is given, return after processing
+        this number of messages in total.  `batch_size' and
+        `wait_time_seconds' override settings of all queues.
+        """
+        self._stopped = False
+        for rq, suffix in self.queues:
+            rq._stopping = False
+        self._slots = gevent.lock.Semaphore(self.concurrency)
+        self._remaining = message_limit
+        pollers = [gevent.spawn(self._poll, rq, suffix,
+                                batch_size, wait_time_seconds)
+                   for rq, suffix in self.queues]
+        try:
+            gevent.joinall(pollers, raise_error=True)
+        finally:
+            self.stop()
+            gevent.joinall(pollers)
+
+    def _reserve(self, batch_size):
+        """Reserve up to `batch_size' processing slots, at least one."""
+        self._slots.acquire()
+        n = 1
+        while n < batch_size and self._slots.acquire(blocking=False):
+            n += 1
+        if self._remaining is not None:
+            give_back = max(n - self._remaining, 0)
+            n -= give_back
+            self._remaining -= n
+            for i in range(give_back):
+                self._slots.release()
+        return n
+
+    def _release(self, n):
+        if self._remaining is not None:
+            self._remaining += n
+        for i in range(n):
+            self._slots.release()
+
+    def _poll(self, rq, suffix, batch_size, wait_time_seconds):
+        q = rq.get_queue(suffix)
+        batch_size = check_batch_size(batch_size or rq.batch_size)
+        if wait_time_seconds is None:
+            wait_time_seconds = rq.wait_time_seconds
+        check_wait_time_seconds(wait_time_seconds)
+        poll_period = min(MIN_POLL_PERIOD, POLL_PERIOD)
+        acks = rq.get_ack_buffer(suffix)
+        group = gevent.pool.Group()
+        try:
+            while not self._stopped:
+                n = self._reserve(batch_size)
+                if not n:
+                    # message limit reached
+                    self.stop()
+                    break
+                try:
+                    received = time.time()
+                    mm = rq.get_messages(q, n, wait_time_seconds)
+                except:
+                    self._release(n)
+                    raise
+                self._release(n - len(mm))
+                if not mm:
+                    if not wait_time_seconds:
+                        gevent.sleep(poll_period)
+                        poll_period = min(poll_period * 2, POLL_PERIOD)
+                    continue
+                poll_period = min(MIN_POLL_PERIOD, POLL_PERIOD)
+                rq.load_messages(mm)
+                if rq.batch:
+                    group.spawn(self._process_batch, rq, q, mm, acks, received)
+                else:
+                    for m in mm:
+                        group.spawn(self._process, rq, q, m, acks, received)
+        finally:
+            group.join()
+            if acks is not None:
+                acks.close()
+
+    def _process_batch(self, rq, q, mm, acks, received):
+        try:
+            rq._process_batch(q, mm, acks, received)
+        except:
+            self._log.exception("Uncaught exception in receiver greenlet")
+        finally:
+            close_connections()
+            for m in mm:
+                self._slots.release()
+
+    def _process(self, rq, q, m, acks, received):
+        try:
+            rq._process_message(q, m, acks, received)
+        except:
+            self._log.exception("Uncaught exception in receiver greenlet")
+        finally:
+            close_connections()
+            self._slots.release()
@@ -0,0 +1,139 @@
+import logging
+import threading
+import time
+
+from acks import MAX_BATCH_SIZE
+import metrics
+
+# Fraction of the visibility timeout after which visibility of a
+# message being processed is extended
+HEARTBEAT_FACTOR = 0.5
+
+
+class _NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+
+class Heartbeat(object):
+    """Keeps messages invisible in queue while they are processed.
+
+    Messages added with `add()' have their visibility timeout extended
+    to `visibility_timeout' seconds again whenever about half of it
+    has passed, until they are removed with `remove()' or `max_lifetime'
+    seconds have passed since they were added; after that, they become
+    visible when the last extension runs out.  Extensions of messages
+    due at the same time are sent with ChangeMessageVisibilityBatch
+    requests by a background thread.
+
+    This allows short visibility timeouts, so that messages of a
+    crashed receiver are redelivered soon, without long-running
+    receivers getting their messages redelivered while they still
+    work on them.
+    """
+
+    def __init__(self, visibility_timeout, max_lifetime=None, log=None):
+        self.visibility_timeout = visibility_timeout
+        self.max_lifetime = max_lifetime
+        self.interval = visibility_timeout * HEARTBEAT_FACTOR
+        if log is None:
+            log = logging.getLogger('django_sqs.heartbeat')
+            log.addHandler(_NullHandler())
+        self._log = log
+        # id(message) -> [message, time added, time of next extension]
+        self._messages = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._messages)
+
+    def add(self, messages, received=None):
+        """Start extending visibility of `messages'.
+
+        `received' is the time messages were received at (defaults to
+        now); first extension is due half of visibility timeout after
+        it.
+        """
+        now = time.time()
+        due = (received or now) + self.interval
+        with self._cond:
+            for m in messages:
+                self._messages[id(m)] = [m, now, due]
+            self._start()
+            self._cond.notify()
+
+    def remove(self, messages):
+        """Stop extending visibility of `messages'."""
+        with self._cond:
+            for m in messages:
+                self._messages.pop(id(m), None)
+
+    def _start(self):
+        # called with self._cond held
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='django_sqs-heartbeat')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    if [entry for entry in self._messages.values()
+                        if entry[2] <= now]:
+                        # extend messages that are due soon, too, so
+                        # that they share the request
+                        due = [entry for entry in self._messages.values()
+                               if entry[2] <= now + self.interval / 2]
+                        break
+                    if self._messages:
+                        self._cond.wait(min(entry[2] for entry in
+                                            self._messages.values()) - now)
+                    else:
+                        self._cond.wait()
+                expired = []
+                for entry in due:
+                    m, added, next_due = entry
+                    if self.max_lifetime and now - added >= self.max_lifetime:
+                        expired.append(m)
+                        del self._messages[id(m)]
+                    else:
+                        entry[2] = now + self.interval
+            for m in expired:
+                self._log.warning(
+                    "Message %s is being processed longer than %d seconds,"
+                    " it will be visible in queue again" % (
+                        m.id, self.max_lifetime))
+            self.extend([entry[0] for entry in due
+                         if entry[0] not in expired])
+
+    def extend(self, messages):
+        """Extend visibility timeout of `messages' now."""
+        by_queue = {}
+        for m in messages:
+            by_queue.setdefault(id(m.queue), (m.queue, []))[1].append(m)
+        for queue, mm in by_queue.values():
+            name = metrics.queue_name(queue)
+            for i in range(0, len(mm), MAX_BATCH_SIZE):
+                batch = mm[i:i+MAX_BATCH_SIZE]
+                metrics.incr(name + '.api.ChangeMessageVisibilityBatch')
+                try:
+                    rv = queue.change_message_visibility_batch(
+                        [(m, self.visibility_timeout) for m in batch])
+                except Exception:
+                    metrics.incr(
+                        name + '.api_errors.ChangeMessageVisibilityBatch')
+                    self._log.exception(
+                        "Cannot extend visibility of %d messages"
+                        % len(batch))
+                    continue
+                metrics.incr(name + '.extended',
+                             len(batch) - len(rv.errors))
+                for error in rv.errors:
+                    self._log.error(
+                        "Cannot extend visibility of message %s: %s: %s" % (
+                            error.get('id'), error.get('error_code'),
+                            error.get('error_message')))
@@ -0,0 +1,155 @@
+"""Idempotent receiving: skipping messages that were already processed.
+
+SQS may deliver a message more than once, and a message whose delete
+came late (after its visibility timeout) or failed is received and
+processed again.  A queue registered with `idempotent' stamps every
+message it sends with a dedup key (DedupKey message attribute), and
+remembers keys of processed messages for SQS_IDEMPOTENCY_TTL seconds;
+a received message whose key is remembered is deleted without calling
+the receiver.  Messages without a dedup key (e.g. sent by other
+producers) are identified by their SQS message id, which covers
+redeliveries, but not messages sent twice.
+
+Keys are kept in a bounded in-process LRU, and in Django's cache
+SQS_IDEMPOTENCY_CACHE (None to use only the LRU), shared by all
+receiver processes.  A database cache backend makes it durable.
+Only completed messages are remembered: a message processed by two
+receivers at the same time is not detected.
+"""
+from collections import OrderedDict
+from hashlib import md5
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+# Seconds for which keys of processed messages are remembered
+IDEMPOTENCY_TTL = getattr(settings, 'SQS_IDEMPOTENCY_TTL', 24 * 60 * 60)
+
+# Alias of Django cache shared by receivers, or None
+IDEMPOTENCY_CACHE = getattr(settings, 'SQS_IDEMPOTENCY_CACHE', 'default')
+
+# Number of keys remembered by each process
+IDEMPOTENCY_LRU_SIZE = getattr(settings, 'SQS_IDEMPOTENCY_LRU_SIZE', 10000)
+
+# Message attribute with the dedup key
+DEDUP_ATTRIBUTE = 'DedupKey'
+
+CACHE_KEY_PREFIX = 'django_sqs.done:'
+
+
+def get_cache(alias):
+    try:
+        from django.core.cache import caches
+    except ImportError:                 # Django < 1.7
+        from django.core.cache import get_cache
+        return get_cache(alias)
+    return caches[alias]
+
+
+def stamp(message, key=None):
+    """Set dedup key of `message' to `key' and return it.
+
+    Without `key', message keeps the key it has, or gets a new random
+    one.
+    """
+    if key is None:
+        key = dedup_key(message, None) or uuid.uuid4().hex
+    message.message_attributes[DEDUP_ATTRIBUTE] = {
+        'data_type': 'String', 'string_value': key}
+    return key
+
+
+def dedup_key(message, default=True):
+    """Return dedup key of a received `message'.
+
+    Without the DedupKey attribute, it is message's id (unless
+    `default' is None).
+    """
+    attribute = (message.message_attributes or {}).get(DEDUP_ATTRIBUTE)
+    if attribute and attribute.get('string_value'):
+        return attribute['string_value']
+    if default is not None:
+        return message.id
+
+
+class IdempotencyStore(object):
+    """Remembers keys of processed messages for `ttl' seconds.
+
+    Up to `size' most recently used keys are kept in memory; all the
+    keys are kept in `cache' (a Django cache, or its alias), if any.
+    """
+
+    def __init__(self, ttl=None, size=None, cache=IDEMPOTENCY_CACHE):
+        self.ttl = ttl or IDEMPOTENCY_TTL
+        self.size = size or IDEMPOTENCY_LRU_SIZE
+        if isinstance(cache, basestring):
+            cache = get_cache(cache)
+        self.cache = cache
+        self._lru = OrderedDict()       # key -> expiry time
+        self._lock = threading.Lock()
+
+    def _cache_key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        # cache backends limit length and characters of keys
+        return CACHE_KEY_PREFIX + md5(key).hexdigest()
+
+    def _remember(self, entries):
+        with self._lock:
+            for key, expires in entries:
+                self._lru.pop(key, None)
+                self._lru[key] = expires
+            while len(self._lru) > self.size:
+                self._lru.popitem(last=False)
+
+    def done(self, keys):
+        """Return set of `keys' that have been marked as done."""
+        now = time.time()
+        rv = set()
+        missing = []
+        with self._lock:
+            for key in keys:
+                expires = self._lru.get(key)
+                if expires is None:
+                    missing.append(key)
+                elif expires < now:
+                    del self._lru[key]
+                    missing.append(key)
+                else:
+                    # move to the most recently used end
+                    del self._lru[key]
+                    self._lru[key] = expires
+                    rv.add(key)
+        if missing and self.cache is not None:
+            cache_keys = dict((self._cache_key(key), key) for key in missing)
+            found = [(cache_keys[cache_key], cached) for cache_key, cached
+                     in self.cache.get_many(cache_keys.keys()).items()
+                     if cached >= now]
+            rv.update(key for key, cached in found)
+            self._remember(found)
+        return rv
+
+    def mark_done(self, keys):
+        """Remember `keys' of processed messages."""
+        keys = list(keys)
+        if not keys:
+            return
+        expires = time.time() + self.ttl
+        self._remember((key, expires) for key in keys)
+        if self.cache is not None:
+            self.cache.set_many(
+                dict((self._cache_key(key), expires) for key in keys),
+                self.ttl)
+
+
+_store = None
+
+
+def get_default_store():
+    """Return IdempotencyStore configured by SQS_IDEMPOTENCY_* settings."""
+    global _store
+    if _store is None:
+        _store = IdempotencyStore()
+    return _store
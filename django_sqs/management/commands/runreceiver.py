@@ -1,46 +1,58 @@
+from functools import partial
 import logging
+import multiprocessing
 import os
 from optparse import make_option
 import signal
+import sys
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 import django_sqs
+from django_sqs import metrics
+from django_sqs.multiplex import Multiplexer
+from django_sqs.supervisor import Supervisor, WorkerGroup
 
-# null handler to avoid warnings
-class _NullHandler(logging.Handler):
-    def emit(self, record):
-        pass
+def _parse_workers(spec):
+    "Parse `N' or `MIN-MAX' number of workers into (min, max) pair."
+    min_workers, sep, max_workers = str(spec).partition('-')
+    try:
+        if sep:
+            return int(min_workers), int(max_workers)
+        return int(min_workers), int(min_workers)
+    except ValueError:
+        raise CommandError("Invalid number of workers: %r" % spec)
 
-# signal name dict for logging
-_signals = {}
-for name in dir(signal):
-    if name.startswith('SIG'):
-        _signals[getattr(signal, name)] = name
-def _status_string(status):
-    "Pretty status description for exited child."
+def _parse_queue_name(arg, default_workers):
+    """Split `queue_name:N' or `queue_name:MIN-MAX' argument.
 
-    if os.WIFSIGNALED(status):
-        return "Terminated by %s (%d)" % (
-            _signals.get(os.WTERMSIG(status), "unknown signal"),
-            os.WTERMSIG(status))
+    Returns (queue_name, min_workers, max_workers) triple."""
+    queue_name, sep, workers = arg.rpartition(':')
+    if sep and workers.replace('-', '').isdigit():
+        return (queue_name, ) + _parse_workers(workers)
+    return (arg, ) + default_workers
 
-    if os.WIFEXITED(status):
-        return "Exited with status %d" % os.WEXITSTATUS(status)
+def _stop_on_sigterm(stop):
+    "Call `stop' on SIGTERM, letting interrupted system calls finish."
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop())
+    signal.siginterrupt(signal.SIGTERM, False)
 
-    if os.WIFSTOPPED(status):
-        return "Stopped by %s (%d)" % (
-            _signals.get(os.WSTOPSIG(status), "unknown signal"),
-            os.WSTOPSIG(status))
-
-    if os.WIFCONTINUED(status):
-        return "Continued from stop"
-
-    return "Unknown reason (%r)" % status
+def _parse_weights(specs):
+    "Parse list of `queue_name=W' strings into a dict."
+    weights = {}
+    for spec in specs or ():
+        queue_name, sep, weight = spec.rpartition('=')
+        try:
+            weights[queue_name] = int(weight)
+        except ValueError:
+            sep = None
+        if not sep or weights[queue_name] <= 0:
+            raise CommandError("Invalid queue weight: %r" % spec)
+    return weights
 
 class Command(BaseCommand):
     help = "Run Amazon SQS receiver for queues registered with django_sqs."
-    args = '[queue_name [queue_name [...]]]'
+    args = '[queue_name[:N] [queue_name[:N] [...]]]'
     option_list = BaseCommand.option_list + (
         make_option('--daemonize',
                     action='store_true', dest='daemonize', default=False,
@@ -59,13 +71,117 @@ class Command(BaseCommand):
         make_option('--message-limit',
                     dest='message_limit', default=None, type='int',
                     metavar='N', help='Exit after processing N messages'),
+        make_option('--batch-size',
+                    dest='batch_size', default=None, type='int',
+                    metavar='N',
+                    help='Fetch up to N (at most 10) messages per SQS request'),
+        make_option('--wait-time-seconds',
+                    dest='wait_time_seconds', default=None, type='int',
+                    metavar='SECONDS',
+                    help='Use SQS long polling, waiting up to SECONDS'
+                    ' (at most 20) for messages to arrive; 0 disables'
+                    ' long polling'),
+        make_option('--concurrency',
+                    dest='concurrency', default=None, type='int',
+                    metavar='N',
+                    help='Process up to N messages at a time, each in its'
+                    ' own thread (or greenlet, with --cooperative)'),
+        make_option('--cooperative',
+                    action='store_true', dest='cooperative', default=False,
+                    help='Receive from all queues in a single process,'
+                    ' running receivers in gevent greenlets'),
+        make_option('--workers',
+                    dest='workers', default='1', metavar='N|MIN-MAX',
+                    help='Run N worker processes for each queue, or'
+                    ' scale between MIN and MAX processes depending on'
+                    ' queue length (use queue_name:N or'
+                    ' queue_name:MIN-MAX to set it for a single queue)'),
+        make_option('--max-messages-per-child',
+                    dest='max_messages_per_child', default=None, type='int',
+                    metavar='N',
+                    help='Replace worker process with a fresh one after'
+                    ' it processes N messages'),
+        make_option('--multiplex',
+                    action='store_true', dest='multiplex', default=False,
+                    help='Receive from all queues (and their suffixes)'
+                    ' in each worker process, instead of running separate'
+                    ' processes for each queue'),
+        make_option('--priority',
+                    dest='priority', default='weighted',
+                    type='choice', choices=('weighted', 'strict'),
+                    help='How --multiplex chooses queue to poll next:'
+                    ' "weighted" (default) round robin, or "strict"'
+                    ' priority by weight'),
+        make_option('--weight',
+                    dest='weights', action='append', default=[],
+                    metavar='QUEUE_NAME=W',
+                    help='Weight (priority) of a queue with --multiplex;'
+                    ' default is 1.  May be given multiple times.'),
+        make_option('--resolve-queues',
+                    action='store_true', dest='resolve_queues',
+                    default=None,
+                    help='Resolve URLs of all the queues in parallel'
+                    ' before receiving (done by default when worker'
+                    ' processes are forked, so that they don\'t need to)'),
+        make_option('--no-resolve-queues',
+                    action='store_false', dest='resolve_queues',
+                    help='Don\'t resolve URLs of queues before forking'
+                    ' worker processes'),
+        make_option('--metrics-interval',
+                    dest='metrics_interval', default=None, type='int',
+                    metavar='SECONDS',
+                    help='Print summary of metrics collected in each'
+                    ' receiving process every SECONDS'),
+        make_option('--profile',
+                    action='store_true', dest='profile', default=False,
+                    help='Profile receiving processes, writing results'
+                    ' on exit and on SIGUSR1'),
+        make_option('--profile-mode',
+                    dest='profile_mode', default='cprofile',
+                    type='choice', choices=('cprofile', 'sample'),
+                    help='"cprofile" (default) writes QUEUE.PID.pstats'
+                    ' files, "sample" writes sampled stacks in'
+                    ' QUEUE.PID.folded files for flamegraph.pl'),
+        make_option('--profile-dir',
+                    dest='profile_dir', default='.', metavar='DIRECTORY',
+                    help='Write profiling results to DIRECTORY (default'
+                    ' is current directory)'),
+        make_option('--profile-messages',
+                    dest='profile_messages', default=None, type='int',
+                    metavar='N',
+                    help='Stop profiling and write results after N'
+                    ' messages'),
         )
 
+    metrics_interval = None
+    resolve_queues = None
+    profile_options = None
+
     def handle(self, *queue_names, **options):
+        metrics.process_started()
         self.validate()
+        self.metrics_interval = options.get('metrics_interval', None)
+        self.resolve_queues = options.get('resolve_queues', None)
+        if options.get('profile', False):
+            if options.get('cooperative', False):
+                raise CommandError("--profile can't be used with"
+                                   " --cooperative")
+            self.profile_options = dict(
+                mode=options.get('profile_mode', 'cprofile'),
+                directory=options.get('profile_dir', '.'),
+                messages=options.get('profile_messages', None))
+        if int(options.get('verbosity', 1)) > 1:
+            # report time to first message of each process
+            log = logging.getLogger('django_sqs.metrics')
+            log.addHandler(logging.StreamHandler())
+            log.setLevel(logging.INFO)
 
         if not queue_names:
             queue_names = django_sqs.queues.keys()
+        default_workers = _parse_workers(options.get('workers', '1'))
+        queue_workers = [_parse_queue_name(arg, default_workers)
+                         for arg in queue_names]
+        queue_names = [queue_name for queue_name, _, _ in queue_workers]
 
         if options.get('daemonize', False):
             from django.utils.daemonize import become_daemon
@@ -76,54 +192,190 @@ class Command(BaseCommand):
             with open(options['pid_file'], 'w') as f:
                 f.write('%d\n' % os.getpid())
 
-        if len(queue_names) == 1:
+        if self.resolve_queues:
+            django_sqs.resolve_queues(queue_names)
+
+        if options.get('cooperative', False):
+            self.receive_cooperative(
+                queue_names,
+                suffix=options.get('suffix'),
+                concurrency=options.get('concurrency', None),
+                message_limit=options.get('message_limit', None),
+                batch_size=options.get('batch_size', None),
+                wait_time_seconds=options.get('wait_time_seconds', None))
+            return
+
+        if options.get('multiplex', False):
+            if [arg for arg in queue_names
+                if _parse_queue_name(arg, (None, None))[1] is not None]:
+                raise CommandError("Use --workers to set number of workers"
+                                   " with --multiplex")
+            for option, name in (('concurrency', '--concurrency'),
+                                 ('wait_time_seconds', '--wait-time-seconds')):
+                if options.get(option, None) is not None:
+                    raise CommandError("%s can't be used with --multiplex"
+                                       % name)
+            self.handle_multiplexed(queue_names, default_workers, **options)
+            return
+
+        # options passed down to RegisteredQueue.receive_loop
+        receive_options = dict(
+            batch_size=options.get('batch_size', None),
+            wait_time_seconds=options.get('wait_time_seconds', None),
+            concurrency=options.get('concurrency', None))
+
+        max_messages_per_child = options.get('max_messages_per_child', None)
+        if (len(queue_workers) == 1 and queue_workers[0][1:] == (1, 1)
+            and not max_messages_per_child):
             self.receive(queue_names[0],
                          suffix=options.get('suffix'),
-                         message_limit=options.get('message_limit', None))
+                         message_limit=options.get('message_limit', None),
+                         **receive_options)
         else:
-            # fork a group of processes.  Quick hack, to be replaced
-            # ASAP with something decent.
-            _log = logging.getLogger('django_sqs.runreceiver.master')
-            _log.addHandler(_NullHandler())
-
-            # Close the DB connection now and let Django reopen it when it
-            # is needed again.  The goal is to make sure that every
-            # process gets its own connection
-            from django.db import connection
-            connection.close()
-
-            os.setpgrp()
-            children = {}               # queue name -> pid
-            for queue_name in queue_names:
-                pid = self.fork_child(queue_name,
-                                      options.get('message_limit', None))
-                children[pid] = queue_name
-                _log.info("Forked %s for %s" % (pid, queue_name))
-
-            while children:
-                pid, status = os.wait()
-                queue_name = children[pid]
-                _log.error("Child %d (%s) exited: %s" % (
-                    pid, children[pid], _status_string(status) ))
-                del children[pid]
-
-                pid = self.fork_child(queue_name)
-                children[pid] = queue_name
-                _log.info("Respawned %s for %s" % (pid, queue_name))
-
-    def fork_child(self, queue_name, message_limit=None):
-        pid = os.fork()
-        if pid:                         # parent
-            return pid
-        # child
-        _log = logging.getLogger('django_sqs.runreceiver.%s' % queue_name)
-        _log.addHandler(_NullHandler())
-        _log.info("Start receiving.")
-        self.receive(queue_name, message_limit=message_limit)
-        _log.error("CAN'T HAPPEN: exiting.")
-        raise SystemExit(0)
-
-    def receive(self, queue_name, message_limit=None, suffix=None):
+            groups = []
+            for queue_name, min_workers, max_workers in queue_workers:
+                suffix = options.get('suffix')
+                depth = counter = None
+                if max_workers > min_workers:
+                    counter = multiprocessing.Value('L', 0)
+                    depth = partial(self.queue_depth, queue_name, suffix)
+                groups.append(WorkerGroup(
+                    queue_name,
+                    partial(self.receive, queue_name,
+                            suffix=suffix,
+                            counter=counter,
+                            **receive_options),
+                    workers=min_workers,
+                    max_workers=max_workers,
+                    depth=depth,
+                    counter=counter,
+                    message_limit=options.get('message_limit', None),
+                    max_messages_per_child=max_messages_per_child))
+            self.prepare_workers(queue_names)
+            Supervisor(groups).run()
+
+    def handle_multiplexed(self, queue_names, default_workers, **options):
+        weights = _parse_weights(options.get('weights'))
+        entries = []
+        for queue_name in queue_names:
+            rq = django_sqs.queues[queue_name]
+            if not rq.receiver:
+                print 'Queue %s has no receiver, skipping.' % queue_name
+                continue
+            if options.get('suffix'):
+                suffixes = (options['suffix'], )
+            else:
+                # dead letter queue is not received from by default
+                suffixes = (None, ) + tuple(
+                    suffix for suffix in rq.suffixes
+                    if suffix != rq.dead_letter)
+            for suffix in suffixes:
+                entries.append((rq, suffix, weights.get(queue_name, 1)))
+        if not entries:
+            return
+
+        min_workers, max_workers = default_workers
+        max_messages_per_child = options.get('max_messages_per_child', None)
+        if default_workers == (1, 1) and not max_messages_per_child:
+            self.receive_multiplexed(
+                entries, options['priority'],
+                message_limit=options.get('message_limit', None),
+                batch_size=options.get('batch_size', None))
+            return
+
+        depth = counter = None
+        if max_workers > min_workers:
+            counter = multiprocessing.Value('L', 0)
+            depth = lambda: sum(rq.get_queue(suffix).count()
+                                for rq, suffix, weight in entries)
+        self.prepare_workers(set(rq.name for rq, suffix, weight in entries))
+        Supervisor([WorkerGroup(
+            'multiplex',
+            partial(self.receive_multiplexed, entries, options['priority'],
+                    batch_size=options.get('batch_size', None),
+                    counter=counter),
+            workers=min_workers,
+            max_workers=max_workers,
+            depth=depth,
+            counter=counter,
+            message_limit=options.get('message_limit', None),
+            max_messages_per_child=max_messages_per_child)]).run()
+
+    def prepare_workers(self, queue_names):
+        """Prepare for forking worker processes.
+
+        Queue URLs are resolved once, in the master process (unless
+        disabled with --no-resolve-queues), so that workers forked
+        later, e.g. respawned or added by autoscaling, inherit them
+        and start receiving right away.
+        """
+        if self.resolve_queues is None:
+            django_sqs.resolve_queues(queue_names)
+
+    def start_metrics(self):
+        """Start reporting metrics summaries, if requested.
+
+        Called in each receiving process, since reporter thread
+        doesn't survive a fork."""
+        if self.metrics_interval:
+            from django_sqs.metrics import SummaryReporter
+            pid = os.getpid()
+
+            def report(lines):
+                for line in lines:
+                    print '[%d] %s' % (pid, line)
+                sys.stdout.flush()
+            SummaryReporter(self.metrics_interval, report).start()
+
+    def start_profiler(self, registered_queues):
+        """Start profiling `registered_queues', if requested.
+
+        Called in each receiving process; returns the Profiler, or
+        None.  Results are written on SIGUSR1, and should be written
+        with `stop_profiler()' when the process exits."""
+        if self.profile_options is None:
+            return None
+        from django_sqs.profiling import Profiler
+        pid = os.getpid()
+
+        def report(lines):
+            for line in lines:
+                print '[%d] %s' % (pid, line)
+            sys.stdout.flush()
+        profiler = Profiler(report=report, **self.profile_options)
+        profiler.install(registered_queues)
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: profiler.write())
+        signal.siginterrupt(signal.SIGUSR1, False)
+        return profiler
+
+    def stop_profiler(self, profiler):
+        # with --profile-messages, results may be written already
+        if profiler is not None and profiler.running:
+            profiler.uninstall()
+            profiler.write()
+
+    def queue_depth(self, queue_name, suffix=None):
+        q = django_sqs.queues[queue_name].get_queue(suffix)
+        return q.count()
+
+    def receive_multiplexed(self, entries, priority, message_limit=None,
+                            batch_size=None, counter=None):
+        profiler = self.start_profiler(
+            set(rq for rq, suffix, weight in entries))
+        mux = Multiplexer(entries, priority)
+        _stop_on_sigterm(mux.stop)
+        self.start_metrics()
+        print 'Receiving from queues %s...' % ', '.join(
+            str(entry) for entry in mux.entries)
+        try:
+            return mux.run(message_limit=message_limit,
+                           batch_size=batch_size, counter=counter)
+        finally:
+            self.stop_profiler(profiler)
+
+    def receive(self, queue_name, message_limit=None, suffix=None,
+                **receive_options):
         rq = django_sqs.queues[queue_name]
         if rq.receiver:
             if message_limit is None:
@@ -131,11 +383,41 @@ class Command(BaseCommand):
             else:
                 message_limit_info = ' %d messages' % message_limit
 
+            _stop_on_sigterm(rq.stop)
+            self.start_metrics()
+            profiler = self.start_profiler([rq])
             print 'Receiving%s from queue %s%s...' % (
                 message_limit_info, queue_name,
                 ('.%s' % suffix if suffix else ''),
                 )
-            rq.receive_loop(message_limit=message_limit,
-                            suffix=suffix)
+            try:
+                return rq.receive_loop(message_limit=message_limit,
+                                       suffix=suffix,
+                                       **receive_options)
+            finally:
+                self.stop_profiler(profiler)
         else:
             print 'Queue %s has no receiver, aborting.' % queue_name
+
+    def receive_cooperative(self, queue_names, suffix=None, concurrency=None,
+                            message_limit=None, **receive_options):
+        from django_sqs import cooperative
+        cooperative.monkey_patch()
+
+        rqs = []
+        for queue_name in queue_names:
+            rq = django_sqs.queues[queue_name]
+            if rq.receiver:
+                rqs.append((rq, suffix))
+            else:
+                print 'Queue %s has no receiver, skipping.' % queue_name
+        if not rqs:
+            return
+
+        engine = cooperative.CooperativeEngine(rqs, concurrency=concurrency)
+        _stop_on_sigterm(engine.stop)
+        self.start_metrics()
+        print 'Receiving from queues %s...' % ', '.join(
+            '%s%s' % (rq.name, ('.%s' % suffix if suffix else ''))
+            for rq, suffix in rqs)
+        engine.run(message_limit=message_limit, **receive_options)
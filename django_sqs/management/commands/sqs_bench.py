@@ -0,0 +1,108 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_sqs import bench
+
+
+class Command(BaseCommand):
+    help = "Benchmark sending and receiving messages with django_sqs."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--messages', '-n',
+                    type='int', dest='messages', default=1000, metavar='N',
+                    help='Number of messages to send and receive'
+                    ' (default is 1000)'),
+        make_option('--size',
+                    type='int', dest='size', default=100, metavar='BYTES',
+                    help='Size of message body (default is 100)'),
+        make_option('--message-class',
+                    dest='message_class', default='raw',
+                    type='choice', choices=sorted(bench.MESSAGE_CLASSES),
+                    help='Message class: "raw" (default), "json" or'
+                    ' "model" (ModelInstanceMessage of ContentType'
+                    ' instances)'),
+        make_option('--receiver-cost',
+                    type='float', dest='receiver_cost', default=0,
+                    metavar='SECONDS',
+                    help='Time receiver spends on each message'),
+        make_option('--cost-type',
+                    dest='cost_type', default='sleep',
+                    type='choice', choices=bench.COST_TYPES,
+                    help='Whether receiver "sleep"s (default) or uses'
+                    ' "cpu" for --receiver-cost'),
+        make_option('--batch-size',
+                    type='int', dest='batch_size', default=10, metavar='N',
+                    help='Receive up to N messages per request'
+                    ' (default is 10)'),
+        make_option('--wait-time-seconds',
+                    type='int', dest='wait_time_seconds', default=1,
+                    metavar='SECONDS',
+                    help='Use long polling, waiting up to SECONDS'
+                    ' (default is 1; 0 polls with sleeps in between,'
+                    ' which adds to latency when receiver is faster'
+                    ' than sender)'),
+        make_option('--concurrency',
+                    type='int', dest='concurrency', default=1, metavar='N',
+                    help='Process up to N messages at a time in threads'),
+        make_option('--delete-batch-size',
+                    type='int', dest='delete_batch_size', default=None,
+                    metavar='N',
+                    help='Delete processed messages in batches of N'),
+        make_option('--batch-receiver',
+                    action='store_true', dest='batch_receiver',
+                    default=False,
+                    help='Use a batch receiver'),
+        make_option('--send-batch',
+                    action='store_true', dest='send_batch', default=False,
+                    help='Send messages with SendMessageBatch requests'),
+        make_option('--transport',
+                    dest='transport', default='memory',
+                    type='choice', choices=bench.TRANSPORTS,
+                    help='Queues to use: "memory" (default), "sqlite"'
+                    ' (temporary database) or "configured" (as set'
+                    ' by SQS_TRANSPORT)'),
+        make_option('--label',
+                    dest='label', default=None,
+                    help='Name of this run, saved with the results'),
+        make_option('--save',
+                    dest='save', default=None, metavar='FILE',
+                    help='Save results as JSON to FILE'),
+        make_option('--compare',
+                    dest='compare', default=None, metavar='FILE',
+                    help='Compare results with ones saved in FILE'),
+        )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError("Command doesn't accept any arguments")
+        baseline = None
+        if options.get('compare'):
+            try:
+                baseline = bench.load(options['compare'])
+            except (IOError, ValueError), e:
+                raise CommandError("Cannot load %s: %s"
+                                   % (options['compare'], e))
+        benchmark = bench.Benchmark(
+            messages=options['messages'],
+            size=options['size'],
+            message_class=options['message_class'],
+            receiver_cost=options['receiver_cost'],
+            cost_type=options['cost_type'],
+            batch_size=options['batch_size'],
+            wait_time_seconds=options['wait_time_seconds'],
+            concurrency=options['concurrency'],
+            delete_batch_size=options['delete_batch_size'],
+            batch_receiver=options['batch_receiver'],
+            send_batch=options['send_batch'],
+            transport=options['transport'],
+            label=options.get('label'))
+        results = benchmark.run()
+        for line in bench.format_results(results):
+            print line
+        if baseline is not None:
+            print
+            for line in bench.compare(results, baseline):
+                print line
+        if options.get('save'):
+            bench.save(results, options['save'])
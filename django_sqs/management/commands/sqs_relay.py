@@ -0,0 +1,69 @@
+from optparse import make_option
+import logging
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from django_sqs import outbox
+
+RELAY_LIMIT = getattr(settings, 'SQS_RELAY_LIMIT', 100)
+RELAY_INTERVAL = getattr(settings, 'SQS_RELAY_INTERVAL', 1)
+
+class Command(BaseCommand):
+    help = "Send messages from django_sqs database outbox to SQS."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', '-l',
+                    type='int', dest='limit', metavar='N',
+                    default=RELAY_LIMIT,
+                    help="Send up to N messages at a time."
+                    " Default is %d." % RELAY_LIMIT),
+        make_option('--interval', '-i',
+                    type='float', dest='interval', metavar='SECONDS',
+                    default=RELAY_INTERVAL,
+                    help="Time to sleep when outbox is empty."
+                    " Default is %s." % RELAY_INTERVAL),
+        make_option('--once', action='store_true', dest='once',
+                    help="Send messages that are in the outbox and exit."),
+        make_option('--database', dest='database', metavar='ALIAS',
+                    help="Database of the outbox.  Default is"
+                    " SQS_OUTBOX_DATABASE."),
+        )
+
+    def handle(self, **options):
+        self.validate()
+        verbosity = int(options.get('verbosity', 1))
+        log = logging.getLogger('django_sqs.outbox')
+        if verbosity > 1:
+            log.addHandler(logging.StreamHandler())
+            log.setLevel(logging.INFO)
+
+        self.running = True
+        def stop(signum, frame):
+            self.running = False
+        signal.signal(signal.SIGTERM, stop)
+        signal.siginterrupt(signal.SIGTERM, False)
+
+        limit = options['limit']
+        total = 0
+        try:
+            while self.running:
+                fetched, sent = outbox.relay(limit, using=options['database'],
+                                             log=log)
+                total += sent
+                if sent and verbosity > 1:
+                    print "Relayed %d messages." % sent
+                if fetched < limit:
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+                elif not sent and not options['once']:
+                    # nothing could be sent, e.g. SQS is down: don't
+                    # go through the rest of the outbox in a tight loop
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        if verbosity > 0 and options['once']:
+            print "Relayed %d messages." % total
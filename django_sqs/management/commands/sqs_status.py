@@ -1,20 +1,35 @@
-from django.core.management.base import NoArgsCommand
+from optparse import make_option
 
-import django_sqs
+from django.core.management.base import BaseCommand
 
+from django_sqs import status
 
-class Command(NoArgsCommand):
+
+class Command(BaseCommand):
     help = "Provides information about used SQS queues and the number of items in each of them."
+    args = '[queue_name [queue_name [...]]]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--json',
+                    action='store_true', dest='json', default=False,
+                    help='Print status as JSON'),
+        make_option('--max-age',
+                    type='int', dest='max_age', default=None,
+                    metavar='SECONDS',
+                    help='Reuse status cached less than SECONDS ago'
+                    ' (default is SQS_STATUS_CACHE_TTL, 0 always'
+                    ' fetches fresh status)'),
+        )
 
-    def handle_noargs(self, **options):
+    def handle(self, *queue_names, **options):
+        statuses = status.get_status(queue_names or None,
+                                     max_age=options.get('max_age'))
+        if options.get('json'):
+            print status.format_json(statuses)
+            return
         print
         print "Active SQS queues"
         print "-----------------"
         print
-        for label, queue in django_sqs.queues.items():
-            q = queue.get_queue()
-            print "%-30s: %4s" % (label, q.count())
-            if queue.suffixes:
-                for suffix in queue.suffixes:
-                    q = queue.get_queue(suffix)
-                    print " .%-28s: %4s" % (suffix, q.count())
+        for line in status.format_text(statuses):
+            print line
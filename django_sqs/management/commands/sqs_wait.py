@@ -2,9 +2,10 @@ from optparse import make_option
 import time
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 import django_sqs
+from django_sqs import status
 
 WAIT_TIME = getattr(settings, 'SQS_WAIT_TIME', 60)
 WAIT_CYCLES = getattr(settings, 'SQS_WAIT_CYCLES', 1)
@@ -35,18 +36,24 @@ class Command(BaseCommand):
         if not queue_names:
             queue_names = django_sqs.queues.keys()
         verbosity = int(options.get('verbosity', 1))
+        django_sqs.resolve_queues(queue_names)
 
         empty_cycles = 0
         while True:
             empty = True
-            for qname in queue_names:
-                q = django_sqs.queues[qname].get_queue()
-                c = q.count()
+            for s in status.get_status(queue_names, suffixes=False,
+                                       max_age=0):
+                if s['error'] is not None:
+                    raise CommandError("Cannot check queue %s: %s" % (
+                        s['queue'], s['error']))
+                c = status.total(s)
                 if c > 0:
                     empty = False
                     if verbosity > 1:
-                        print "Queue %s has %d messages, keep waiting." % (
-                            qname, c)
+                        print "Queue %s has %d messages (%d in flight," \
+                            " %d delayed), keep waiting." % (
+                            s['queue'], c, s['in_flight'] or 0,
+                            s['delayed'] or 0)
                     break
 
             if empty:
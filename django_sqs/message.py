@@ -10,44 +10,115 @@ except ImportError:
 
 import boto.sqs.message
 
-from django.contrib.contenttypes.models import ContentType
+from django.conf import settings
+
+from codec import (decode, encode, is_encoded,
+                   COMPRESSION, COMPRESS_THRESHOLD)
+
+# Write messages in the format used before codecs were introduced, so
+# that consumers that haven't been upgraded yet can read them; set to
+# False once all of them can read the compact format
+LEGACY_ENCODING = getattr(settings, 'SQS_LEGACY_ENCODING', True)
 
 
 class ModelInstanceMessage(boto.sqs.message.RawMessage):
-    """SQS Message class that returns 
+    """SQS Message class that returns a Django model instance.
+
+    Only a reference to the instance (app label, model name and
+    primary key) is sent: as base64-encoded JSON, or packed with the
+    `model' codec when SQS_LEGACY_ENCODING is False; both formats can
+    be received.  The instance is fetched from the database when
+    message body is first needed; messages received together can be
+    loaded with a single query per model using `load_batch()'.
     """
+
+    __reference = None
+    __reason = None
+    __loaded = False
+
     def __init__(self, queue=None, instance=None):
         boto.sqs.message.RawMessage.__init__(
             self, queue=queue, body=instance)
 
     def encode(self, value):
+        from django.contrib.contenttypes.models import ContentType
         ct = ContentType.objects.get_for_model(value)
-        return base64.b64encode(
-            json.dumps(
-                (ct.app_label, ct.model, value.pk)))
+        if LEGACY_ENCODING:
+            return base64.b64encode(
+                json.dumps(
+                    (ct.app_label, ct.model, value.pk)))
+        return encode(('%s.%s' % (ct.app_label, ct.model), value.pk),
+                      'model')
 
     def decode(self, value):
+        # reference is a ((app_label, model), pk) pair
+        self.__loaded = False
         try:
-            app_label, model, pk = json.loads(base64.b64decode(value))
+            if is_encoded(value):
+                label, pk = decode(value)
+                app_label, _, model = label.partition('.')
+                self.__reference = ((app_label, model), pk)
+            else:
+                app_label, model, pk = json.loads(base64.b64decode(value))
+                self.__reference = ((app_label, model), pk)
         except Exception, e:
+            self.__reference = None
             self.__reason = "Error decoding payload: %s" % e
-            return None
-            
-        try:
-            ct = ContentType.objects.get(app_label=app_label, model=model)
-        except ContentType.DoesNotExist:
-            self.__reason = "Invalid content type."
-            return None
+        return None
 
-        cls = ct.model_class()
-        try:
-            return cls.objects.get(pk=pk)
-        except cls.DoesNotExist:
-            self.__reason = "%s.%s %r does not exist" % (
-                cls.__module__, cls.__name__, pk)
-            return None
+    @classmethod
+    def load_batch(cls, messages, select_related=None, prefetch_related=None):
+        """Fetch instances of all `messages' with one query per model.
+
+        `select_related' and `prefetch_related' are sequences of field
+        names passed to the queryset.  Messages whose instance doesn't
+        exist will raise ValueError from `get_body()', as usual.
+        """
+        from django.contrib.contenttypes.models import ContentType
+        by_type = {}
+        for m in messages:
+            if m.__reference is not None and not m.__loaded:
+                by_type.setdefault(m.__reference[0], []).append(m)
+
+        for content_type, mm in by_type.items():
+            try:
+                ct = ContentType.objects.get_by_natural_key(*content_type)
+                model_class = ct.model_class()
+            except ContentType.DoesNotExist:
+                model_class = None
+            if model_class is None:
+                for m in mm:
+                    m.__set_instance(None, "Invalid content type.")
+                continue
+
+            qs = model_class.objects.all()
+            if select_related:
+                qs = qs.select_related(*select_related)
+            if prefetch_related:
+                qs = qs.prefetch_related(*prefetch_related)
+            missing = "%s.%s %%r does not exist" % (
+                model_class.__module__, model_class.__name__)
+            pks = {}
+            for m in mm:
+                try:
+                    pks[m] = model_class._meta.pk.to_python(m.__reference[1])
+                except Exception:
+                    # not a valid primary key, so there is no such row
+                    m.__set_instance(None, missing % (m.__reference[1], ))
+            instances = qs.in_bulk(list(set(pks.values())))
+            for m, pk in pks.items():
+                m.__set_instance(instances.get(pk),
+                                 missing % (m.__reference[1], ))
+
+    def __set_instance(self, instance, reason):
+        self.__loaded = True
+        self.set_body(instance)
+        if instance is None:
+            self.__reason = reason
 
     def get_body(self):
+        if self.__reference is not None and not self.__loaded:
+            self.load_batch([self])
         rv = boto.sqs.message.RawMessage.get_body(self)
         if rv is not None:
             return rv
@@ -55,3 +126,54 @@ class ModelInstanceMessage(boto.sqs.message.RawMessage):
 
     def get_instance(self):
         return self.get_body()
+
+
+class CodecMessage(boto.sqs.message.RawMessage):
+    """SQS Message class encoding its body with a codec.
+
+    Subclasses choose `codec' and `compression' (names or instances)
+    and `compress_threshold'.  Any message written by `encode()' can
+    be decoded, whatever codec it was written with.  Bodies without
+    the header are passed to `decode_legacy()', which returns them
+    unchanged by default.
+
+    A body that can't be decoded doesn't break receiving of other
+    messages: `get_body()' raises ValueError with the reason instead.
+    """
+    codec = 'json'
+    compression = COMPRESSION
+    compress_threshold = COMPRESS_THRESHOLD
+
+    _decode_error = None
+
+    def encode(self, value):
+        return encode(value, self.codec, self.compression,
+                      self.compress_threshold)
+
+    def decode(self, value):
+        self._decode_error = None
+        try:
+            if is_encoded(value):
+                return decode(value)
+            return self.decode_legacy(value)
+        except Exception, e:
+            self._decode_error = "Error decoding payload: %s" % e
+            return None
+
+    def decode_legacy(self, value):
+        return value
+
+    def get_body(self):
+        if self._decode_error is not None:
+            raise ValueError(self._decode_error)
+        return boto.sqs.message.RawMessage.get_body(self)
+
+
+class JSONMessage(CodecMessage):
+    """Message with a JSON-serializable body."""
+    codec = 'json'
+
+
+class MsgpackMessage(CodecMessage):
+    """Message with a body serialized with msgpack."""
+    codec = 'msgpack'
@@ -0,0 +1,336 @@
+"""Instrumentation of sending and receiving messages.
+
+Metrics are reported to a collector chosen with SQS_METRICS_BACKEND:
+- None or 'null' (default): metrics are dropped, at the cost of a
+  function call;
+- 'memory': kept in process by InProcessCollector, see `summary()';
+- 'statsd': sent to statsd daemon at SQS_STATSD_HOST:SQS_STATSD_PORT,
+  prefixed with SQS_STATSD_PREFIX;
+- dotted path of a Collector subclass.
+
+Metric names start with full name of the queue, e.g.
+`myqueue.received'.  Times are in seconds.  Reported metrics are:
+- received, deleted, processed, failed, restarted, retried,
+  dead_lettered, gave_up (counters, messages)
+- receive_latency (time of a ReceiveMessage call)
+- batch_size (histogram, messages per non-empty receive)
+- run_time (time of a receiver call)
+- dwell_time (time since message was sent until it was received)
+- throttled (counter, waits for throttle) and throttle_wait (time
+  of a wait)
+- time_to_first_message (time since receiving process started, see
+  `process_started()', until it received its first message)
+- api.<Action> and api_errors.<Action> (counters, SQS requests)
+"""
+from importlib import import_module
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+METRICS_BACKEND = getattr(settings, 'SQS_METRICS_BACKEND', None)
+
+STATSD_HOST = getattr(settings, 'SQS_STATSD_HOST', 'localhost')
+STATSD_PORT = getattr(settings, 'SQS_STATSD_PORT', 8125)
+STATSD_PREFIX = getattr(settings, 'SQS_STATSD_PREFIX', 'django_sqs')
+
+
+class _NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+_log = logging.getLogger('django_sqs.metrics')
+_log.addHandler(_NullHandler())
+
+
+class Collector(object):
+    """Receives metrics; subclasses override what they need."""
+
+    # False if metrics are dropped, so that callers can skip
+    # computing them
+    enabled = True
+
+    def incr(self, name, count=1):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+    def histogram(self, name, value):
+        pass
+
+
+class NullCollector(Collector):
+    enabled = False
+
+
+class _Stat(object):
+    __slots__ = ('count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+
+class InProcessCollector(Collector):
+    """Aggregates metrics in memory.
+
+    Counters are summed; timings and histograms keep count, total,
+    minimum and maximum.  `summary()' returns them, optionally
+    starting a new period.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._counters = {}
+        self._stats = {}
+        self._since = time.time()
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + count
+
+    def timing(self, name, seconds):
+        self.histogram(name, seconds)
+
+    def histogram(self, name, value):
+        with self._lock:
+            stat = self._stats.get(name)
+            if stat is None:
+                stat = self._stats[name] = _Stat()
+            stat.add(value)
+
+    def summary(self, reset=False):
+        """Return dict with `period' length, `counters' and `stats'.
+
+        Stats are dicts with `count', `avg', `min' and `max' keys.
+        """
+        with self._lock:
+            rv = {
+                'period': time.time() - self._since,
+                'counters': dict(self._counters),
+                'stats': dict(
+                    (name, {'count': stat.count,
+                            'avg': float(stat.total) / stat.count,
+                            'min': stat.min,
+                            'max': stat.max})
+                    for name, stat in self._stats.items()),
+                }
+            if reset:
+                self._reset()
+        return rv
+
+
+class StatsdCollector(Collector):
+    """Sends metrics to statsd daemon over UDP.
+
+    Sending is fire-and-forget, so a missing daemon doesn't slow down
+    receivers.
+    """
+
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (host or STATSD_HOST, port or STATSD_PORT)
+        if prefix is None:
+            prefix = STATSD_PREFIX
+        self.prefix = prefix and prefix + '.' or ''
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, data):
+        try:
+            self._socket.sendto(data, self.address)
+        except socket.error:
+            pass
+
+    def incr(self, name, count=1):
+        self._send('%s%s:%d|c' % (self.prefix, name, count))
+
+    def timing(self, name, seconds):
+        self._send('%s%s:%d|ms' % (self.prefix, name, seconds * 1000))
+
+    def histogram(self, name, value):
+        self._send('%s%s:%s|h' % (self.prefix, name, value))
+
+
+class MultiCollector(Collector):
+    """Reports metrics to all of `collectors'."""
+
+    def __init__(self, collectors):
+        self.collectors = collectors
+
+    def incr(self, name, count=1):
+        for collector in self.collectors:
+            collector.incr(name, count)
+
+    def timing(self, name, seconds):
+        for collector in self.collectors:
+            collector.timing(name, seconds)
+
+    def histogram(self, name, value):
+        for collector in self.collectors:
+            collector.histogram(name, value)
+
+
+_backends = {
+    'null': NullCollector,
+    'memory': InProcessCollector,
+    'statsd': StatsdCollector,
+    }
+_collector = None
+
+
+def get_collector():
+    """Return the configured collector."""
+    global _collector
+    if _collector is None:
+        backend = METRICS_BACKEND or 'null'
+        cls = _backends.get(backend)
+        if cls is None:
+            module_name, _, class_name = backend.rpartition('.')
+            try:
+                cls = getattr(import_module(module_name), class_name)
+            except (ImportError, AttributeError, ValueError), e:
+                raise ImproperlyConfigured(
+                    "Cannot load metrics backend %s: %s" % (backend, e))
+        _collector = cls()
+    return _collector
+
+
+def set_collector(collector):
+    """Replace the collector used from now on."""
+    global _collector
+    _collector = collector
+
+
+def in_process_collector():
+    """Return an InProcessCollector receiving all metrics.
+
+    If configured collector is of another kind, metrics are reported
+    to both from now on.
+    """
+    collector = get_collector()
+    if isinstance(collector, InProcessCollector):
+        return collector
+    if isinstance(collector, MultiCollector):
+        for c in collector.collectors:
+            if isinstance(c, InProcessCollector):
+                return c
+    memory = InProcessCollector()
+    if collector.enabled:
+        set_collector(MultiCollector([collector, memory]))
+    else:
+        set_collector(memory)
+    return memory
+
+
+def enabled():
+    return get_collector().enabled
+
+
+def incr(name, count=1):
+    get_collector().incr(name, count)
+
+
+def timing(name, seconds):
+    get_collector().timing(name, seconds)
+
+
+def histogram(name, value):
+    get_collector().histogram(name, value)
+
+
+def queue_name(queue):
+    """Name of boto `queue' for use in metric names."""
+    return getattr(queue, 'name', None) or 'unknown'
+
+
+# (pid, start time) of the receiving process waiting for its first
+# message; forked children don't inherit it, since pid differs
+_started = None
+
+
+def process_started(when=None):
+    """Mark start of a receiving process (at `when', default is now).
+
+    Time from then until the process receives its first message is
+    reported as `time_to_first_message' and logged.
+    """
+    global _started
+    _started = (os.getpid(), when or time.time())
+
+
+def awaiting_first_message():
+    return _started is not None and _started[0] == os.getpid()
+
+
+def first_message(queue):
+    """Report first message received by this process from `queue'."""
+    global _started
+    if not awaiting_first_message():
+        return
+    elapsed = time.time() - _started[1]
+    _started = None
+    name = queue_name(queue)
+    get_collector().timing(name + '.time_to_first_message', elapsed)
+    _log.info("Process %d received first message from %s %.3f seconds"
+              " after start" % (os.getpid(), name, elapsed))
+    return elapsed
+
+
+def format_summary(summary):
+    """Return lines of text describing `summary' of InProcessCollector."""
+    period = summary['period'] or 1
+    lines = []
+    for name, count in sorted(summary['counters'].items()):
+        lines.append("%s: %d (%.2f/s)" % (name, count, count / period))
+    for name, stat in sorted(summary['stats'].items()):
+        lines.append("%s: n=%d avg=%.4g min=%.4g max=%.4g" % (
+            name, stat['count'], stat['avg'], stat['min'], stat['max']))
+    return lines
+
+
+class SummaryReporter(object):
+    """Calls `report' with lines of metrics summary every `interval'
+    seconds, from a background thread."""
+
+    def __init__(self, interval, report):
+        self.interval = interval
+        self.report = report
+        self.collector = in_process_collector()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='django_sqs-metrics')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                summary = self.collector.summary(reset=True)
+                self.report(["Metrics for last %d seconds:"
+                             % summary['period']]
+                            + format_summary(summary))
+            except Exception:
+                _log.exception("Cannot report metrics")
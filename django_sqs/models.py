@@ -0,0 +1,36 @@
+from django.db import models
+from django.utils import timezone
+
+
+class OutboxMessage(models.Model):
+    """Message waiting in the database outbox to be sent to SQS.
+
+    Rows are written by RegisteredQueue.send() with SQS_OUTBOX set to
+    'database', in the sender's transaction, and deleted by
+    `manage.py sqs_relay' after they have been sent.
+    """
+    queue_name = models.CharField(max_length=255)
+    suffix = models.CharField(max_length=255, blank=True)
+    # encoded body (or claim check of an offloaded one)
+    body = models.TextField()
+    # JSON of boto's message_attributes, if any
+    message_attributes = models.TextField(blank=True)
+    # MessageGroupId and MessageDeduplicationId of FIFO queue messages
+    group_id = models.CharField(max_length=128, blank=True)
+    deduplication_id = models.CharField(max_length=128, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # not sent before this time: it is being sent by a relay (that
+    # set `claim'), or waiting to be retried
+    next_attempt_at = models.DateTimeField(default=timezone.now,
+                                           db_index=True)
+    claim = models.CharField(max_length=32, blank=True)
+
+    class Meta:
+        ordering = ('id', )
+
+    def __unicode__(self):
+        if self.suffix:
+            return u'%s.%s #%s' % (self.queue_name, self.suffix, self.pk)
+        return u'%s #%s' % (self.queue_name, self.pk)
@@ -0,0 +1,144 @@
+"""Receiving from many queues in a single process."""
+import time
+
+from registered_queue import MIN_POLL_PERIOD, POLL_PERIOD, check_batch_size
+
+WEIGHTED = 'weighted'
+STRICT = 'strict'
+
+
+class _Entry(object):
+    def __init__(self, registered_queue, suffix=None, weight=1):
+        if weight <= 0:
+            raise ValueError("weight must be positive, not %r" % weight)
+        self.registered_queue = registered_queue
+        self.suffix = suffix
+        self.weight = weight
+        self.queue = None
+        self.acks = None
+        self.next_poll = 0
+        self.poll_period = min(MIN_POLL_PERIOD, POLL_PERIOD)
+        self.current_weight = 0
+
+    def __str__(self):
+        return self.registered_queue.full_name(self.suffix)
+
+    def idle(self, now):
+        """Queue was empty: poll it less often."""
+        self.next_poll = now + self.poll_period
+        self.poll_period = min(self.poll_period * 2, POLL_PERIOD)
+
+    def busy(self):
+        """Queue had messages: poll it again right away."""
+        self.next_poll = 0
+        self.poll_period = min(MIN_POLL_PERIOD, POLL_PERIOD)
+
+
+class Multiplexer(object):
+    """Receives messages from several queues in a single process.
+
+    `entries' is a list of (registered_queue, suffix, weight) triples.
+    Messages are processed one at a time by receivers of their queues.
+
+    A queue that turned out to be empty is not polled again for a
+    while, starting with SQS_MIN_POLL_PERIOD seconds and doubling up
+    to SQS_POLL_PERIOD; a queue that had messages is polled again
+    right away.  Among queues due to be polled, one is chosen by
+    `priority':
+    - WEIGHTED: smooth weighted round robin, so that busy queues are
+      polled in proportion to their weights;
+    - STRICT: queue with highest weight always goes first, so lower
+      priority queues are polled only when higher priority ones are
+      empty.
+
+    Long polling is not used, since it would block other queues; for
+    the same reason, a queue whose throttle doesn't allow fetching
+    messages is treated as empty.
+    Batch receivers get all messages of a single poll at once,
+    without waiting for more (`batch_wait' is ignored).
+    """
+
+    def __init__(self, entries, priority=WEIGHTED):
+        if priority not in (WEIGHTED, STRICT):
+            raise ValueError("Unknown priority mode %r" % priority)
+        self.priority = priority
+        self.entries = [_Entry(*entry) for entry in entries]
+        if priority == STRICT:
+            # sort is stable: equal weights keep their order
+            self.entries.sort(key=lambda entry: -entry.weight)
+        self._stopping = False
+
+    def stop(self):
+        """Make running `run()' return after current message."""
+        self._stopping = True
+
+    def run(self, message_limit=None, batch_size=None, counter=None):
+        """Receive messages until stopped.
+
+        `message_limit', `batch_size' and `counter' are like for
+        RegisteredQueue.receive_loop; `batch_size' overrides setting
+        of all the queues.  Returns number of messages received.
+        """
+        if batch_size:
+            check_batch_size(batch_size)
+        for entry in self.entries:
+            entry.queue = entry.registered_queue.get_queue(entry.suffix)
+            entry.acks = entry.registered_queue.get_ack_buffer(entry.suffix)
+        processed = 0
+        self._stopping = False
+        try:
+            while not self._stopping:
+                if message_limit and processed >= message_limit:
+                    return processed
+                now = time.time()
+                entry = self.choose(now)
+                if entry is None:
+                    next_poll = min(e.next_poll for e in self.entries)
+                    time.sleep(min(max(next_poll - now, 0), POLL_PERIOD))
+                    continue
+
+                rq = entry.registered_queue
+                n = batch_size or rq.batch_size
+                if message_limit:
+                    n = min(n, message_limit - processed)
+                received = time.time()
+                # a throttled queue is skipped, like an empty one
+                mm = rq.get_messages(entry.queue, n, block=False)
+                if not mm:
+                    entry.idle(time.time())
+                    continue
+                entry.busy()
+                rq.load_messages(mm)
+                if rq.batch:
+                    rq._process_batch(entry.queue, mm, entry.acks, received)
+                else:
+                    for m in mm:
+                        rq._process_message(
+                            entry.queue, m, entry.acks, received)
+                processed += len(mm)
+                if counter is not None:
+                    with counter.get_lock():
+                        counter.value += len(mm)
+        finally:
+            for entry in self.entries:
+                if entry.acks is not None:
+                    entry.acks.close()
+                    entry.acks = None
+        return processed
+
+    def choose(self, now):
+        """Return entry to poll next, or None if none is due."""
+        due = [entry for entry in self.entries if entry.next_poll <= now]
+        if not due:
+            return None
+        if self.priority == STRICT:
+            return due[0]
+        total = 0
+        best = None
+        for entry in due:
+            entry.current_weight += entry.weight
+            total += entry.weight
+            if best is None or entry.current_weight > best.current_weight:
+                best = entry
+        best.current_weight -= total
+        return best
@@ -0,0 +1,380 @@
+"""Outboxes publishing messages only after the sender's transaction
+commits.
+
+Without an outbox, RegisteredQueue.send() writes to SQS right away:
+the request waits for SQS, and a receiver may get the message before
+the transaction that sent it commits, or even after it is rolled
+back.  SQS_OUTBOX setting (or `outbox' argument of a registered
+queue) chooses an outbox instead:
+
+- 'commit': messages sent in a transaction started with `atomic()'
+  of this module are kept in memory and published in batches when it
+  commits; those sent in a transaction (or nested block) that is
+  rolled back are dropped.  With Django's `transaction.on_commit()'
+  (Django 1.9 or newer), this works for any transaction.  Otherwise,
+  messages are sent right away.  Messages are lost if the process
+  dies, or SQS fails, right after commit.
+
+- 'database': messages are written to OutboxMessage table in the
+  sender's transaction, and published by `manage.py sqs_relay',
+  which deletes them after they have been sent.  Nothing is lost,
+  but a message may be sent twice if relay dies in between.  Failed
+  messages are retried with exponential backoff.
+
+Outbox writes go to SQS_OUTBOX_DATABASE database (default is
+'default'), which should be the one sender's transactions use.
+"""
+import datetime
+from functools import wraps
+import logging
+import threading
+import uuid
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import django.utils.simplejson as json
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils import timezone
+
+from blobs import check_out
+from connection import call_in_parallel
+
+# Outbox used by registered queues: None (send right away), 'commit'
+# or 'database'
+OUTBOX = getattr(settings, 'SQS_OUTBOX', None)
+
+OUTBOX_DATABASE = getattr(settings, 'SQS_OUTBOX_DATABASE', DEFAULT_DB_ALIAS)
+
+# Relay retries a message that failed after this many seconds,
+# doubled on each failed attempt up to SQS_OUTBOX_MAX_RETRY_DELAY
+OUTBOX_RETRY_DELAY = getattr(settings, 'SQS_OUTBOX_RETRY_DELAY', 1)
+OUTBOX_MAX_RETRY_DELAY = getattr(settings, 'SQS_OUTBOX_MAX_RETRY_DELAY',
+                                 15 * 60)
+
+# Messages claimed by a relay are not sent by other relays for this
+# many seconds, after which it is assumed to have died
+OUTBOX_CLAIM_TIMEOUT = getattr(settings, 'SQS_OUTBOX_CLAIM_TIMEOUT', 300)
+
+
+class _NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+_log = logging.getLogger('django_sqs.outbox')
+_log.addHandler(_NullHandler())
+
+
+def _group(entries):
+    """Group (key, item) pairs by key, keeping order of first keys."""
+    groups = []
+    by_key = {}
+    for key, item in entries:
+        if key not in by_key:
+            by_key[key] = []
+            groups.append((key, by_key[key]))
+        by_key[key].append(item)
+    return groups
+
+
+class _Batch(object):
+    """Messages to publish when a transaction (or savepoint) commits."""
+
+    def __init__(self, outbox, key):
+        self.outbox = outbox
+        self.key = key
+        self.entries = []
+
+    def publish(self):
+        self.outbox._forget(self)
+        for (rq, suffix), messages in _group(self.entries):
+            try:
+                rq.publish_batch(messages, suffix)
+            except Exception:
+                _log.exception("Cannot send %d messages to %s" % (
+                    len(messages), rq.full_name(suffix)))
+
+
+def _transaction_block(using):
+    if hasattr(transaction, 'atomic'):
+        return transaction.atomic(using=using)
+    return transaction.commit_on_success(using=using)  # Django < 1.6
+
+
+class atomic(object):
+    """Transaction block whose messages are sent after it commits.
+
+    Works like Django's `transaction.atomic' (`commit_on_success'
+    before Django 1.6), as a context manager or a decorator.  Messages
+    sent inside it to queues using the 'commit' outbox are published
+    when the block's changes are committed, and dropped if it fails.
+    It should wrap the outermost transaction: if the block is nested
+    in another transaction, messages are published at its end, unless
+    `transaction.on_commit()' is available to wait for the commit.
+    """
+
+    def __init__(self, using=None):
+        self.using = using or OUTBOX_DATABASE
+        self._block = None
+
+    def __call__(self, fn):
+        @wraps(fn)
+        def _atomic(*args, **kwargs):
+            # a new instance for each call, as decorated function may
+            # run in many threads at once
+            with atomic(self.using):
+                return fn(*args, **kwargs)
+        return _atomic
+
+    def __enter__(self):
+        self._block = _transaction_block(self.using)
+        self._block.__enter__()
+        get_outbox('commit')._enter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        committed = False
+        try:
+            rv = self._block.__exit__(exc_type, exc_value, traceback)
+            committed = exc_type is None
+        finally:
+            self._block = None
+            get_outbox('commit')._exit(committed)
+        return rv
+
+
+class CommitOutbox(object):
+    """Publishes messages after the transaction they were sent in commits.
+
+    Messages sent in an `atomic()' block are buffered until it ends.
+    Other messages sent in a transaction are handed to
+    `transaction.on_commit()', if it is available (Django 1.9+), and
+    sent right away otherwise.  Messages sent in a nested block or
+    savepoint are kept in a separate batch, so that they are dropped
+    if it is rolled back.
+    """
+
+    def __init__(self, using=None):
+        self.using = using or OUTBOX_DATABASE
+        self._local = threading.local()
+
+    def _blocks(self):
+        """Stack of entry lists of this thread's `atomic()' blocks."""
+        try:
+            return self._local.blocks
+        except AttributeError:
+            self._local.blocks = []
+            return self._local.blocks
+
+    def _enter(self):
+        self._blocks().append([])
+
+    def _exit(self, committed):
+        blocks = self._blocks()
+        entries = blocks.pop()
+        if not hasattr(transaction, 'atomic'):
+            # before Django 1.6, leaving a nested commit_on_success()
+            # commits (or rolls back) the enclosing blocks, too
+            for outer in reversed(blocks):
+                entries[:0] = outer
+                del outer[:]
+        if not committed:
+            return
+        if blocks and hasattr(transaction, 'atomic'):
+            blocks[-1].extend(entries)
+            return
+        if not entries:
+            return
+        batch = _Batch(self, None)
+        batch.entries = entries
+        connection = connections[self.using]
+        if (hasattr(transaction, 'on_commit')
+            and connection.in_atomic_block):
+            transaction.on_commit(batch.publish, using=self.using)
+        else:
+            batch.publish()
+
+    def _batches(self):
+        try:
+            return self._local.batches
+        except AttributeError:
+            self._local.batches = {}
+            return self._local.batches
+
+    def _forget(self, batch):
+        batches = self._batches()
+        if batches.get(batch.key) is batch:
+            del batches[batch.key]
+
+    def _is_pending(self, connection, batch):
+        # callbacks of rolled back transactions and savepoints are
+        # removed from the connection; a batch whose callback is gone
+        # must not be used any more
+        return any(entry[1] == batch.publish
+                   for entry in connection.run_on_commit)
+
+    def add(self, rq, suffix, messages):
+        blocks = self._blocks()
+        if blocks:
+            blocks[-1].extend(((rq, suffix), m) for m in messages)
+            return
+        connection = connections[self.using]
+        if not (hasattr(transaction, 'on_commit')
+                and connection.in_atomic_block):
+            rq.publish_batch(messages, suffix)
+            return
+        key = tuple(connection.savepoint_ids)
+        batches = self._batches()
+        batch = batches.get(key)
+        if batch is None or not self._is_pending(connection, batch):
+            batch = batches[key] = _Batch(self, key)
+            transaction.on_commit(batch.publish, using=self.using)
+        batch.entries.extend(((rq, suffix), m) for m in messages)
+
+
+class DatabaseOutbox(object):
+    """Writes messages to OutboxMessage table, to be sent by `relay()'."""
+
+    def __init__(self, using=None):
+        self.using = using or OUTBOX_DATABASE
+
+    def add(self, rq, suffix, messages):
+        from models import OutboxMessage
+        rows = []
+        for m in messages:
+            if m.message_attributes:
+                attributes = json.dumps(m.message_attributes)
+            else:
+                attributes = ''
+            rows.append(OutboxMessage(
+                queue_name=rq.name, suffix=suffix or '',
+                body=check_out(m.get_body_encoded()),
+                message_attributes=attributes,
+                group_id=getattr(m, 'group_id', None) or '',
+                deduplication_id=getattr(m, 'deduplication_id', None) or ''))
+        OutboxMessage.objects.using(self.using).bulk_create(rows)
+
+
+_outboxes = {
+    'commit': CommitOutbox,
+    'database': DatabaseOutbox,
+    }
+_instances = {}
+
+
+def get_outbox(name):
+    """Return outbox instance by name ('commit' or 'database')."""
+    if name not in _instances:
+        try:
+            cls = _outboxes[name]
+        except KeyError:
+            raise ImproperlyConfigured("Unknown outbox %r" % name)
+        _instances[name] = cls()
+    return _instances[name]
+
+
+def _relay_chunk(rq, suffix, rows):
+    import boto.sqs.message
+    messages = []
+    for row in rows:
+        m = boto.sqs.message.RawMessage(body=row.body)
+        if row.message_attributes:
+            m.message_attributes.update(json.loads(row.message_attributes))
+        if row.group_id:
+            m.group_id = row.group_id
+            m.deduplication_id = row.deduplication_id or None
+        messages.append(m)
+    return rq.publish_batch(messages, suffix)
+
+
+def retry_delay(attempts):
+    """Seconds to wait before attempt number `attempts' + 1."""
+    return min(OUTBOX_RETRY_DELAY * 2 ** max(attempts - 1, 0),
+               OUTBOX_MAX_RETRY_DELAY)
+
+
+def claim(limit=100, using=None):
+    """Claim up to `limit' oldest messages that are due to be sent.
+
+    Claimed messages are not returned by other calls (also in other
+    processes) for SQS_OUTBOX_CLAIM_TIMEOUT seconds.  Returns a list
+    of OutboxMessage rows, and the claim token.
+    """
+    from models import OutboxMessage
+    messages = OutboxMessage.objects.using(using or OUTBOX_DATABASE)
+    now = timezone.now()
+    ids = list(messages.filter(next_attempt_at__lte=now)
+               .order_by('id').values_list('id', flat=True)[:limit])
+    if not ids:
+        return [], None
+    token = uuid.uuid4().hex
+    # rows claimed by another relay since they were selected have
+    # next_attempt_at in the future, and are not updated
+    messages.filter(pk__in=ids, next_attempt_at__lte=now).update(
+        claim=token,
+        next_attempt_at=now + datetime.timedelta(
+            seconds=OUTBOX_CLAIM_TIMEOUT))
+    return list(messages.filter(claim=token).order_by('id')), token
+
+
+def relay(limit=100, using=None, log=None):
+    """Send up to `limit' oldest messages from the database outbox.
+
+    Messages are claimed (see `claim()'), so that relays running at
+    the same time don't send them twice, and sent with
+    SendMessageBatch requests, in parallel; sent ones are deleted
+    from the table.  Failed ones are retried by later calls after
+    `retry_delay()' seconds.  Queues must be registered in the calling
+    process.
+
+    Returns (fetched, sent) numbers of messages; if `fetched' is
+    `limit', there may be more to send.
+    """
+    import django_sqs
+    from models import OutboxMessage
+    using = using or OUTBOX_DATABASE
+    log = log or _log
+    rows, token = claim(limit, using)
+    chunks = []
+    failed = []
+    for (queue_name, suffix), group in _group(
+            ((row.queue_name, row.suffix or None), row) for row in rows):
+        rq = django_sqs.queues.get(queue_name)
+        if rq is None:
+            failed.extend((row, "Queue %s is not registered" % queue_name)
+                          for row in group)
+            continue
+        for i in range(0, len(group), 10):
+            chunks.append((rq, suffix, group[i:i+10]))
+
+    sent = []
+    results = call_in_parallel(
+        (lambda chunk=chunk: _relay_chunk(*chunk)) for chunk in chunks)
+    for (rq, suffix, chunk), (rv, e) in zip(chunks, results):
+        if e is not None:
+            failed.extend((row, str(e)) for row in chunk)
+            continue
+        for row, (m, error) in zip(chunk, rv):
+            if error is None:
+                sent.append(row.pk)
+            else:
+                failed.append((row, error))
+
+    messages = OutboxMessage.objects.using(using).filter(claim=token)
+    if sent:
+        messages.filter(pk__in=sent).delete()
+    now = timezone.now()
+    for row, error in failed:
+        attempts = row.attempts + 1
+        delay = retry_delay(attempts)
+        log.error("Cannot relay message %s (attempt %d), retrying in %d"
+                  " seconds: %s" % (row, attempts, delay, error))
+        messages.filter(pk=row.pk).update(
+            attempts=attempts, last_error=error, claim='',
+            next_attempt_at=now + datetime.timedelta(seconds=delay))
+    return len(rows), len(sent)
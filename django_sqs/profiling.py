@@ -0,0 +1,366 @@
+"""Profiling where receiving processes spend their time.
+
+`Profiler.install()' wraps methods of registered queues, and of the
+queue objects they use, to measure per queue:
+- time spent in SQS calls, per action,
+- time loading message bodies (`load_messages()', e.g. instances of
+  ModelInstanceMessage) and running receivers, with number of
+  database queries per message; the query repeated most times while
+  handling a single message shows N+1 query patterns,
+- where the time goes inside of it: with 'cprofile' mode, cProfile
+  stats written as `QUEUE.PID.pstats' files (see `pstats' module);
+  with 'sample' mode, stacks sampled every `interval' seconds written
+  as `QUEUE.PID.folded' files, ready for flamegraph.pl.
+
+Database queries are counted with Django's debug cursor, which is
+turned on for connections used while profiling, and turned back off
+by `Profiler.uninstall()'.  Receivers running in gevent greenlets
+can't be profiled.
+"""
+import cProfile
+from collections import defaultdict
+import os
+import re
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections, reset_queries
+
+MODES = ('cprofile', 'sample')
+
+# Seconds between stack samples in 'sample' mode
+SAMPLE_INTERVAL = 0.005
+
+# SQS calls of queue objects that are measured
+QUEUE_METHODS = (
+    'get_messages', 'delete_message', 'delete_message_batch',
+    'change_message_visibility_batch', 'write', 'write_batch',
+    'get_attributes',
+    )
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def normalize_sql(sql):
+    """Return `sql' with literal values replaced with `?'."""
+    return _literals.sub('?', sql)
+
+
+def _queries():
+    rv = []
+    for c in connections.all():
+        rv.extend(q['sql'] for q in c.queries)
+    return rv
+
+
+_missing = object()
+
+# debug cursor flags: `use_debug_cursor' before Django 1.8,
+# `force_debug_cursor' since then
+_DEBUG_CURSOR_FLAGS = ('use_debug_cursor', 'force_debug_cursor')
+
+
+class _Snapshot(object):
+    """cProfile stats of a profiler that may be still running."""
+
+    def __init__(self, profile):
+        profile.snapshot_stats()
+        self.stats = profile.stats
+
+    def create_stats(self):
+        pass
+
+
+class _Timing(object):
+    __slots__ = ('calls', 'time')
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+
+
+class QueueProfile(object):
+    """Measurements of a single queue."""
+
+    def __init__(self, name):
+        self.name = name
+        self.messages = 0
+        self.phases = defaultdict(_Timing)      # phase -> _Timing
+        self.sqs = defaultdict(_Timing)         # action -> _Timing
+        self.queries = defaultdict(int)         # phase -> count
+        self.max_queries = defaultdict(int)     # phase -> per message
+        self.repeated = (0, None)               # (count, normalized SQL)
+        self.profiles = []                      # cProfile.Profile per thread
+        self.samples = defaultdict(int)         # folded stack -> count
+
+    def summary(self):
+        """Return lines of text describing the measurements."""
+        lines = ["Queue %s: %d messages" % (self.name, self.messages)]
+        per_message = max(self.messages, 1)
+        fetch = self.phases.get('fetch')
+        if fetch is not None:
+            lines.append("  fetch    %8.3fs (%d calls, including throttle"
+                         " waits)" % (fetch.time, fetch.calls))
+        for phase in ('load', 'receiver'):
+            timing = self.phases.get(phase)
+            if timing is None:
+                continue
+            lines.append(
+                "  %-8s %8.3fs (%.2f ms/message), %.1f DB queries/message"
+                " (max %d)" % (
+                    phase, timing.time, timing.time * 1000 / per_message,
+                    float(self.queries[phase]) / per_message,
+                    self.max_queries[phase]))
+        for action, timing in sorted(self.sqs.items()):
+            lines.append("  SQS %s: %d calls, %.3fs (%.2f ms/call)" % (
+                action, timing.calls, timing.time,
+                timing.time * 1000 / max(timing.calls, 1)))
+        count, sql = self.repeated
+        if count > 1:
+            lines.append("  Query run %d times for a message: %s"
+                         % (count, sql))
+        return lines
+
+
+class _ProfiledQueue(object):
+    """Proxy of a queue object measuring its SQS calls."""
+
+    def __init__(self, profiler, stats, queue):
+        self._profiler = profiler
+        self._stats = stats
+        self._queue = queue
+
+    def __getattr__(self, name):
+        value = getattr(self._queue, name)
+        if name in QUEUE_METHODS:
+            return self._profiler._measured(
+                self._stats, value, sqs=name)
+        return value
+
+
+class Profiler(object):
+    """Profiles registered queues receiving in this process.
+
+    `write()' writes results to `directory' (default is current one)
+    and calls `report' with lines of their summary.  With `messages',
+    profiling stops after that many messages, and results are written.
+    """
+
+    def __init__(self, mode='cprofile', directory=None, messages=None,
+                 interval=None, report=None):
+        if mode not in MODES:
+            raise ValueError("Unknown profiling mode %r" % mode)
+        self.mode = mode
+        self.directory = directory or '.'
+        self.messages = messages
+        self.interval = interval or SAMPLE_INTERVAL
+        self.report = report
+        self.queues = {}                # queue name -> QueueProfile
+        self._installed = []
+        self._cursors = {}              # id -> (connection, saved flags)
+        self._proxies = {}
+        self._local = threading.local()
+        self._current = {}              # thread id -> QueueProfile
+        # write() may be called from a signal handler
+        self._lock = threading.RLock()
+        self._count = 0
+        self._sampler = None
+        self.running = False
+
+    def install(self, registered_queues):
+        """Start profiling `registered_queues'."""
+        for rq in registered_queues:
+            stats = self.queues.setdefault(rq.name, QueueProfile(rq.name))
+            self._wrap(rq, 'get_messages', stats, 'fetch')
+            self._wrap(rq, 'load_messages', stats, 'load', queries=True)
+            self._wrap(rq, 'receive', stats, 'receiver', queries=True)
+            get_queue = rq.get_queue
+            rq.get_queue = lambda suffix=None, stats=stats, \
+                get_queue=get_queue: self._proxy(stats, get_queue(suffix))
+            self._installed.append((rq, 'get_queue'))
+        self.running = True
+        if self.mode == 'sample':
+            self._sampler = threading.Thread(target=self._sample,
+                                             name='django_sqs-profiler')
+            self._sampler.daemon = True
+            self._sampler.start()
+
+    def uninstall(self):
+        """Stop profiling, restoring the original methods and the
+        debug cursor setting of database connections."""
+        self.running = False
+        for rq, name in self._installed:
+            rq.__dict__.pop(name, None)
+        self._installed = []
+        with self._lock:
+            for connection, flags in self._cursors.values():
+                self._restore_cursor(connection, flags)
+            self._cursors = {}
+
+    def _debug_cursors(self):
+        if not self.running:
+            return
+        for connection in connections.all():
+            with self._lock:
+                if id(connection) not in self._cursors:
+                    self._cursors[id(connection)] = (connection, [
+                        getattr(connection, name, _missing)
+                        for name in _DEBUG_CURSOR_FLAGS])
+            for name in _DEBUG_CURSOR_FLAGS:
+                setattr(connection, name, True)
+
+    def _restore_cursor(self, connection, flags):
+        for name, value in zip(_DEBUG_CURSOR_FLAGS, flags):
+            if value is _missing:
+                connection.__dict__.pop(name, None)
+            else:
+                setattr(connection, name, value)
+        if not (settings.DEBUG or True in flags):
+            # drop queries logged while profiling; before Django 1.8,
+            # nothing else would
+            if hasattr(connection, 'queries_log'):
+                connection.queries_log.clear()
+            else:
+                connection.queries = []
+
+    def _wrap(self, rq, name, stats, phase, queries=False):
+        setattr(rq, name, self._measured(
+            stats, getattr(rq, name), phase=phase, queries=queries,
+            batch=rq.batch))
+        self._installed.append((rq, name))
+
+    def _proxy(self, stats, q):
+        key = id(q)
+        proxy = self._proxies.get(key)
+        if proxy is None or proxy._queue is not q:
+            proxy = self._proxies[key] = _ProfiledQueue(self, stats, q)
+        return proxy
+
+    def _messages(self, phase, batch, args):
+        if phase == 'load':
+            return len(args[0])
+        if phase == 'receiver':
+            return len(args[0]) if batch else 1
+        return 0
+
+    def _measured(self, stats, fn, phase=None, sqs=None, queries=False,
+                  batch=False):
+        def _wrapper(*args, **kwargs):
+            if not self.running:
+                return fn(*args, **kwargs)
+            local = self._local
+            outer = not getattr(local, 'active', False)
+            profile = None
+            if outer:
+                local.active = True
+                if self.mode == 'cprofile':
+                    profile = self._thread_profile(stats)
+                    profile.enable()
+                else:
+                    self._current[threading.current_thread().ident] = stats
+            if queries:
+                self._debug_cursors()
+                reset_queries()
+            start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                if outer:
+                    if profile is not None:
+                        profile.disable()
+                    else:
+                        self._current.pop(threading.current_thread().ident,
+                                          None)
+                    local.active = False
+                self._record(stats, phase, sqs, elapsed, queries,
+                             self._messages(phase, batch, args))
+        return _wrapper
+
+    def _thread_profile(self, stats):
+        profiles = getattr(self._local, 'profiles', None)
+        if profiles is None:
+            profiles = self._local.profiles = {}
+        profile = profiles.get(stats.name)
+        if profile is None:
+            profile = profiles[stats.name] = cProfile.Profile()
+            with self._lock:
+                stats.profiles.append(profile)
+        return profile
+
+    def _record(self, stats, phase, sqs, elapsed, queries, messages):
+        if queries:
+            sql = [normalize_sql(s) for s in _queries()]
+        done = False
+        with self._lock:
+            timing = stats.sqs[sqs] if sqs else stats.phases[phase]
+            timing.calls += 1
+            timing.time += elapsed
+            if queries:
+                stats.queries[phase] += len(sql)
+                stats.max_queries[phase] = max(
+                    stats.max_queries[phase],
+                    len(sql) / max(messages, 1))
+                counts = defaultdict(int)
+                for s in sql:
+                    counts[s] += 1
+                if counts:
+                    most = max((n, s) for s, n in counts.items())
+                    most = (most[0] / max(messages, 1), most[1])
+                    if most[0] > stats.repeated[0]:
+                        stats.repeated = most
+            if phase == 'receiver':
+                stats.messages += messages
+                self._count += messages
+                done = self.messages and self._count >= self.messages
+        if done and self.running:
+            self.uninstall()
+            self.write()
+
+    def _sample(self):
+        while self.running:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for ident, stats in self._current.items():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                if stack:
+                    with self._lock:
+                        stats.samples[';'.join(reversed(stack))] += 1
+
+    def write(self):
+        """Write results to files in `directory' and report their summary.
+
+        Returns lines of the summary.
+        """
+        pid = os.getpid()
+        lines = []
+        with self._lock:
+            queues = sorted(self.queues.values(), key=lambda s: s.name)
+            for stats in queues:
+                lines.extend(stats.summary())
+                base = os.path.join(self.directory,
+                                    '%s.%d' % (stats.name, pid))
+                if stats.profiles:
+                    import pstats
+                    result = pstats.Stats(_Snapshot(stats.profiles[0]))
+                    for profile in stats.profiles[1:]:
+                        result.add(_Snapshot(profile))
+                    result.dump_stats(base + '.pstats')
+                    lines.append("  Written %s.pstats" % base)
+                if stats.samples:
+                    with open(base + '.folded', 'w') as f:
+                        for stack, count in sorted(stats.samples.items()):
+                            f.write('%s %d\n' % (stack, count))
+                    lines.append("  Written %s.folded" % base)
+        if self.report is not None:
+            self.report(lines)
+        return lines
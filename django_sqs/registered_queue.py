@@ -1,46 +1,145 @@
 import logging
-import signal
+import os
 import time
+import uuid
 from warnings import warn
 
-import boto.sqs.message
-
 from django.conf import settings
 
-try:
-    from django.db import connections
-    CONNECTIONS = connections.all()
-except ImportError:
-    from django.db import connection
-    CONNECTIONS = (connection, )
+from app_settings import QUEUE_PREFIX
+import connection
+import idempotency
+import metrics
+from blobs import (
+    check_out, claim_check_class, discard_blobs, get_store, is_claim_check)
+from codec import decode
+from acks import AckBuffer, MAX_BATCH_SIZE, delete_messages
+from outbox import OUTBOX, get_outbox
+from throttle import Throttle
+from transports import FIFO_SUFFIX
+from heartbeat import Heartbeat
+from workers import WorkerPool, close_connections, make_timeout
 
 class _NullHandler(logging.Handler):
     def emit(self, record):
         pass
 
-if settings.DEBUG:
-    boto_debug = 1
-else:
-    boto_debug=0
-
 DEFAULT_VISIBILITY_TIMEOUT = getattr(
     settings, 'SQS_DEFAULT_VISIBILITY_TIMEOUT', 60)
 
 POLL_PERIOD = getattr(
     settings, 'SQS_POLL_PERIOD', 10)
 
+# Shortest sleep between polls of an empty queue when long polling is
+# disabled; it is doubled on every empty poll up to POLL_PERIOD.
+MIN_POLL_PERIOD = getattr(
+    settings, 'SQS_MIN_POLL_PERIOD', 1)
+
+# Long polling is disabled by default
+WAIT_TIME_SECONDS = getattr(
+    settings, 'SQS_WAIT_TIME_SECONDS', 0)
+
+# SQS won't wait longer than twenty seconds for messages to arrive
+MAX_WAIT_TIME_SECONDS = 20
+
+RECEIVE_BATCH_SIZE = getattr(
+    settings, 'SQS_RECEIVE_BATCH_SIZE', 1)
+
+# Messages are deleted right after processing by default
+DELETE_BATCH_SIZE = getattr(
+    settings, 'SQS_DELETE_BATCH_SIZE', 1)
+
+DELETE_MAX_AGE = getattr(
+    settings, 'SQS_DELETE_MAX_AGE', 1)
+
+# Number of times entries of a batch send that failed on SQS side are
+# retried
+SEND_BATCH_RETRIES = getattr(
+    settings, 'SQS_SEND_BATCH_RETRIES', 3)
+
+# Visibility of messages is extended by heartbeat for at most this
+# many seconds; SQS won't keep a message invisible for more than 12
+# hours since it was received anyway
+MAX_LIFETIME = getattr(
+    settings, 'SQS_MAX_LIFETIME', 12 * 60 * 60)
+
+# SQS won't keep a message invisible for longer than 12 hours
+MAX_VISIBILITY_TIMEOUT = 12 * 60 * 60
+
+# SQS won't accept messages, nor batches of messages, bigger than 256KB
+MAX_PAYLOAD_SIZE = 256 * 1024
+
+# Longest sleep of a throttled receive loop before it checks whether
+# it has been stopped
+MAX_THROTTLE_SLEEP = 1
+
 
 class TimedOut(Exception):
     """Raised by timeout handler."""
     pass
 
-def sigalrm_handler(signum, frame):
-    raise TimedOut()
+
+def check_batch_size(batch_size):
+    """Return `batch_size' if it's within SQS limits, raise ValueError otherwise."""
+    if not 1 <= batch_size <= MAX_BATCH_SIZE:
+        raise ValueError("batch size must be between 1 and %d, not %r"
+                         % (MAX_BATCH_SIZE, batch_size))
+    return batch_size
+
+
+def check_wait_time_seconds(wait_time_seconds):
+    """Return `wait_time_seconds' if it's within SQS limits, raise ValueError otherwise."""
+    if not 0 <= wait_time_seconds <= MAX_WAIT_TIME_SECONDS:
+        raise ValueError("wait time must be between 0 and %d seconds, not %r"
+                         % (MAX_WAIT_TIME_SECONDS, wait_time_seconds))
+    return wait_time_seconds
+
+
+def _payload_size(body):
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    return len(body)
+
+
+def _split_batches(indices, sizes):
+    """Split `indices' into SendMessageBatch-sized lists.
+
+    Every batch has at most MAX_BATCH_SIZE entries whose total
+    `sizes' don't exceed MAX_PAYLOAD_SIZE.
+    """
+    batch, batch_size = [], 0
+    for i in indices:
+        if batch and (len(batch) == MAX_BATCH_SIZE
+                      or batch_size + sizes[i] > MAX_PAYLOAD_SIZE):
+            yield batch
+            batch, batch_size = [], 0
+        batch.append(i)
+        batch_size += sizes[i]
+    if batch:
+        yield batch
 
 
 class RestartLater(Exception):
-    """Raised by receivers to stop processing and leave message in queue."""
-    pass
+    """Raised by receivers to stop processing and leave message in queue.
+
+    A batch receiver can pass a list of `messages' keyword argument to
+    leave only these messages in queue; rest of the batch is deleted.
+    By default, all messages of the batch are left in queue.
+    """
+    def __init__(self, *args, **kwargs):
+        self.messages = kwargs.pop('messages', None)
+        Exception.__init__(self, *args, **kwargs)
+
+
+class _RawBodyMixin(object):
+    """Keeps body of a received message as it was sent to the queue."""
+    raw_body = None
+
+    def decode(self, value):
+        self.raw_body = value
+        return super(_RawBodyMixin, self).decode(value)
+
+_raw_body_classes = {}
 
 
 class UnknownSuffixWarning(RuntimeWarning):
@@ -64,34 +163,118 @@ class RegisteredQueue(object):
         def __call__(self, message=None, **kwargs):
             self.registered_queue.send(message, **kwargs)
 
+        def many(self, messages, suffix=None):
+            """Send many messages at once, see RegisteredQueue.send_batch."""
+            return self.registered_queue.send_batch(messages, suffix)
+
     def __init__(self, name,
                  receiver=None, visibility_timeout=None, message_class=None,
                  timeout=None, delete_on_start=False, close_database=False,
-                 suffixes=()):
-        self._connection = None
+                 suffixes=(), batch_size=None, wait_time_seconds=None,
+                 delete_batch_size=None, delete_max_age=None, concurrency=1,
+                 select_related=None, prefetch_related=None,
+                 batch=False, max_batch=None, batch_wait=0,
+                 heartbeat=False, max_lifetime=None,
+                 retry_delay=None, max_retry_delay=None, max_attempts=None,
+                 dead_letter=None, outbox=None, idempotent=False,
+                 fifo=False, rate_limit=None, rate_burst=None,
+                 max_in_flight=None):
+        self._pid = os.getpid()
         self.name = name
         self.receiver = receiver
         self.visibility_timeout = visibility_timeout or DEFAULT_VISIBILITY_TIMEOUT
-        self.message_class = message_class or boto.sqs.message.Message
+        self._message_class = message_class
         self.queues = {}
         self.timeout = timeout
         self.delete_on_start = delete_on_start
         self.close_database = close_database
         self.suffixes = suffixes
+        self.batch = batch
+        self.max_batch = max_batch or MAX_BATCH_SIZE
+        self.batch_wait = batch_wait
+        if batch and not batch_size:
+            batch_size = min(self.max_batch, MAX_BATCH_SIZE)
+        self.batch_size = check_batch_size(batch_size or RECEIVE_BATCH_SIZE)
+        if wait_time_seconds is None:
+            wait_time_seconds = WAIT_TIME_SECONDS
+        self.wait_time_seconds = check_wait_time_seconds(wait_time_seconds)
+        self.delete_batch_size = check_batch_size(
+            delete_batch_size or DELETE_BATCH_SIZE)
+        if delete_max_age is None:
+            delete_max_age = DELETE_MAX_AGE
+        self.delete_max_age = delete_max_age
+        self.concurrency = concurrency
+        self.select_related = select_related
+        self.prefetch_related = prefetch_related
+        self.heartbeat = heartbeat
+        self.max_lifetime = max_lifetime or MAX_LIFETIME
+        self._heartbeat = None
+        self.retry_delay = retry_delay
+        self.max_retry_delay = min(max_retry_delay or MAX_VISIBILITY_TIMEOUT,
+                                   MAX_VISIBILITY_TIMEOUT)
+        self.max_attempts = max_attempts
+        self.dead_letter = dead_letter
+        if dead_letter and dead_letter not in self.suffixes:
+            self.suffixes = tuple(self.suffixes) + (dead_letter, )
+        if outbox is None:
+            outbox = OUTBOX
+        self.outbox = outbox
+        if idempotent is True:
+            idempotent = idempotency.get_default_store()
+        self.idempotency = idempotent or None
+        self.fifo = fifo
+        self._stopping = False
+
+        if dead_letter and not max_attempts:
+            raise ValueError("dead_letter is meaningful only with max_attempts")
+
+        if self.max_batch < 1:
+            raise ValueError("max_batch must be positive, not %r"
+                             % self.max_batch)
+        if self.batch_wait >= self.visibility_timeout:
+            raise ValueError("batch_wait must be shorter than visibility"
+                             " timeout (%r seconds)" % self.visibility_timeout)
 
         if self.timeout and not self.receiver:
             raise ValueError("timeout is meaningful only with receiver")
 
-        if not issubclass(self.message_class, boto.sqs.message.RawMessage):
-            raise ValueError(
-                "%s is not a subclass of boto.sqs.message.RawMessage"
-                % self.message_class)
+        if message_class is not None:
+            import boto.sqs.message
+            if not issubclass(message_class, boto.sqs.message.RawMessage):
+                raise ValueError(
+                    "%s is not a subclass of boto.sqs.message.RawMessage"
+                    % message_class)
 
-        self.prefix = getattr(settings, 'SQS_QUEUE_PREFIX', None)
+        self.prefix = QUEUE_PREFIX
+        self._logger = None
 
-        self._log = logging.getLogger('django_sqs.queue.%s' % self.name)
-        self._log.addHandler(_NullHandler())
-        self._log.info("Using queue %s" % self.full_name())
+        # shared by suffixes, which have the same receiver
+        if rate_limit or max_in_flight:
+            self.throttle = Throttle(self.full_name(), rate_limit,
+                                     rate_burst, max_in_flight)
+        else:
+            self.throttle = None
+
+    @property
+    def message_class(self):
+        # boto is imported when it's needed, see transports
+        if self._message_class is None:
+            import boto.sqs.message
+            self._message_class = boto.sqs.message.Message
+        return self._message_class
+
+    @message_class.setter
+    def message_class(self, message_class):
+        self._message_class = message_class
+
+    @property
+    def _log(self):
+        # set up when needed, so that registering many queues is cheap
+        if self._logger is None:
+            self._logger = logging.getLogger('django_sqs.queue.%s'
+                                             % self.name)
+            self._logger.addHandler(_NullHandler())
+        return self._logger
 
     def full_name(self, suffix=None):
         name = self.name
@@ -100,122 +283,860 @@ class RegisteredQueue(object):
                 warn("Unknown suffix %s" % suffix, UnknownSuffixWarning)
             name = '%s__%s' % ( name, suffix )
         if self.prefix:
-            return '%s__%s' % (self.prefix, name)
-        else:
-            return name
+            name = '%s__%s' % (self.prefix, name)
+        if self.fifo:
+            name += FIFO_SUFFIX
+        return name
+
+    def _check_fork(self):
+        # queue objects hold a connection that must not be shared
+        # with a forked process, and threads don't survive fork
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.queues = {}
+            self._heartbeat = None
 
     def get_connection(self):
-        if settings.AWS_REGION:
-            for r in boto.sqs.regions():
-                if r.name == settings.AWS_REGION:
-                    region = r
-
-        if self._connection is None:
-            self._connection = boto.sqs.connection.SQSConnection(
-                settings.AWS_ACCESS_KEY_ID,
-                settings.AWS_SECRET_ACCESS_KEY,
-                region=region,
-                debug=boto_debug)
-        return self._connection
+        return connection.get_connection()
 
     def get_queue(self, suffix=None):
+        self._check_fork()
         if suffix not in self.queues:
-            self.queues[suffix] = self.get_connection().create_queue(
-                self.full_name(suffix), self.visibility_timeout)
-            self.queues[suffix].set_message_class(self.message_class)
+            q = connection.get_queue(self.full_name(suffix),
+                                     self.visibility_timeout)
+            q.set_message_class(self.received_message_class())
+            self.queues[suffix] = q
+            self._log.info("Using queue %s" % self.full_name(suffix))
         return self.queues[suffix]
 
+    def received_message_class(self):
+        """Return class of messages received from the queue.
+
+        It is `message_class', or its subclass that resolves claim
+        checks of offloaded bodies and keeps raw bodies of messages
+        that may be forwarded to dead letter queue.
+        """
+        cls = self.message_class
+        if get_store() is not None:
+            cls = claim_check_class(cls)
+        if self.dead_letter:
+            if cls not in _raw_body_classes:
+                _raw_body_classes[cls] = type(
+                    cls.__name__, (_RawBodyMixin, cls), {})
+            cls = _raw_body_classes[cls]
+        return cls
+
+    @property
+    def retries(self):
+        """True if failed messages are retried instead of deleted."""
+        return bool(self.retry_delay or self.max_attempts)
+
+    def get_messages(self, q, num_messages=1, wait_time_seconds=None,
+                     block=True):
+        """Receive up to `num_messages' from `q' with attributes we need.
+
+        With a throttle, fewer messages may be received.  While it
+        doesn't allow any, this waits until it does (or until the
+        loop is stopped); without `block', it returns no messages.
+        Messages received must be processed by `_process_message()'
+        or `_process_batch()', which give their in-flight slots back.
+        """
+        if self.throttle is None:
+            return self._get_messages(q, num_messages, wait_time_seconds)
+        num_messages = self._wait_for_throttle(q, num_messages, block)
+        if not num_messages:
+            return []
+        try:
+            mm = self._get_messages(q, num_messages, wait_time_seconds)
+        except:
+            self.throttle.release(num_messages, unused=True)
+            raise
+        self.throttle.release(num_messages - len(mm), unused=True)
+        return mm
+
+    def _wait_for_throttle(self, q, n, block=True):
+        """Return number of messages (up to `n') throttle allows to fetch."""
+        start = None
+        while True:
+            granted, wait = self.throttle.acquire(n)
+            if granted:
+                break
+            if start is None:
+                start = time.time()
+                metrics.incr(metrics.queue_name(q) + '.throttled')
+            if not block or self._stopping:
+                break
+            time.sleep(min(wait, MAX_THROTTLE_SLEEP))
+        if start is not None:
+            metrics.timing(metrics.queue_name(q) + '.throttle_wait',
+                           time.time() - start)
+        return granted
+
+    def _get_messages(self, q, num_messages=1, wait_time_seconds=None):
+        collector = metrics.get_collector()
+        kwargs = {}
+        if wait_time_seconds:
+            kwargs['wait_time_seconds'] = wait_time_seconds
+        attributes = []
+        if self.retries:
+            attributes.append('ApproximateReceiveCount')
+        if collector.enabled:
+            attributes.append('SentTimestamp')
+        if self.fifo and self.dead_letter:
+            attributes.append('MessageGroupId')
+        if attributes:
+            kwargs['attributes'] = attributes
+        if self.dead_letter:
+            # all of them are forwarded to dead letter queue
+            kwargs['message_attributes'] = ['All']
+        elif self.idempotency is not None:
+            kwargs['message_attributes'] = [idempotency.DEDUP_ATTRIBUTE]
+        if not collector.enabled:
+            mm = q.get_messages(num_messages, **kwargs)
+            if mm and metrics.awaiting_first_message():
+                metrics.first_message(q)
+            return mm
+
+        name = metrics.queue_name(q)
+        collector.incr(name + '.api.ReceiveMessage')
+        start = time.time()
+        try:
+            mm = q.get_messages(num_messages, **kwargs)
+        except:
+            collector.incr(name + '.api_errors.ReceiveMessage')
+            raise
+        now = time.time()
+        collector.timing(name + '.receive_latency', now - start)
+        if mm:
+            if metrics.awaiting_first_message():
+                metrics.first_message(q)
+            collector.incr(name + '.received', len(mm))
+            collector.histogram(name + '.batch_size', len(mm))
+            for m in mm:
+                try:
+                    sent = int(m.attributes['SentTimestamp']) / 1000.0
+                except (AttributeError, KeyError, ValueError):
+                    continue
+                collector.timing(name + '.dwell_time', max(now - sent, 0))
+        return mm
+
+    def get_ack_buffer(self, suffix=None):
+        """Return an AckBuffer for batched deletes, or None if disabled."""
+        if self.delete_batch_size <= 1 or self.delete_on_start:
+            return None
+        return AckBuffer(self.get_queue(suffix),
+                         size=self.delete_batch_size,
+                         max_age=self.delete_max_age,
+                         visibility_timeout=self.visibility_timeout,
+                         log=self._log)
+
+    def get_heartbeat(self):
+        """Return Heartbeat extending visibility of messages, or None."""
+        if not self.heartbeat:
+            return None
+        self._check_fork()
+        if self._heartbeat is None:
+            self._heartbeat = Heartbeat(self.visibility_timeout,
+                                        self.max_lifetime, log=self._log)
+        return self._heartbeat
+
     def get_receiver_proxy(self):
         return self.ReceiverProxy(self)
 
-    def send(self, message=None, suffix=None, **kwargs):
-        q = self.get_queue(suffix)
+    def _make_message(self, message=None, group_id=None,
+                      deduplication_id=None, **kwargs):
         if message is None:
             message = self.message_class(**kwargs)
-        else:
-            if not isinstance(message, self.message_class):
-                raise ValueError('%r is not an instance of %r' % (
-                    message, self.message_class))
-        q.write(message)
+        elif not isinstance(message, self.message_class):
+            raise ValueError('%r is not an instance of %r' % (
+                message, self.message_class))
+        self._stamp(message, group_id, deduplication_id)
+        return message
+
+    def _stamp(self, message, group_id=None, deduplication_id=None):
+        """Set dedup key and FIFO ids of a message to send."""
+        if (group_id or deduplication_id) and not self.fifo:
+            raise ValueError("group_id and deduplication_id are meaningful"
+                             " only for FIFO queues")
+        key = deduplication_id or getattr(message, 'deduplication_id', None)
+        if self.idempotency is not None:
+            key = idempotency.stamp(message, key)
+        if self.fifo:
+            message.group_id = (group_id or getattr(message, 'group_id', None)
+                                or self.name)
+            message.deduplication_id = key or uuid.uuid4().hex
+
+    def send(self, message=None, suffix=None, **kwargs):
+        """Send a message to the queue.
+
+        With an outbox (see `outbox' module), message is handed to it
+        to be published after the current transaction commits.
+
+        For a FIFO queue, `group_id' (default is queue's name) and
+        `deduplication_id' (default is message's dedup key, or a
+        random one) keyword arguments set MessageGroupId and
+        MessageDeduplicationId of the message.
+        """
+        message = self._make_message(message, **kwargs)
+        if self.outbox:
+            get_outbox(self.outbox).add(self, suffix, [message])
+            return
+        self.publish(message, suffix)
+
+    def publish(self, message, suffix=None):
+        """Send `message' to SQS right away, bypassing outbox."""
+        if self.fifo and getattr(message, 'group_id', None) is None:
+            self._stamp(message)
+        q = self.get_queue(suffix)
+        body = message.get_body_encoded()
+        checked = check_out(body)
+        name = metrics.queue_name(q)
+        metrics.incr(name + '.api.SendMessage')
+        if checked is body:
+            try:
+                q.write(message)
+            except:
+                metrics.incr(name + '.api_errors.SendMessage')
+                raise
+            metrics.incr(name + '.sent')
+            return
+        # body has been offloaded, send the claim check instead
+        import boto.sqs.message
+        claim = boto.sqs.message.RawMessage(body=checked)
+        claim.message_attributes = message.message_attributes
+        if self.fifo:
+            claim.group_id = message.group_id
+            claim.deduplication_id = message.deduplication_id
+        try:
+            q.write(claim)
+        except:
+            metrics.incr(name + '.api_errors.SendMessage')
+            self._discard_claim(checked)
+            raise
+        metrics.incr(name + '.sent')
+        message.id = claim.id
+        message.md5 = claim.md5
+
+    def _discard_claim(self, body):
+        try:
+            get_store().delete(decode(body)['key'])
+        except Exception:
+            self._log.exception("Cannot delete blob of unsent message")
+
+    def send_batch(self, messages, suffix=None):
+        """Send many messages using SendMessageBatch requests.
+
+        `messages' is an iterable of `message_class' instances, or
+        dicts of keyword arguments for `message_class' constructor
+        (and `group_id' and `deduplication_id' ones, see `send()').
+        They are grouped into requests of up to ten messages and 256KB
+        of payload.  Bodies longer than SQS_BLOB_THRESHOLD are
+        offloaded to the blob store, if one is configured.  Entries
+        that failed because of an SQS-side error are retried up to
+        SQS_SEND_BATCH_RETRIES times; entries rejected as invalid are
+        not retried.
+
+        Returns a list of (message, error) pairs, in the same order as
+        `messages'.  `error' is None if message has been sent (its
+        `id' attribute is set then), or a string describing why it
+        couldn't be sent.  With an outbox, messages are handed to it
+        and all errors are None.
+        """
+        messages = [self._make_message(**m) if isinstance(m, dict)
+                    else self._make_message(m)
+                    for m in messages]
+        if self.outbox:
+            get_outbox(self.outbox).add(self, suffix, messages)
+            return [(m, None) for m in messages]
+        return self.publish_batch(messages, suffix)
+
+    def publish_batch(self, messages, suffix=None):
+        """Send `messages' to SQS right away, bypassing outbox.
+
+        See `send_batch()'; `messages' may be of any message class.
+        """
+        if self.fifo:
+            for m in messages:
+                if getattr(m, 'group_id', None) is None:
+                    self._stamp(m)
+        q = self.get_queue(suffix)
+        bodies = [check_out(m.get_body_encoded()) for m in messages]
+        sizes = [_payload_size(body) for body in bodies]
+        errors = [None] * len(messages)
+
+        name = metrics.queue_name(q)
+        pending = []
+        for i, size in enumerate(sizes):
+            if size > MAX_PAYLOAD_SIZE:
+                errors[i] = "Message is %d bytes long, limit is %d" % (
+                    size, MAX_PAYLOAD_SIZE)
+            else:
+                pending.append(i)
 
-    def receive(self, message):
+        for attempt in range(SEND_BATCH_RETRIES + 1):
+            if attempt:
+                self._log.warning("Retrying %d failed messages" % len(pending))
+                time.sleep(0.1 * 2 ** (attempt - 1))
+            failed = []
+            for batch in _split_batches(pending, sizes):
+                metrics.incr(name + '.api.SendMessageBatch')
+                try:
+                    rv = q.write_batch([self._batch_entry(i, bodies[i],
+                                                          messages[i])
+                                        for i in batch])
+                except Exception, e:
+                    metrics.incr(name + '.api_errors.SendMessageBatch')
+                    self._log.exception(
+                        "Cannot send %d messages" % len(batch))
+                    for i in batch:
+                        errors[i] = str(e)
+                    failed.extend(batch)
+                    continue
+                for result in rv.results:
+                    i = int(result['id'])
+                    messages[i].id = result.get('message_id')
+                    messages[i].md5 = result.get('message_md5')
+                    errors[i] = None
+                for error in rv.errors:
+                    i = int(error['id'])
+                    errors[i] = "%s: %s" % (error.get('error_code'),
+                                            error.get('error_message'))
+                    if error.get('sender_fault') != 'true':
+                        failed.append(i)
+            if not failed:
+                break
+            pending = sorted(failed)
+
+        for i, error in enumerate(errors):
+            if error is not None:
+                self._log.error("Cannot send message %r: %s" % (
+                    messages[i], error))
+                if is_claim_check(bodies[i]):
+                    self._discard_claim(bodies[i])
+        metrics.incr(name + '.sent', errors.count(None))
+        return zip(messages, errors)
+
+    def _batch_entry(self, i, body, message):
+        entry = (str(i), body, 0, message.message_attributes)
+        if self.fifo:
+            entry += (message.group_id, message.deduplication_id)
+        return entry
+
+    def receive(self, message, received=None):
+        """Call receiver with `message' (a list for batch receivers).
+
+        With `heartbeat', visibility of the message is extended while
+        receiver runs; `received' is the time message was received.
+        """
         if self.receiver is None:
             raise Exception("Not configured to received messages.")
+        heartbeat = None
+        if not self.delete_on_start:
+            heartbeat = self.get_heartbeat()
+        if self.batch:
+            messages = message
+        else:
+            messages = [message]
+        if heartbeat is not None:
+            heartbeat.add(messages, received)
+        timeout = None
         if self.timeout:
-           signal.alarm(self.timeout)
-           signal.signal(signal.SIGALRM, sigalrm_handler)
+            timeout = make_timeout(self.timeout, TimedOut)
+            timeout.start()
+        collector = metrics.get_collector()
+        start = time.time()
         try:
-            self.receiver(message)
+            try:
+                rv = self.receiver(message)
+            finally:
+                if timeout is not None:
+                    timeout.cancel()
+            # In a thread, exception of a timeout that fired during a
+            # blocking call lands wherever the thread happens to be
+            # when the call returns (if it isn't cancelled by then),
+            # so the outcome is decided by the timeout itself.
+            if getattr(timeout, 'fired', False):
+                raise TimedOut()
+            return rv
         finally:
-            if self.timeout:
-                try:
-                    signal.alarm(0)
-                    signal.signal(signal.SIGALRM, signal.SIG_DFL)
-                except TimedOut:
-                    # possible race condition if we don't cancel the
-                    # alarm in time.  Now there is no race condition
-                    # threat, since alarm already rang.
-                    signal.alarm(0)
-                    signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            if collector.enabled:
+                collector.timing(
+                    metrics.queue_name(messages[0].queue) + '.run_time',
+                    time.time() - start)
+            if heartbeat is not None:
+                heartbeat.remove(messages)
             if self.close_database:
-                for connection in CONNECTIONS:
-                    print 'Closing', connection
-                    connection.close()
+                close_connections()
+
+
+    def load_messages(self, messages):
+        """Let message class load bodies of received `messages' at once.
 
+        Message classes that fetch body contents from elsewhere (like
+        ModelInstanceMessage) can provide a `load_batch(messages,
+        select_related, prefetch_related)' class method, which is
+        called for every batch of received messages.  If it fails,
+        each message loads its body by itself when it is needed.
+        """
+        load_batch = getattr(self.message_class, 'load_batch', None)
+        if load_batch is None or not messages:
+            return
+        try:
+            load_batch(messages,
+                       select_related=self.select_related,
+                       prefetch_related=self.prefetch_related)
+        except Exception:
+            self._log.exception("Cannot load batch of %d messages"
+                                % len(messages))
 
     def receive_single(self, suffix=None):
         """Receive single message from the queue.
 
         This method is here for debugging purposes.  It receives
         single message from the queue, processes it, deletes it from
-        queue and returns (message, handler_result_value) pair.
+        queue and returns (message, handler_result_value) pair.  Batch
+        receiver is called with a single-element list; if it returns
+        the message as failed, the message is retried like in
+        `_run_batch()' instead of being deleted.
         """
         q = self.get_queue(suffix)
-        mm = q.get_messages(1)
+        mm = self.get_messages(q, 1)
         if mm:
-            if self.delete_on_start:
-                q.delete_message(mm[0])
-            rv1 = self.receive(mm[0])
-            if not self.delete_on_start:
-                q.delete_message(mm[0])
-            return (mm[0], rv1)
+            try:
+                self.load_messages(mm)
+                if self.delete_on_start:
+                    q.delete_message(mm[0])
+                if self.batch:
+                    rv1 = self.receive(mm)
+                    failed = set(id(m) for m in rv1 or ())
+                    if id(mm[0]) in failed:
+                        if self.delete_on_start:
+                            discard_blobs(mm)
+                        elif self.retries:
+                            self._retry(q, mm)
+                        return (mm[0], rv1)
+                else:
+                    rv1 = self.receive(mm[0])
+                if not self.delete_on_start:
+                    q.delete_message(mm[0])
+                discard_blobs(mm)
+                return (mm[0], rv1)
+            finally:
+                if self.throttle is not None:
+                    self.throttle.release(1)
 
-    def receive_loop(self, message_limit=None, suffix=None):
+    def stop(self):
+        """Make running receive_loop return after current messages.
+
+        Messages that have already been fetched are processed and
+        pending deletes are flushed before receive_loop returns.  Safe
+        to call from a signal handler.
+        """
+        self._stopping = True
+
+    def receive_loop(self, message_limit=None, suffix=None, batch_size=None,
+                     wait_time_seconds=None, concurrency=None, counter=None):
         """Run receiver loop.
 
         If `message_limit' number is given, return after processing
         this number of messages.
+
+        Up to `batch_size' messages (queue's `batch_size' by default)
+        are fetched with a single SQS request; they are processed in
+        the order they were received.
+
+        If `wait_time_seconds' (queue's `wait_time_seconds' by
+        default) is non-zero, SQS long polling is used: each request
+        waits up to that many seconds for a message to arrive.
+        Otherwise, the loop sleeps between polls of an empty queue,
+        starting with SQS_MIN_POLL_PERIOD seconds and doubling the
+        sleep up to SQS_POLL_PERIOD until a message arrives.
+
+        If `concurrency' (queue's `concurrency' by default) is greater
+        than 1, messages are processed by a pool of that many threads.
+        No more messages are fetched than there are free threads to
+        process them.  Each thread uses its own database connections.
+
+        For a batch receiver, messages are collected into batches of
+        up to queue's `max_batch' messages, possibly with several SQS
+        requests; see `_receive_batches()'.
+
+        Loop can be stopped gracefully by calling `stop()'.
+
+        If `counter' is given, it should be a `multiprocessing.Value';
+        its value is incremented for each message received.
+
+        Returns number of messages received.
         """
         q = self.get_queue(suffix)
-        i = 0
+        batch_size = check_batch_size(batch_size or self.batch_size)
+        if wait_time_seconds is None:
+            wait_time_seconds = self.wait_time_seconds
+        check_wait_time_seconds(wait_time_seconds)
+        poll_period = min(MIN_POLL_PERIOD, POLL_PERIOD)
+        acks = self.get_ack_buffer(suffix)
+        concurrency = concurrency or self.concurrency
+        if concurrency > 1:
+            pool = WorkerPool(concurrency,
+                              name='django_sqs-%s' % self.name,
+                              log=self._log)
+        else:
+            pool = None
+        processed = 0
+        self._stopping = False
+        try:
+            if self.batch:
+                return self._receive_batches(q, message_limit, batch_size,
+                                             wait_time_seconds, pool, acks,
+                                             counter)
+            while not self._stopping:
+                n = batch_size
+                if pool is not None:
+                    n = min(n, pool.wait_for_slot())
+                if message_limit:
+                    if processed >= message_limit:
+                        return processed
+                    n = min(n, message_limit - processed)
+                received = time.time()
+                mm = self.get_messages(q, n, wait_time_seconds)
+                if not mm:
+                    if not wait_time_seconds:
+                        time.sleep(poll_period)
+                        poll_period = min(poll_period * 2, POLL_PERIOD)
+                else:
+                    poll_period = min(MIN_POLL_PERIOD, POLL_PERIOD)
+                    self.load_messages(mm)
+                    for m in mm:
+                        if pool is None:
+                            self._process_message(q, m, acks, received)
+                        else:
+                            pool.submit(self._process_message,
+                                        q, m, acks, received)
+                        processed += 1
+                        if counter is not None:
+                            with counter.get_lock():
+                                counter.value += 1
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if acks is not None:
+                acks.close()
+        return processed
+
+    def _receive_batches(self, q, message_limit, batch_size,
+                         wait_time_seconds, pool, acks, counter):
+        """Receive loop of a batch receiver.
+
+        Messages are fetched until `max_batch' of them are collected,
+        or until `batch_wait' seconds have passed since the first one
+        of the batch was received, and then handed to the receiver
+        all at once.  With a pool of threads, a batch takes one
+        thread.
+        """
+        poll_period = min(MIN_POLL_PERIOD, POLL_PERIOD)
+        processed = 0
+        batch = []
+        first_received = None
         while True:
+            if batch and (len(batch) >= self.max_batch
+                          or time.time() >= first_received + self.batch_wait
+                          or self._stopping
+                          or (message_limit and
+                              processed + len(batch) >= message_limit)):
+                self.load_messages(batch)
+                if pool is None:
+                    self._process_batch(q, batch, acks, first_received)
+                else:
+                    pool.submit(self._process_batch,
+                                q, batch, acks, first_received)
+                processed += len(batch)
+                if counter is not None:
+                    with counter.get_lock():
+                        counter.value += len(batch)
+                batch = []
+
+            if not batch:
+                if self._stopping:
+                    return processed
+                if message_limit and processed >= message_limit:
+                    return processed
+                if pool is not None:
+                    pool.wait_for_slot()
+
+            n = min(self.max_batch - len(batch), batch_size)
             if message_limit:
-                i += 1
-                if i > message_limit:
-                    return
-            mm = q.get_messages(1)
+                n = min(n, message_limit - processed - len(batch))
+            wait = wait_time_seconds
+            if batch:
+                wait = min(wait, max(
+                    int(first_received + self.batch_wait - time.time()), 0))
+            received = time.time()
+            mm = self.get_messages(q, n, wait)
+            if mm:
+                poll_period = min(MIN_POLL_PERIOD, POLL_PERIOD)
+                if not batch:
+                    first_received = received
+                batch.extend(mm)
+            elif not batch:
+                if not wait_time_seconds:
+                    time.sleep(poll_period)
+                    poll_period = min(poll_period * 2, POLL_PERIOD)
+            elif not wait:
+                time.sleep(max(min(
+                    poll_period,
+                    first_received + self.batch_wait - time.time()), 0))
+
+    def _process_batch(self, q, mm, acks=None, received=None):
+        """Run batch receiver on messages `mm' and delete them.
+
+        See `_run_batch()'.
+        """
+        try:
+            self._run_batch(q, mm, acks, received)
+        finally:
+            if self.throttle is not None:
+                self.throttle.release(len(mm))
+
+    def _run_batch(self, q, mm, acks=None, received=None):
+        """Run batch receiver on messages `mm' and delete them.
+
+        Receiver may return a list of messages that failed; these are
+        retried according to queue's retry policy, or left in queue if
+        there is none.  Messages listed by RestartLater are left in
+        queue.
+        """
+        failed = None
+        restart = None
+        if self.idempotency is not None:
+            mm = self._skip_done(q, mm, acks, received)
             if not mm:
-                time.sleep(POLL_PERIOD)
+                return
+        try:
+            if self.delete_on_start:
+                delete_messages(q, mm, self._log, discard=False)
+            failed = self.receive(mm, received)
+        except KeyboardInterrupt, e:
+            raise e
+        except RestartLater, e:
+            restart = e.messages
+            if restart is None:
+                restart = mm
+            self._log.debug("Restarting handling of %d messages"
+                            % len(restart))
+        except:
+            self._log.exception(
+                "Caught exception in receive loop for batch of %d %s"
+                % (len(mm), self.message_class))
+            if self.retries:
+                failed = mm
+        failed = list(failed or ())
+        restart = list(restart or ())
+        kept = set(id(m) for m in failed + restart)
+        done = [m for m in mm if id(m) not in kept]
+        collector = metrics.get_collector()
+        if collector.enabled:
+            name = metrics.queue_name(q)
+            collector.incr(name + '.processed', len(done))
+            if failed:
+                collector.incr(name + '.failed', len(failed))
+            if restart:
+                collector.incr(name + '.restarted', len(restart))
+        self._mark_done(done)
+        if self.delete_on_start:
+            discard_blobs(mm)
+            return
+        if acks is None:
+            delete_messages(q, done, self._log)
+        else:
+            for m in done:
+                acks.add(m, received)
+        if self.retries:
+            self._retry(q, failed, acks, received)
+        self._back_off(q, restart)
+
+    def _process_message(self, q, m, acks=None, received=None):
+        """Run receiver on a single message and delete it when appropriate.
+
+        See `_run_message()'.
+        """
+        try:
+            self._run_message(q, m, acks, received)
+        finally:
+            if self.throttle is not None:
+                self.throttle.release(1)
+
+    def _run_message(self, q, m, acks=None, received=None):
+        """Run receiver on a single message and delete it when appropriate.
+
+        If `acks' AckBuffer is given, message is scheduled for batched
+        deletion instead of being deleted right away.
+        """
+        if self.idempotency is not None \
+                and not self._skip_done(q, [m], acks, received):
+            return
+        try:
+            if self.delete_on_start:
+                self._delete_message(q, m, discard=False)
+            self.receive(m, received)
+        except KeyboardInterrupt, e:
+            raise e
+        except RestartLater:
+            self._log.debug("Restarting message handling")
+            metrics.incr(metrics.queue_name(q) + '.restarted')
+            if not self.delete_on_start:
+                self._back_off(q, [m])
+        except:
+            try:
+                body = repr(m.get_body())
+            except Exception, e:
+                body = "(cannot run %r.get_body(): %s)" % (m, e)
+            self._log.exception(
+                "Caught exception in receive loop for %s %s" % (
+                    m.__class__, body))
+            metrics.incr(metrics.queue_name(q) + '.failed')
+            if not self.delete_on_start:
+                if self.retries:
+                    self._retry(q, [m], acks, received)
+                else:
+                    self._delete_message(q, m, acks, received)
+        else:
+            metrics.incr(metrics.queue_name(q) + '.processed')
+            self._mark_done([m])
+            if not self.delete_on_start:
+                self._delete_message(q, m, acks, received)
+        if self.delete_on_start:
+            discard_blobs([m])
+
+    def _done_key(self, message):
+        return '%s:%s' % (self.name, idempotency.dedup_key(message))
+
+    def _skip_done(self, q, mm, acks=None, received=None):
+        """Delete messages of `mm' that have already been processed.
+
+        Returns list of the rest.  Without idempotency store, or if it
+        fails, all the messages are returned.
+        """
+        try:
+            done = self.idempotency.done(self._done_key(m) for m in mm)
+        except Exception:
+            self._log.exception("Cannot check for processed messages")
+            return mm
+        if not done:
+            return mm
+        rv = []
+        for m in mm:
+            if self._done_key(m) not in done:
+                rv.append(m)
+                continue
+            self._log.info("Message %s has already been processed,"
+                           " deleting it" % m.id)
+            metrics.incr(metrics.queue_name(q) + '.duplicates')
+            try:
+                self._delete_message(q, m, acks, received)
+            except Exception:
+                self._log.exception("Cannot delete message %s" % m.id)
+        return rv
+
+    def _mark_done(self, mm):
+        if self.idempotency is None or not mm:
+            return
+        try:
+            self.idempotency.mark_done(self._done_key(m) for m in mm)
+        except Exception:
+            self._log.exception("Cannot remember %d processed messages"
+                                % len(mm))
+
+    def attempts(self, message):
+        """Number of times `message' has been received."""
+        try:
+            return int(message.attributes.get('ApproximateReceiveCount', 1))
+        except (AttributeError, ValueError):
+            return 1
+
+    def retry_delay_for(self, attempts):
+        """Seconds to wait before retrying message after `attempts'."""
+        return min(int(self.retry_delay * 2 ** (attempts - 1)),
+                   self.max_retry_delay)
+
+    def _retry(self, q, mm, acks=None, received=None):
+        """Retry failed messages `mm' later, or give up on them.
+
+        After `max_attempts', message is forwarded to `dead_letter'
+        suffix queue (if any) and deleted.
+        """
+        retry = []
+        for m in mm:
+            if self.max_attempts and self.attempts(m) >= self.max_attempts:
+                self._give_up(q, m, acks, received)
             else:
-                for m in mm:
-                    try:
-                        if self.delete_on_start:
-                            q.delete_message(m)
-                        self.receive(m)
-                    except KeyboardInterrupt, e:
-                        raise e
-                    except RestartLater:
-                        self._log.debug("Restarting message handling")
-                    except:
-                        try:
-                            body = repr(m.get_body())
-                        except Exception, e:
-                            body = "(cannot run %r.get_body(): %s)" % (m, e)
-                        self._log.exception(
-                            "Caught exception in receive loop for %s %s" % (
-                                m.__class__, body))
-                        if not self.delete_on_start:
-                            q.delete_message(m)
-                    else:
-                        if not self.delete_on_start:
-                            q.delete_message(m)
+                retry.append(m)
+        if retry:
+            metrics.incr(metrics.queue_name(q) + '.retried', len(retry))
+        self._back_off(q, retry)
+
+    def _give_up(self, q, m, acks=None, received=None):
+        if not self.dead_letter:
+            self._log.error("Message %s failed %d times, deleting it" % (
+                m.id, self.attempts(m)))
+            metrics.incr(metrics.queue_name(q) + '.gave_up')
+            self._delete_message(q, m, acks, received)
+            return
+        dlq = self.get_queue(self.dead_letter)
+        if dlq is q:
+            # already in dead letter queue, just keep it there
+            return
+        self._log.error("Message %s failed %d times, moving it to %s" % (
+            m.id, self.attempts(m), self.full_name(self.dead_letter)))
+        import boto.sqs.message
+        dead = boto.sqs.message.RawMessage(body=m.raw_body)
+        dead.message_attributes = m.message_attributes
+        if self.fifo:
+            dead.group_id = m.attributes.get('MessageGroupId', self.name)
+            dead.deduplication_id = m.id
+        try:
+            dlq.write(dead)
+        except Exception:
+            self._log.exception("Cannot move message %s to %s" % (
+                m.id, self.full_name(self.dead_letter)))
+            self._back_off(q, [m])
+            return
+        metrics.incr(metrics.queue_name(q) + '.dead_lettered')
+        # offloaded body now belongs to the message in dead letter queue
+        self._delete_message(q, m, discard=False)
+
+    def _back_off(self, q, mm):
+        """Make messages `mm' visible again after retry delay."""
+        if not self.retry_delay or not mm:
+            return
+        name = metrics.queue_name(q)
+        for i in range(0, len(mm), MAX_BATCH_SIZE):
+            batch = mm[i:i+MAX_BATCH_SIZE]
+            metrics.incr(name + '.api.ChangeMessageVisibilityBatch')
+            try:
+                rv = q.change_message_visibility_batch(
+                    [(m, self.retry_delay_for(self.attempts(m)))
+                     for m in batch])
+            except Exception:
+                metrics.incr(name + '.api_errors.ChangeMessageVisibilityBatch')
+                self._log.exception("Cannot delay retry of %d messages"
+                                    % len(batch))
+                continue
+            for error in rv.errors:
+                self._log.error("Cannot delay retry of message %s: %s: %s" % (
+                    error.get('id'), error.get('error_code'),
+                    error.get('error_message')))
+
+    def _delete_message(self, q, m, acks=None, received=None, discard=True):
+        if acks is None:
+            name = metrics.queue_name(q)
+            metrics.incr(name + '.api.DeleteMessage')
+            try:
+                q.delete_message(m)
+            except:
+                metrics.incr(name + '.api_errors.DeleteMessage')
+                raise
+            metrics.incr(name + '.deleted')
+            if discard:
+                discard_blobs([m])
+        else:
+            acks.add(m, received)
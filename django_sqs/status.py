@@ -0,0 +1,183 @@
+"""Status of registered queues, shared by sqs_status, sqs_wait and
+the status view.
+
+Attributes of all the queues are fetched with concurrent
+GetQueueAttributes requests, and kept in Django's cache for
+SQS_STATUS_CACHE_TTL seconds, so that frequent checks (e.g. by
+monitoring polling the status view) don't hit SQS every time.
+"""
+import datetime
+from functools import partial
+import os
+import time
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import django.utils.simplejson as json
+
+from django.conf import settings
+from django.core.cache import cache
+
+import django_sqs
+from app_settings import AWS_REGION
+from connection import call_in_parallel
+
+# Seconds for which queue status is cached; 0 disables caching
+STATUS_CACHE_TTL = getattr(settings, 'SQS_STATUS_CACHE_TTL', 15)
+
+# Whether to read age of the oldest message from CloudWatch, which
+# needs an extra request per queue (and cloudwatch:GetMetricStatistics
+# permission)
+STATUS_CLOUDWATCH = getattr(settings, 'SQS_STATUS_CLOUDWATCH', False)
+
+CACHE_KEY_PREFIX = 'django_sqs.status:'
+
+# queue attribute -> status field
+ATTRIBUTES = (
+    ('ApproximateNumberOfMessages', 'messages'),
+    ('ApproximateNumberOfMessagesNotVisible', 'in_flight'),
+    ('ApproximateNumberOfMessagesDelayed', 'delayed'),
+    )
+
+# status fields with numbers, None if unknown
+FIELDS = ('messages', 'in_flight', 'delayed', 'oldest_age')
+
+_cloudwatch = None
+_cloudwatch_pid = None
+
+
+def get_cloudwatch():
+    """Return CloudWatch connection of this process."""
+    global _cloudwatch, _cloudwatch_pid
+    if _cloudwatch is None or _cloudwatch_pid != os.getpid():
+        import boto.ec2.cloudwatch
+        _cloudwatch = boto.ec2.cloudwatch.connect_to_region(
+            AWS_REGION,
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
+        _cloudwatch_pid = os.getpid()
+    return _cloudwatch
+
+
+def oldest_age(queue_name):
+    """Age in seconds of the oldest message in `queue_name', according
+    to CloudWatch, or None if there is no recent datapoint."""
+    now = datetime.datetime.utcnow()
+    datapoints = get_cloudwatch().get_metric_statistics(
+        60, now - datetime.timedelta(minutes=5), now,
+        'ApproximateAgeOfOldestMessage', 'AWS/SQS', ['Maximum'],
+        dimensions={'QueueName': queue_name})
+    if datapoints:
+        latest = max(datapoints, key=lambda d: d['Timestamp'])
+        return int(latest['Maximum'])
+
+
+def fetch_status(rq, suffix=None):
+    """Fetch status of RegisteredQueue `rq' (with `suffix') from SQS.
+
+    Returns a dict with `queue' and `suffix' identifying it, full
+    queue `name', numbers in FIELDS, `checked' timestamp and `error'
+    (None, or a string describing why status couldn't be fetched).
+    """
+    status = dict((field, None) for field in FIELDS)
+    status.update(queue=rq.name, suffix=suffix, name=rq.full_name(suffix),
+                  checked=time.time(), error=None)
+    try:
+        attributes = rq.get_queue(suffix).get_attributes('All')
+        for attribute, field in ATTRIBUTES:
+            if attribute in attributes:
+                status[field] = int(attributes[attribute])
+        if STATUS_CLOUDWATCH:
+            status['oldest_age'] = oldest_age(status['name'])
+    except Exception, e:
+        status['error'] = str(e) or e.__class__.__name__
+    return status
+
+
+def get_status(queue_names=None, suffixes=True, max_age=None):
+    """Return list of statuses (see `fetch_status') of registered queues.
+
+    Queues named in `queue_names' (default is all) are listed in
+    order, each followed by its suffixes unless `suffixes' is false.
+    Statuses cached less than `max_age' seconds ago (default is
+    SQS_STATUS_CACHE_TTL) are reused; the rest are fetched in
+    parallel.
+    """
+    if queue_names is None:
+        queue_names = sorted(django_sqs.queues.keys())
+    if max_age is None:
+        max_age = STATUS_CACHE_TTL
+    entries = []
+    for queue_name in queue_names:
+        rq = django_sqs.queues[queue_name]
+        entries.append((rq, None))
+        if suffixes:
+            entries.extend((rq, suffix) for suffix in rq.suffixes)
+
+    keys = [CACHE_KEY_PREFIX + queue.full_name(suffix)
+            for queue, suffix in entries]
+    cached = {}
+    if max_age > 0:
+        now = time.time()
+        cached = dict(
+            (key, status)
+            for key, status in cache.get_many(keys).items()
+            if status['checked'] > now - max_age)
+
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+    fetched = call_in_parallel(partial(fetch_status, *entries[i])
+                               for i in missing)
+    fresh = {}
+    for i, (status, e) in zip(missing, fetched):
+        cached[keys[i]] = status
+        if status['error'] is None:
+            fresh[keys[i]] = status
+    if fresh and STATUS_CACHE_TTL > 0:
+        cache.set_many(fresh, STATUS_CACHE_TTL)
+    return [cached[key] for key in keys]
+
+
+def total(status):
+    """Number of messages in queue, including in flight and delayed ones."""
+    return sum(status[field] or 0
+               for field in ('messages', 'in_flight', 'delayed'))
+
+
+def label(status):
+    if status['suffix']:
+        return '%s.%s' % (status['queue'], status['suffix'])
+    return status['queue']
+
+
+def format_text(statuses):
+    """Return lines of a plain text table of `statuses'.
+
+    Columns are the approximate number of messages, messages in
+    flight, delayed messages and age of the oldest message.
+    """
+    def _value(value):
+        if value is None:
+            return '-'
+        return value
+    lines = ["%-30s  %6s %6s %6s %8s" % (
+        'queue', 'count', 'flight', 'delay', 'oldest')]
+    for status in statuses:
+        if status['error'] is not None:
+            lines.append("%-30s: error: %s" % (label(status), status['error']))
+        else:
+            lines.append("%-30s: %6s %6s %6s %8s" % (
+                (label(status), ) + tuple(_value(status[field])
+                                          for field in FIELDS)))
+    return lines
+
+
+def format_json(statuses):
+    """Return JSON document describing `statuses'."""
+    return json.dumps({
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'queues': statuses,
+        }, sort_keys=True, indent=2)
@@ -0,0 +1,432 @@
+"""Pre-forking supervisor for receiver processes."""
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from django.conf import settings
+
+import metrics
+from workers import close_connections
+
+# A child that exits within this many seconds after start is
+# considered to be crash-looping: it is respawned after a delay, which
+# is doubled on each consecutive quick crash up to MAX_RESPAWN_DELAY.
+MIN_UPTIME = 10
+MAX_RESPAWN_DELAY = 60
+
+# How often master process wakes up to check on its children.
+TICK = 1
+
+# How often (in seconds) autoscaled groups are resized
+AUTOSCALE_INTERVAL = getattr(settings, 'SQS_AUTOSCALE_INTERVAL', 30)
+
+# Autoscaled groups get enough workers to process their queue's
+# backlog within this many seconds, at observed per-worker throughput
+AUTOSCALE_DRAIN_TIME = getattr(settings, 'SQS_AUTOSCALE_DRAIN_TIME', 60)
+
+
+class _NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+
+# signal name dict for logging
+_signals = {}
+for name in dir(signal):
+    if name.startswith('SIG') and not name.startswith('SIG_'):
+        _signals[getattr(signal, name)] = name
+def status_string(status):
+    "Pretty status description for exited child."
+
+    if os.WIFSIGNALED(status):
+        return "Terminated by %s (%d)" % (
+            _signals.get(os.WTERMSIG(status), "unknown signal"),
+            os.WTERMSIG(status))
+
+    if os.WIFEXITED(status):
+        return "Exited with status %d" % os.WEXITSTATUS(status)
+
+    if os.WIFSTOPPED(status):
+        return "Stopped by %s (%d)" % (
+            _signals.get(os.WSTOPSIG(status), "unknown signal"),
+            os.WSTOPSIG(status))
+
+    if os.WIFCONTINUED(status):
+        return "Continued from stop"
+
+    return "Unknown reason (%r)" % status
+
+
+class WorkerGroup(object):
+    """A group of identical worker processes.
+
+    `target' is called in each child process with a `message_limit'
+    argument (None for no limit).  It should return after processing
+    that many messages, or after SIGTERM is received, having finished
+    messages it is processing.  It should return the number of
+    messages it has processed; if it returns None, it is assumed to
+    have processed all of its `message_limit'.  A child that raises an
+    exception or gets killed is respawned.
+
+    `message_limit' is number of messages each worker processes
+    before the worker is done for good.  With `max_messages_per_child',
+    a worker process is replaced with a fresh one after processing that
+    many messages, which bounds memory growth of long-lived workers.
+
+    If `max_workers' is greater than `workers', the group is
+    autoscaled between `workers' and `max_workers' processes.  This
+    needs a `depth' callable returning number of messages waiting in
+    the queue, and a `counter' (a `multiprocessing.Value') that
+    workers increment for each message they receive.
+    """
+
+    def __init__(self, name, target, workers=1, message_limit=None,
+                 max_messages_per_child=None, max_workers=None,
+                 depth=None, counter=None):
+        if workers < 1:
+            raise ValueError("number of workers must be positive, not %r"
+                             % workers)
+        self.name = name
+        self.target = target
+        self.workers = workers
+        self.message_limit = message_limit
+        self.max_messages_per_child = max_messages_per_child
+        self.max_workers = max(max_workers or workers, workers)
+        self.depth = depth
+        self.counter = counter
+        if self.autoscaled and (depth is None or counter is None):
+            raise ValueError("autoscaling needs depth and counter")
+
+    @property
+    def autoscaled(self):
+        return self.max_workers > self.workers
+
+    def desired_workers(self, depth, rate, active):
+        """Number of workers needed for `depth' messages in the queue.
+
+        `rate' is number of messages per second received by `active'
+        workers recently, or None if it isn't known yet.
+        """
+        if not depth:
+            desired = self.workers
+        elif not rate or not active:
+            # backlog and no throughput data: grow step by step
+            desired = active + 1
+        else:
+            per_worker = float(rate) / active
+            desired = int(math.ceil(
+                depth / (per_worker * AUTOSCALE_DRAIN_TIME)))
+        return min(max(desired, self.workers), self.max_workers)
+
+
+class _Worker(object):
+    """A single worker slot of a group, served by consecutive children."""
+
+    def __init__(self, group, index):
+        self.group = group
+        self.index = index
+        self.remaining = group.message_limit
+        # messages processed by the last child, reported by the child
+        self.processed = multiprocessing.Value('L', 0, lock=False)
+        self.pid = None
+        self.started = None
+        self.child_limit = None
+        self.respawn_at = None
+        self.respawn_delay = 0
+        self.restarting = False
+        self.retiring = False
+
+    def __str__(self):
+        return '%s#%d' % (self.group.name, self.index)
+
+    def next_child_limit(self):
+        limits = [limit for limit in (self.remaining,
+                                      self.group.max_messages_per_child)
+                  if limit is not None]
+        if limits:
+            return min(limits)
+        return None
+
+
+class Supervisor(object):
+    """Runs worker groups in child processes and keeps them running.
+
+    Signals handled by the master process:
+    - SIGTERM, SIGINT: stop gracefully; children are sent SIGTERM
+      and master exits when all of them have finished
+    - SIGHUP: restart gracefully; children are sent SIGTERM and
+      replaced with fresh ones as they exit
+    - SIGUSR1: passed on to children, which ignore it unless they
+      handle it (e.g. runreceiver --profile writes its results)
+
+    Autoscaled groups are resized every AUTOSCALE_INTERVAL seconds.
+    Workers are removed by sending them SIGTERM, so they exit only
+    after finishing messages they are processing.
+    """
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.workers = []
+        self._next_index = {}
+        for group in groups:
+            for i in range(group.workers):
+                self._add_worker(group)
+        self._throughput = {}           # group -> (time, counter value)
+        self._next_autoscale = time.time() + AUTOSCALE_INTERVAL
+        self._stopping = False
+        self._restart_requested = False
+        self._log = logging.getLogger('django_sqs.runreceiver.master')
+        self._log.addHandler(_NullHandler())
+
+    def children(self):
+        return [w for w in self.workers if w.pid is not None]
+
+    def _add_worker(self, group):
+        index = self._next_index.get(group, 0)
+        self._next_index[group] = index + 1
+        worker = _Worker(group, index)
+        self.workers.append(worker)
+        return worker
+
+    def active_workers(self, group):
+        """Workers of `group' that are running or about to be respawned."""
+        return [w for w in self.workers
+                if w.group is group and not w.retiring
+                and (w.pid is not None or w.respawn_at is not None)]
+
+    def run(self):
+        # Close the DB connection now and let Django reopen it when it
+        # is needed again.  The goal is to make sure that every
+        # process gets its own connection
+        close_connections()
+
+        os.setpgrp()
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_restart)
+        signal.signal(signal.SIGUSR1, self._handle_usr1)
+
+        for worker in self.workers:
+            self.spawn(worker)
+
+        while True:
+            self.reap()
+            if self._restart_requested:
+                self._restart_requested = False
+                self.restart_all()
+            if self._stopping:
+                if not self.children():
+                    break
+            else:
+                self.respawn_due()
+                if not self.children() and not [
+                        w for w in self.workers if w.respawn_at is not None]:
+                    # every worker is done with its message limit
+                    break
+            self.tick()
+            time.sleep(TICK)
+        self._log.info("All children exited, stopping.")
+
+    def tick(self):
+        """Called by the main loop about every TICK seconds."""
+        now = time.time()
+        if self._stopping or now < self._next_autoscale:
+            return
+        self._next_autoscale = now + AUTOSCALE_INTERVAL
+        for group in self.groups:
+            if group.autoscaled:
+                try:
+                    self.autoscale(group, now)
+                except Exception:
+                    self._log.exception("Cannot autoscale %s" % group.name)
+
+    def autoscale(self, group, now):
+        active = self.active_workers(group)
+        count = group.counter.value
+        rate = None
+        if group in self._throughput:
+            last_time, last_count = self._throughput[group]
+            if now > last_time:
+                rate = (count - last_count) / (now - last_time)
+        self._throughput[group] = (now, count)
+        depth = group.depth()
+        desired = group.desired_workers(depth, rate, len(active))
+        if desired > len(active):
+            self._log.info("Scaling %s up from %d to %d workers"
+                           " (%d messages waiting)" % (
+                               group.name, len(active), desired, depth))
+            for i in range(desired - len(active)):
+                self.spawn(self._add_worker(group))
+        elif desired < len(active):
+            # scale down gently, one worker at a time
+            worker = active[-1]
+            self._log.info("Scaling %s down from %d to %d workers"
+                           " (%d messages waiting)" % (
+                               group.name, len(active), len(active) - 1,
+                               depth))
+            self.retire(worker)
+
+    def retire(self, worker):
+        """Stop `worker' after it finishes messages it is processing."""
+        worker.retiring = True
+        if worker.pid is None:
+            self.workers.remove(worker)
+            return
+        try:
+            os.kill(worker.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def _handle_stop(self, signum, frame):
+        self._log.info("Got %s, stopping." % _signals.get(signum, signum))
+        self._stopping = True
+        self.signal_children(signal.SIGTERM)
+
+    def _handle_restart(self, signum, frame):
+        self._restart_requested = True
+
+    def _handle_usr1(self, signum, frame):
+        self.signal_children(signal.SIGUSR1)
+
+    def signal_children(self, signum):
+        for worker in self.children():
+            try:
+                os.kill(worker.pid, signum)
+            except OSError:
+                pass
+
+    def restart_all(self):
+        self._log.info("Restarting all children.")
+        for worker in self.children():
+            if worker.retiring:
+                continue
+            worker.restarting = True
+            worker.respawn_delay = 0
+        self.signal_children(signal.SIGTERM)
+
+    def reap(self):
+        """Collect exited children and schedule their respawns."""
+        by_pid = dict((w.pid, w) for w in self.children())
+        while by_pid:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if not pid:
+                return
+            worker = by_pid.pop(pid, None)
+            if worker is None:
+                continue
+            self.child_exited(worker, status)
+
+    def child_exited(self, worker, status):
+        uptime = time.time() - worker.started
+        worker.pid = None
+        clean = os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+        if self._stopping:
+            self._log.info("Child %s exited: %s" % (
+                worker, status_string(status)))
+            return
+
+        if worker.retiring:
+            self._log.info("Child %s retired: %s" % (
+                worker, status_string(status)))
+            self.workers.remove(worker)
+            return
+
+        if worker.restarting:
+            worker.restarting = False
+            self._log.info("Child %s exited for restart: %s" % (
+                worker, status_string(status)))
+            worker.respawn_at = time.time()
+            return
+
+        if clean:
+            processed = worker.processed.value
+            if worker.remaining is not None:
+                worker.remaining -= processed
+                if worker.remaining <= 0:
+                    self._log.info("Child %s processed its message limit."
+                                   % worker)
+                    return
+            if worker.child_limit is None:
+                self._log.info("Child %s finished." % worker)
+            elif processed >= worker.child_limit:
+                self._log.info("Recycling child %s." % worker)
+                worker.respawn_delay = 0
+                worker.respawn_at = time.time()
+            else:
+                # stopped early, e.g. by a SIGTERM not sent by us
+                self._log.info("Child %s exited after %d of %d messages."
+                               % (worker, processed, worker.child_limit))
+                self._schedule_respawn(worker, uptime)
+            return
+
+        self._log.error("Child %s exited: %s" % (
+            worker, status_string(status)))
+        self._schedule_respawn(worker, uptime)
+
+    def _schedule_respawn(self, worker, uptime):
+        if uptime < MIN_UPTIME:
+            worker.respawn_delay = min(
+                max(worker.respawn_delay * 2, 1), MAX_RESPAWN_DELAY)
+        else:
+            worker.respawn_delay = 0
+        if worker.respawn_delay:
+            self._log.warning("Child %s is crashing, respawning in %d seconds"
+                              % (worker, worker.respawn_delay))
+        worker.respawn_at = time.time() + worker.respawn_delay
+
+    def respawn_due(self):
+        now = time.time()
+        for worker in self.workers:
+            if worker.respawn_at is not None and worker.respawn_at <= now:
+                self.spawn(worker)
+
+    def spawn(self, worker):
+        worker.respawn_at = None
+        worker.child_limit = worker.next_child_limit()
+        worker.processed.value = 0
+        worker.started = time.time()
+        pid = os.fork()
+        if pid:                         # parent
+            worker.pid = pid
+            self._log.info("Forked %d for %s" % (pid, worker))
+            return pid
+        # child
+        metrics.process_started(worker.started)
+        self._run_child(worker)
+
+    def _run_child(self, worker):
+        status = 0
+        _log = logging.getLogger(
+            'django_sqs.runreceiver.%s' % worker.group.name)
+        _log.addHandler(_NullHandler())
+        try:
+            # master process takes care of stopping and restarting
+            # us with SIGTERM
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            _log.info("Start receiving.")
+            processed = worker.group.target(worker.child_limit)
+            if processed is None:
+                processed = worker.child_limit or 0
+            worker.processed.value = processed
+        except SystemExit, e:
+            if isinstance(e.code, int):
+                status = e.code
+            elif e.code:
+                status = 1
+        except:
+            _log.exception("Receiver %s crashed." % worker)
+            status = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
@@ -0,0 +1,103 @@
+"""Tests of django_sqs, run with `manage.py test django_sqs'.
+
+Queues are kept in memory (see `transports.local'), so no SQS access
+is needed.
+"""
+import threading
+import time
+import unittest
+
+from message import JSONMessage
+import metrics
+import registered_queue
+from registered_queue import RegisteredQueue
+import transports
+from transports.local import MemoryTransport
+
+
+class QueueTestCase(unittest.TestCase):
+    """Test case with in-memory queues and metrics."""
+
+    def setUp(self):
+        self._saved_transport = transports.set_transport(MemoryTransport())
+        self._saved_collector = metrics.get_collector()
+        self.collector = metrics.InProcessCollector()
+        metrics.set_collector(self.collector)
+
+    def tearDown(self):
+        transports.set_transport(self._saved_transport)
+        metrics.set_collector(self._saved_collector)
+
+    def counter(self, q, name):
+        counters = self.collector.summary()['counters']
+        return counters.get('%s.%s' % (metrics.queue_name(q), name), 0)
+
+
+class ThreadTimeoutTest(QueueTestCase):
+
+    def test_blocking_receiver_in_thread(self):
+        # Exception of a thread's timeout reaches a receiver blocked in
+        # a C call only after the call returns, somewhere in the code
+        # that follows; the message has to fail all the same, and the
+        # thread has to go on receiving.  Timer firing while receiver
+        # is returning from the call must not make a difference.
+        handled = []
+
+        def receiver(message):
+            handled.append(message.get_body())
+            if message.get_body() == 'block':
+                time.sleep(2)
+
+        closed = []
+        rq = RegisteredQueue('test_timeout', receiver, timeout=1,
+                             close_database=True, wait_time_seconds=0,
+                             outbox=False)
+        q = rq.get_queue()
+        rq.send(body='block')
+        rq.send(body='quick')
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(rq.receive_loop(message_limit=2)))
+        saved = registered_queue.close_connections
+        registered_queue.close_connections = lambda: closed.append(True)
+        try:
+            thread.start()
+            thread.join(10)
+        finally:
+            registered_queue.close_connections = saved
+        self.assertFalse(thread.isAlive())
+        self.assertEqual(result, [2])
+        self.assertEqual(handled, ['block', 'quick'])
+        self.assertEqual(self.counter(q, 'failed'), 1)
+        self.assertEqual(self.counter(q, 'processed'), 1)
+        # cleaning up after receiver wasn't cut short
+        self.assertEqual(closed, [True, True])
+
+
+class DeadLetterTest(QueueTestCase):
+
+    def test_dead_lettered_message_decodes(self):
+        def receiver(message):
+            raise ValueError("failing on purpose")
+
+        rq = RegisteredQueue('test_dlq', receiver, message_class=JSONMessage,
+                             max_attempts=1, dead_letter='dead',
+                             wait_time_seconds=0, outbox=False)
+        # long enough to be compressed
+        body = {'data': 'x' * 2000}
+        m = JSONMessage()
+        m.set_body(body)
+        m.message_attributes['origin'] = {
+            'data_type': 'String', 'string_value': 'tests'}
+        rq.send(m)
+        self.assertEqual(rq.receive_loop(message_limit=1), 1)
+
+        q = rq.get_queue()
+        dlq = rq.get_queue('dead')
+        self.assertEqual(self.counter(q, 'dead_lettered'), 1)
+        self.assertEqual(q.get_messages(1), [])
+        mm = dlq.get_messages(1, message_attributes=['All'])
+        self.assertEqual(len(mm), 1)
+        self.assertEqual(mm[0].get_body(), body)
+        self.assertEqual(mm[0].message_attributes['origin']['string_value'],
+                         'tests')
@@ -0,0 +1,167 @@
+"""Rate limits and concurrency caps of receivers, shared by processes.
+
+A queue registered with `rate_limit' (messages per second, with
+bursts of up to `rate_burst' messages) or `max_in_flight' (messages
+processed at a time) doesn't fetch more messages than its throttle
+allows: receive loop waits instead, so messages stay in queue,
+available to other hosts.  Limits apply to all processes of a host
+receiving from the queue (and its suffixes): their shared state is
+kept in a small file in SQS_THROTTLE_DIRECTORY, locked with flock().
+
+Messages being processed by a process that died are not counted after
+it is gone.
+"""
+import errno
+import fcntl
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import django.utils.simplejson as json
+
+from django.conf import settings
+
+THROTTLE_DIRECTORY = getattr(
+    settings, 'SQS_THROTTLE_DIRECTORY',
+    os.path.join(tempfile.gettempdir(), 'django_sqs-throttle'))
+
+# How often a process waiting for a free in-flight slot checks again
+IN_FLIGHT_POLL = 0.1
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class Throttle(object):
+    """Token bucket and in-flight cap for queue named `name'.
+
+    `acquire()' permits to fetch some messages, and `release()' gives
+    back the in-flight slots when they have been processed.
+    """
+
+    def __init__(self, name, rate=None, burst=None, max_in_flight=None,
+                 directory=None):
+        if not rate and not max_in_flight:
+            raise ValueError("throttle needs rate or max_in_flight")
+        if rate is not None and rate <= 0:
+            raise ValueError("rate must be positive, not %r" % rate)
+        if max_in_flight is not None and max_in_flight < 1:
+            raise ValueError("max_in_flight must be positive, not %r"
+                             % max_in_flight)
+        self.name = name
+        self.rate = rate
+        self.burst = burst or (rate and max(rate, 1))
+        self.max_in_flight = max_in_flight
+        self.path = os.path.join(directory or THROTTLE_DIRECTORY,
+                                 '%s.throttle' % name)
+        self._fd = None
+        self._pid = None
+        # flock() doesn't exclude threads sharing a file descriptor
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # a descriptor inherited from parent shares its lock
+        if self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            if self._fd is not None:
+                os.close(self._fd)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+            self._pid = os.getpid()
+        return self._fd
+
+    def _update(self, update):
+        """Call `update(state, now)' with state locked, save and return it."""
+        with self._lock:
+            fd = self._open()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                os.lseek(fd, 0, os.SEEK_SET)
+                data = os.read(fd, 65536)
+                now = time.time()
+                try:
+                    state = json.loads(data)
+                except ValueError:
+                    state = {'tokens': self.burst, 'updated': now,
+                             'in_flight': {}}
+                rv = update(state, now)
+                data = json.dumps(state)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, data)
+                os.ftruncate(fd, len(data))
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        return rv
+
+    def _acquire(self, state, now, n):
+        granted = n
+        if self.rate:
+            if state.get('tokens') is None:
+                # state was saved by a throttle without rate limit
+                state['tokens'], state['updated'] = self.burst, now
+            tokens = min(self.burst, state['tokens'] +
+                         (now - state['updated']) * self.rate)
+            state['tokens'], state['updated'] = tokens, now
+            granted = min(granted, int(tokens))
+        if self.max_in_flight:
+            in_flight = state['in_flight']
+            for pid in in_flight.keys():
+                if not _alive(int(pid)):
+                    del in_flight[pid]
+            granted = min(granted,
+                          self.max_in_flight - sum(in_flight.values()))
+        if granted <= 0:
+            if self.rate and state['tokens'] < 1:
+                return 0, (1 - state['tokens']) / self.rate
+            return 0, IN_FLIGHT_POLL
+        if self.rate:
+            state['tokens'] -= granted
+        if self.max_in_flight:
+            pid = str(os.getpid())
+            state['in_flight'][pid] = state['in_flight'].get(pid, 0) + granted
+        return granted, 0
+
+    def acquire(self, n):
+        """Permit fetching up to `n' messages.
+
+        Returns (granted, wait) pair: number of messages that may be
+        fetched, and if none, seconds to wait before trying again.
+        """
+        return self._update(lambda state, now: self._acquire(state, now, n))
+
+    def _release(self, state, now, n, unused):
+        if self.max_in_flight:
+            pid = str(os.getpid())
+            count = state['in_flight'].get(pid, 0) - n
+            if count > 0:
+                state['in_flight'][pid] = count
+            else:
+                state['in_flight'].pop(pid, None)
+        if unused and self.rate:
+            state['tokens'] = min(self.burst, state['tokens'] + n)
+
+    def release(self, n, unused=False):
+        """Give back in-flight slots of `n' messages.
+
+        With `unused', messages have not been fetched at all (e.g.
+        queue had fewer of them), and their tokens are given back, too.
+        """
+        if n <= 0 or not (self.max_in_flight or unused):
+            return
+        self._update(lambda state, now: self._release(state, now, n, unused))
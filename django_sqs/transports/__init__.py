@@ -0,0 +1,81 @@
+"""Transports connecting registered queues to a queue service.
+
+The transport is chosen with SQS_TRANSPORT setting:
+- 'aws' (default): Amazon SQS, through boto;
+- 'memory': queues kept in memory of the process, see `local';
+- 'sqlite': queues kept in SQLite database SQS_SQLITE_PATH, shared by
+  all processes using it, see `local';
+- dotted path of a Transport subclass.
+
+A transport returns queue objects with the interface of boto's
+`boto.sqs.queue.Queue', which is all the rest of django_sqs uses.
+
+Transport module is imported when it is first needed, and its
+settings are checked then.
+"""
+from importlib import import_module
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+TRANSPORT = getattr(settings, 'SQS_TRANSPORT', 'aws')
+
+# FIFO queue names must have this suffix
+FIFO_SUFFIX = '.fifo'
+
+
+class Transport(object):
+    """Opens connections and queues of a queue service."""
+
+    def check_settings(self):
+        """Raise ImproperlyConfigured if settings needed are missing."""
+        pass
+
+    def get_connection(self, region_name=None):
+        """Return connection object for `region_name'."""
+        raise NotImplementedError
+
+    def get_queue(self, queue_name, visibility_timeout=None,
+                  region_name=None):
+        """Return queue named `queue_name', creating it if needed."""
+        raise NotImplementedError
+
+    def reset(self):
+        """Forget all connections and cached queues."""
+        pass
+
+
+_transports = {
+    'aws': 'django_sqs.transports.aws.AWSTransport',
+    'memory': 'django_sqs.transports.local.MemoryTransport',
+    'sqlite': 'django_sqs.transports.local.SQLiteTransport',
+    }
+_transport = None
+
+
+def get_transport():
+    """Return the configured transport, loading it if needed."""
+    global _transport
+    if _transport is None:
+        path = _transports.get(TRANSPORT, TRANSPORT)
+        module_name, _, class_name = path.rpartition('.')
+        try:
+            cls = getattr(import_module(module_name), class_name)
+        except (ImportError, AttributeError, ValueError), e:
+            raise ImproperlyConfigured(
+                "Cannot load transport %s: %s" % (TRANSPORT, e))
+        transport = cls()
+        transport.check_settings()
+        _transport = transport
+    return _transport
+
+
+def set_transport(transport):
+    """Replace the transport used from now on (e.g. in tests).
+
+    Queues already opened by registered queues are not affected.
+    Returns the transport used so far (None if none was loaded yet).
+    """
+    global _transport
+    previous, _transport = _transport, transport
+    return previous
@@ -0,0 +1,172 @@
+"""Amazon SQS transport.
+
+Connections are shared by all registered queues of a process, one per
+region.  They are dropped automatically in a forked child, which opens
+its own.  Queue URLs, once resolved, are kept for the lifetime of the
+process and inherited by forked children, so that a queue name is
+resolved with a CreateQueue request only once.
+"""
+import os
+import threading
+
+import boto.sqs
+import boto.sqs.connection
+import boto.sqs.batchresults
+import boto.sqs.message
+import boto.sqs.queue
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from django_sqs.app_settings import AWS_REGION
+from django_sqs.transports import FIFO_SUFFIX, Transport
+
+if settings.DEBUG:
+    boto_debug = 1
+else:
+    boto_debug=0
+
+
+ATTRIBUTE_VALUES = (
+    ('data_type', 'DataType'),
+    ('string_value', 'StringValue'),
+    ('binary_value', 'BinaryValue'),
+    ('string_list_value', 'StringListValue'),
+    ('binary_list_value', 'BinaryListValue'),
+    )
+
+
+def _message_params(params, base, body, message_attributes,
+                    group_id, deduplication_id):
+    """Add SendMessage parameters of a FIFO queue message to `params'."""
+    params[base + 'MessageBody'] = body
+    params[base + 'MessageGroupId'] = group_id
+    if deduplication_id:
+        params[base + 'MessageDeduplicationId'] = deduplication_id
+    for j, name in enumerate(sorted(message_attributes or {})):
+        attribute = message_attributes[name]
+        prefix = '%sMessageAttribute.%d.' % (base, j + 1)
+        params[prefix + 'Name'] = name
+        for key, param in ATTRIBUTE_VALUES:
+            if key in attribute:
+                params[prefix + 'Value.' + param] = attribute[key]
+
+
+class FifoQueue(boto.sqs.queue.Queue):
+    """boto Queue sending messages with MessageGroupId and
+    MessageDeduplicationId, which boto doesn't support.
+
+    `write()' takes them from message's `group_id' and
+    `deduplication_id' attributes, `write_batch()' from 5th and 6th
+    elements of entries.  Per-message delays are not supported by
+    FIFO queues and are ignored.
+    """
+
+    def write(self, message, delay_seconds=None):
+        params = {}
+        _message_params(params, '', message.get_body_encoded(),
+                        message.message_attributes,
+                        message.group_id,
+                        getattr(message, 'deduplication_id', None))
+        rv = self.connection.get_object(
+            'SendMessage', params, boto.sqs.message.Message, self.id,
+            verb='POST')
+        message.id = rv.id
+        message.md5 = rv.md5
+        return message
+
+    def write_batch(self, messages):
+        params = {}
+        for i, entry in enumerate(messages):
+            base = 'SendMessageBatchRequestEntry.%d.' % (i + 1)
+            params[base + 'Id'] = entry[0]
+            _message_params(params, base, entry[1], entry[3], entry[4],
+                            entry[5] if len(entry) > 5 else None)
+        return self.connection.get_object(
+            'SendMessageBatch', params, boto.sqs.batchresults.BatchResults,
+            self.id, verb='POST')
+
+
+class AWSTransport(Transport):
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+        self._connections = {}          # region name -> SQSConnection
+        self._queue_urls = {}           # (region name, queue name) -> URL
+        self._regions = None
+
+    def check_settings(self):
+        if not getattr(settings, 'AWS_ACCESS_KEY_ID', None):
+            raise ImproperlyConfigured('Missing setting "AWS_ACCESS_KEY_ID"')
+        if not getattr(settings, 'AWS_SECRET_ACCESS_KEY', None):
+            raise ImproperlyConfigured(
+                'Missing setting "AWS_SECRET_ACCESS_KEY"')
+
+    def _check_fork(self):
+        # HTTP connections must not be shared with a forked process
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._connections.clear()
+
+    def get_region(self, region_name):
+        """Return boto's RegionInfo for `region_name', or None if unknown."""
+        if self._regions is None:
+            self._regions = dict((r.name, r) for r in boto.sqs.regions())
+        return self._regions.get(region_name)
+
+    def get_connection(self, region_name=None):
+        """Return SQS connection for `region_name' (default is AWS_REGION)."""
+        region_name = region_name or AWS_REGION
+        with self._lock:
+            self._check_fork()
+            if region_name not in self._connections:
+                self._connections[region_name] = \
+                    boto.sqs.connection.SQSConnection(
+                        settings.AWS_ACCESS_KEY_ID,
+                        settings.AWS_SECRET_ACCESS_KEY,
+                        region=self.get_region(region_name),
+                        debug=boto_debug)
+            return self._connections[region_name]
+
+    def get_queue(self, queue_name, visibility_timeout=None,
+                  region_name=None):
+        """Return boto Queue object for queue named `queue_name'.
+
+        Queue is created if it doesn't exist yet.  Its URL is cached,
+        so the CreateQueue request is sent only the first time.  A
+        name ending with `.fifo' is a FIFO queue (see FifoQueue).
+        """
+        region_name = region_name or AWS_REGION
+        connection = self.get_connection(region_name)
+        fifo = queue_name.endswith(FIFO_SUFFIX)
+        key = (region_name, queue_name)
+        url = self._queue_urls.get(key)
+        if url is not None:
+            if fifo:
+                return FifoQueue(connection, url)
+            return boto.sqs.queue.Queue(connection, url)
+        if fifo:
+            q = self.create_fifo_queue(connection, queue_name,
+                                       visibility_timeout)
+        else:
+            q = connection.create_queue(queue_name, visibility_timeout)
+        with self._lock:
+            self._queue_urls[key] = q.url
+        return q
+
+    def create_fifo_queue(self, connection, queue_name,
+                          visibility_timeout=None):
+        params = {'QueueName': queue_name,
+                  'Attribute.1.Name': 'FifoQueue',
+                  'Attribute.1.Value': 'true'}
+        if visibility_timeout:
+            params['Attribute.2.Name'] = 'VisibilityTimeout'
+            params['Attribute.2.Value'] = int(visibility_timeout)
+        return connection.get_object('CreateQueue', params, FifoQueue)
+
+    def reset(self):
+        with self._lock:
+            self._connections.clear()
+            self._queue_urls.clear()
+            self._regions = None
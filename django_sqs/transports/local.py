@@ -0,0 +1,754 @@
+"""Local queues, for tests and benchmarks without network access or
+AWS credentials.
+
+MemoryTransport keeps queues in memory of the process; they are not
+shared with other processes, including worker processes forked by
+runreceiver.  SQLiteTransport keeps them in SQLite database
+SQS_SQLITE_PATH, shared by all processes using it.
+
+Both model what django_sqs relies on: visibility timeouts, receive
+counts, delayed messages, receipt handles that change with every
+receive, batch requests with per-entry errors, long polling and
+limits on message size and batch length.  Errors are raised as boto's
+SQSError with SQS error codes.  Like standard SQS queues, messages are
+received roughly in the order they became visible.
+"""
+from contextlib import contextmanager
+import hashlib
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import django.utils.simplejson as json
+
+import boto.exception
+import boto.sqs.batchresults
+import boto.sqs.message
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from django_sqs.transports import Transport
+
+# Database file of SQLiteTransport
+SQLITE_PATH = getattr(settings, 'SQS_SQLITE_PATH', None)
+
+# How often SQLite queues are checked while long polling
+SQLITE_POLL_INTERVAL = 0.05
+
+# SQS defaults and limits
+DEFAULT_VISIBILITY_TIMEOUT = 30
+MAX_VISIBILITY_TIMEOUT = 12 * 60 * 60
+MAX_DELAY_SECONDS = 15 * 60
+MAX_WAIT_TIME_SECONDS = 20
+MAX_MESSAGES = 10
+MAX_BATCH_ENTRIES = 10
+MAX_MESSAGE_SIZE = 256 * 1024
+
+
+def _error(code, message):
+    e = boto.exception.SQSError(400, 'Bad Request')
+    e.error_code = code
+    e.message = message
+    return e
+
+
+def _names(names):
+    """Set of attribute names requested with `names' (a string or list)."""
+    if not names:
+        return set()
+    if isinstance(names, basestring):
+        return set([names])
+    return set(names)
+
+
+def _md5(body):
+    return hashlib.md5(body.encode('utf-8')).hexdigest()
+
+
+def _receipt(message_id, receive_count):
+    return '%s:%d' % (message_id, receive_count)
+
+
+def _parse_receipt(receipt):
+    """Return (message id, receive count) of a receipt handle."""
+    try:
+        message_id, receive_count = receipt.rsplit(':', 1)
+        return message_id, int(receive_count)
+    except (AttributeError, ValueError):
+        raise _error('ReceiptHandleIsInvalid',
+                     "The receipt handle %r is not valid." % (receipt, ))
+
+
+class _Message(object):
+    """A message stored in a local queue."""
+    __slots__ = ('id', 'body', 'message_attributes', 'sent', 'visible_at',
+                 'receive_count', 'first_receive', 'seq')
+
+    def __init__(self, id, body, message_attributes, sent, visible_at,
+                 receive_count=0, first_receive=None, seq=None):
+        self.id = id
+        self.body = body
+        self.message_attributes = message_attributes
+        self.sent = sent
+        self.visible_at = visible_at
+        self.receive_count = receive_count
+        self.first_receive = first_receive
+        self.seq = seq
+
+    def copy(self):
+        return _Message(*[getattr(self, name) for name in self.__slots__])
+
+    @property
+    def receipt(self):
+        return _receipt(self.id, self.receive_count)
+
+
+class _MemoryQueue(object):
+    def __init__(self, visibility_timeout):
+        self.visibility_timeout = visibility_timeout
+        self.created = time.time()
+        self.messages = {}              # id -> _Message
+        # (visible_at, seq, id, receive_count) entries; entries of
+        # deleted messages, or outdated by a receive or visibility
+        # change, are skipped when popped
+        self.heap = []
+
+
+class MemoryStore(object):
+    """Keeps queues in a dictionary."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._seq = itertools.count()
+
+    def _queue(self, name):
+        try:
+            return self._queues[name]
+        except KeyError:
+            raise _error('AWS.SimpleQueueService.NonExistentQueue',
+                         "The specified queue %s does not exist." % name)
+
+    def _push(self, q, m):
+        heapq.heappush(q.heap, (m.visible_at, m.seq, m.id, m.receive_count))
+
+    def create_queue(self, name, visibility_timeout):
+        with self._cond:
+            if name not in self._queues:
+                self._queues[name] = _MemoryQueue(visibility_timeout)
+
+    def get_visibility_timeout(self, name):
+        with self._cond:
+            return self._queue(name).visibility_timeout
+
+    def set_visibility_timeout(self, name, visibility_timeout):
+        with self._cond:
+            self._queue(name).visibility_timeout = visibility_timeout
+
+    def get_created(self, name):
+        with self._cond:
+            return self._queue(name).created
+
+    def send(self, name, entries):
+        """Store (body, delay_seconds, message_attributes) `entries'.
+
+        Returns list of new messages' ids."""
+        now = time.time()
+        ids = []
+        with self._cond:
+            q = self._queue(name)
+            for body, delay, message_attributes in entries:
+                m = _Message(uuid.uuid4().hex, body, message_attributes,
+                             now, now + (delay or 0), seq=self._seq.next())
+                q.messages[m.id] = m
+                self._push(q, m)
+                ids.append(m.id)
+            self._cond.notify_all()
+        return ids
+
+    def receive(self, name, num_messages, visibility_timeout):
+        """Return copies of up to `num_messages' visible messages, and
+        hide them for `visibility_timeout' seconds."""
+        now = time.time()
+        rv = []
+        with self._cond:
+            q = self._queue(name)
+            while q.heap and len(rv) < num_messages and q.heap[0][0] <= now:
+                visible_at, seq, message_id, receive_count = \
+                    heapq.heappop(q.heap)
+                m = q.messages.get(message_id)
+                if m is None or m.receive_count != receive_count \
+                        or m.visible_at != visible_at:
+                    continue
+                m.receive_count += 1
+                if m.first_receive is None:
+                    m.first_receive = now
+                m.visible_at = now + visibility_timeout
+                self._push(q, m)
+                rv.append(m.copy())
+        return rv
+
+    def delete(self, name, receipts):
+        """Delete messages; returns list of error codes (None if deleted)."""
+        with self._cond:
+            q = self._queue(name)
+            for receipt in receipts:
+                message_id, receive_count = _parse_receipt(receipt)
+                m = q.messages.get(message_id)
+                # like SQS, a stale receipt handle doesn't delete the
+                # message, and deleting a deleted message is no error
+                if m is not None and m.receive_count == receive_count:
+                    del q.messages[message_id]
+        return [None] * len(receipts)
+
+    def change_visibility(self, name, changes):
+        """Apply (receipt, timeout) `changes'; returns list of error
+        codes (None if changed)."""
+        now = time.time()
+        rv = []
+        with self._cond:
+            q = self._queue(name)
+            for receipt, timeout in changes:
+                message_id, receive_count = _parse_receipt(receipt)
+                m = q.messages.get(message_id)
+                if m is None or m.receive_count != receive_count:
+                    rv.append('ReceiptHandleIsInvalid')
+                elif m.visible_at <= now:
+                    rv.append('AWS.SimpleQueueService.MessageNotInflight')
+                else:
+                    m.visible_at = now + timeout
+                    self._push(q, m)
+                    rv.append(None)
+            self._cond.notify_all()
+        return rv
+
+    def counts(self, name):
+        """Return numbers of (visible, in flight, delayed) messages."""
+        now = time.time()
+        visible = in_flight = delayed = 0
+        with self._cond:
+            for m in self._queue(name).messages.itervalues():
+                if m.visible_at <= now:
+                    visible += 1
+                elif m.receive_count:
+                    in_flight += 1
+                else:
+                    delayed += 1
+        return visible, in_flight, delayed
+
+    def purge(self, name):
+        """Delete all messages, return their number."""
+        with self._cond:
+            q = self._queue(name)
+            n = len(q.messages)
+            q.messages.clear()
+            del q.heap[:]
+        return n
+
+    def wait(self, name, timeout):
+        """Wait up to `timeout' seconds for a message to become visible."""
+        with self._cond:
+            q = self._queue(name)
+            if q.heap:
+                timeout = min(timeout, max(q.heap[0][0] - time.time(), 0))
+            if timeout > 0:
+                self._cond.wait(timeout)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS django_sqs_queue (
+    name TEXT PRIMARY KEY,
+    visibility_timeout INTEGER NOT NULL,
+    created REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS django_sqs_message (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    queue TEXT NOT NULL,
+    body TEXT NOT NULL,
+    message_attributes TEXT,
+    sent REAL NOT NULL,
+    visible_at REAL NOT NULL,
+    receive_count INTEGER NOT NULL DEFAULT 0,
+    first_receive REAL);
+CREATE INDEX IF NOT EXISTS django_sqs_message_visible
+    ON django_sqs_message (queue, visible_at, seq);
+"""
+
+
+class SQLiteStore(object):
+    """Keeps queues in SQLite database at `path'.
+
+    Each thread of each process uses its own connection.  Receives
+    are done in IMMEDIATE transactions, so that a message is never
+    received by two processes at the same time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._pid = None
+        self._local = None
+
+    def _db(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._local = threading.local()
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SQLITE_SCHEMA)
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _queue_row(self, db, name, columns):
+        row = db.execute('SELECT %s FROM django_sqs_queue WHERE name = ?'
+                         % columns, (name, )).fetchone()
+        if row is None:
+            raise _error('AWS.SimpleQueueService.NonExistentQueue',
+                         "The specified queue %s does not exist." % name)
+        return row
+
+    def create_queue(self, name, visibility_timeout):
+        with self._transaction() as db:
+            db.execute('INSERT OR IGNORE INTO django_sqs_queue'
+                       ' (name, visibility_timeout, created)'
+                       ' VALUES (?, ?, ?)',
+                       (name, visibility_timeout, time.time()))
+
+    def get_visibility_timeout(self, name):
+        return self._queue_row(self._db(), name, 'visibility_timeout')[0]
+
+    def set_visibility_timeout(self, name, visibility_timeout):
+        with self._transaction() as db:
+            self._queue_row(db, name, 'name')
+            db.execute('UPDATE django_sqs_queue SET visibility_timeout = ?'
+                       ' WHERE name = ?', (visibility_timeout, name))
+
+    def get_created(self, name):
+        return self._queue_row(self._db(), name, 'created')[0]
+
+    def send(self, name, entries):
+        now = time.time()
+        ids = []
+        with self._transaction() as db:
+            self._queue_row(db, name, 'name')
+            for body, delay, message_attributes in entries:
+                message_id = uuid.uuid4().hex
+                db.execute('INSERT INTO django_sqs_message'
+                           ' (id, queue, body, message_attributes, sent,'
+                           ' visible_at) VALUES (?, ?, ?, ?, ?, ?)',
+                           (message_id, name, body, message_attributes,
+                            now, now + (delay or 0)))
+                ids.append(message_id)
+        return ids
+
+    def receive(self, name, num_messages, visibility_timeout):
+        now = time.time()
+        rv = []
+        with self._transaction() as db:
+            self._queue_row(db, name, 'name')
+            rows = db.execute(
+                'SELECT id, body, message_attributes, sent, visible_at,'
+                ' receive_count, first_receive, seq FROM django_sqs_message'
+                ' WHERE queue = ? AND visible_at <= ?'
+                ' ORDER BY visible_at, seq LIMIT ?',
+                (name, now, num_messages)).fetchall()
+            for row in rows:
+                m = _Message(*row)
+                m.receive_count += 1
+                if m.first_receive is None:
+                    m.first_receive = now
+                m.visible_at = now + visibility_timeout
+                db.execute('UPDATE django_sqs_message SET receive_count = ?,'
+                           ' first_receive = ?, visible_at = ? WHERE id = ?',
+                           (m.receive_count, m.first_receive, m.visible_at,
+                            m.id))
+                rv.append(m)
+        return rv
+
+    def delete(self, name, receipts):
+        with self._transaction() as db:
+            for receipt in receipts:
+                message_id, receive_count = _parse_receipt(receipt)
+                db.execute('DELETE FROM django_sqs_message WHERE id = ?'
+                           ' AND queue = ? AND receive_count = ?',
+                           (message_id, name, receive_count))
+        return [None] * len(receipts)
+
+    def change_visibility(self, name, changes):
+        now = time.time()
+        rv = []
+        with self._transaction() as db:
+            for receipt, timeout in changes:
+                message_id, receive_count = _parse_receipt(receipt)
+                row = db.execute(
+                    'SELECT receive_count, visible_at FROM django_sqs_message'
+                    ' WHERE id = ? AND queue = ?',
+                    (message_id, name)).fetchone()
+                if row is None or row[0] != receive_count:
+                    rv.append('ReceiptHandleIsInvalid')
+                elif row[1] <= now:
+                    rv.append('AWS.SimpleQueueService.MessageNotInflight')
+                else:
+                    db.execute('UPDATE django_sqs_message SET visible_at = ?'
+                               ' WHERE id = ?', (now + timeout, message_id))
+                    rv.append(None)
+        return rv
+
+    def counts(self, name):
+        now = time.time()
+        db = self._db()
+        self._queue_row(db, name, 'name')
+        return db.execute(
+            'SELECT'
+            ' COALESCE(SUM(visible_at <= ?), 0),'
+            ' COALESCE(SUM(visible_at > ? AND receive_count > 0), 0),'
+            ' COALESCE(SUM(visible_at > ? AND receive_count = 0), 0)'
+            ' FROM django_sqs_message WHERE queue = ?',
+            (now, now, now, name)).fetchone()
+
+    def purge(self, name):
+        with self._transaction() as db:
+            self._queue_row(db, name, 'name')
+            return db.execute('DELETE FROM django_sqs_message'
+                              ' WHERE queue = ?', (name, )).rowcount
+
+    def wait(self, name, timeout):
+        time.sleep(min(timeout, SQLITE_POLL_INTERVAL))
+
+
+class LocalQueue(object):
+    """Queue of a local transport, with the interface of boto's Queue."""
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        self.url = 'local:///%s' % name
+        self.message_class = boto.sqs.message.Message
+
+    def __repr__(self):
+        return 'LocalQueue(%s)' % self.name
+
+    @property
+    def store(self):
+        return self.connection.store
+
+    def set_message_class(self, message_class):
+        self.message_class = message_class
+
+    def _check_body(self, body):
+        if isinstance(body, str):
+            try:
+                body = body.decode('utf-8')
+            except UnicodeDecodeError:
+                raise _error('InvalidMessageContents',
+                             "Message body is not valid UTF-8")
+        size = len(body.encode('utf-8'))
+        if size > MAX_MESSAGE_SIZE:
+            raise _error('InvalidParameterValue',
+                         "Message must be shorter than %d bytes, it is %d"
+                         % (MAX_MESSAGE_SIZE, size))
+        return body
+
+    def _check_delay(self, delay_seconds):
+        if not 0 <= int(delay_seconds or 0) <= MAX_DELAY_SECONDS:
+            raise _error('InvalidParameterValue',
+                         "DelaySeconds must be between 0 and %d"
+                         % MAX_DELAY_SECONDS)
+        return int(delay_seconds or 0)
+
+    def _check_timeout(self, visibility_timeout):
+        if not 0 <= int(visibility_timeout) <= MAX_VISIBILITY_TIMEOUT:
+            raise _error('InvalidParameterValue',
+                         "VisibilityTimeout must be between 0 and %d"
+                         % MAX_VISIBILITY_TIMEOUT)
+        return int(visibility_timeout)
+
+    def _check_batch(self, entries):
+        if not entries:
+            raise _error('AWS.SimpleQueueService.EmptyBatchRequest',
+                         "There should be at least one entry in the request.")
+        if len(entries) > MAX_BATCH_ENTRIES:
+            raise _error(
+                'AWS.SimpleQueueService.TooManyEntriesInBatchRequest',
+                "Maximum number of entries per request are %d."
+                % MAX_BATCH_ENTRIES)
+        ids = [entry[0] for entry in entries]
+        if len(set(ids)) != len(ids):
+            raise _error('AWS.SimpleQueueService.BatchEntryIdsNotDistinct',
+                         "Batch entry ids must be distinct.")
+
+    def _result(self, entry_id, **kwargs):
+        result = boto.sqs.batchresults.ResultEntry(id=entry_id)
+        result.update(kwargs)
+        return result
+
+    def _batch_error(self, entry_id, code, message=None, sender_fault=True):
+        return self._result(entry_id, error_code=code,
+                            error_message=message or code,
+                            sender_fault=sender_fault and 'true' or 'false')
+
+    def get_attributes(self, attributes='All'):
+        visible, in_flight, delayed = self.store.counts(self.name)
+        rv = {
+            'ApproximateNumberOfMessages': str(visible),
+            'ApproximateNumberOfMessagesNotVisible': str(in_flight),
+            'ApproximateNumberOfMessagesDelayed': str(delayed),
+            'VisibilityTimeout': str(
+                self.store.get_visibility_timeout(self.name)),
+            'CreatedTimestamp': str(int(self.store.get_created(self.name))),
+            'DelaySeconds': '0',
+            'MaximumMessageSize': str(MAX_MESSAGE_SIZE),
+            'ReceiveMessageWaitTimeSeconds': '0',
+            }
+        names = _names(attributes)
+        if 'All' in names:
+            return rv
+        return dict((k, v) for k, v in rv.items() if k in names)
+
+    def set_attribute(self, attribute, value):
+        if attribute != 'VisibilityTimeout':
+            raise _error('InvalidAttributeName',
+                         "Unsupported attribute %s" % attribute)
+        self.store.set_visibility_timeout(self.name,
+                                          self._check_timeout(value))
+        return True
+
+    def get_timeout(self):
+        return self.store.get_visibility_timeout(self.name)
+
+    def set_timeout(self, visibility_timeout):
+        return self.set_attribute('VisibilityTimeout', visibility_timeout)
+
+    def count(self, page_size=10, vtimeout=10):
+        return self.store.counts(self.name)[0]
+
+    def purge(self):
+        self.store.purge(self.name)
+        return True
+
+    def clear(self, page_size=10, vtimeout=10):
+        return self.store.purge(self.name)
+
+    def new_message(self, body='', **kwargs):
+        m = self.message_class(self, body, **kwargs)
+        m.queue = self
+        return m
+
+    def write(self, message, delay_seconds=None):
+        body = self._check_body(message.get_body_encoded())
+        [message.id] = self.store.send(self.name, [(
+            body, self._check_delay(delay_seconds),
+            json.dumps(message.message_attributes or {}))])
+        message.md5 = _md5(body)
+        return message
+
+    def write_batch(self, messages):
+        """Send (id, body, delay_seconds[, message_attributes]) entries.
+
+        FIFO queue's group and deduplication ids (5th and 6th
+        elements of entries) are accepted, but ignored.
+        """
+        self._check_batch(messages)
+        rv = boto.sqs.batchresults.BatchResults(self)
+        total = 0
+        valid = []
+        for entry in messages:
+            try:
+                body = self._check_body(entry[1])
+                delay = self._check_delay(entry[2])
+            except boto.exception.SQSError, e:
+                rv.errors.append(self._batch_error(entry[0], e.error_code,
+                                                   e.message))
+                continue
+            total += len(body.encode('utf-8'))
+            attributes = entry[3] if len(entry) > 3 else {}
+            valid.append((entry[0], body, delay,
+                          json.dumps(attributes or {})))
+        if total > MAX_MESSAGE_SIZE:
+            raise _error('AWS.SimpleQueueService.BatchRequestTooLong',
+                         "Batch requests must be shorter than %d bytes"
+                         % MAX_MESSAGE_SIZE)
+        ids = self.store.send(self.name, [entry[1:] for entry in valid])
+        for entry, message_id in zip(valid, ids):
+            rv.results.append(self._result(entry[0], message_id=message_id,
+                                           message_md5=_md5(entry[1])))
+        return rv
+
+    def _message(self, m, attributes, message_attributes):
+        message = self.message_class(self)
+        message.id = m.id
+        message.receipt_handle = m.receipt
+        message.md5 = _md5(m.body)
+        all_attributes = {
+            'SenderId': 'local',
+            'SentTimestamp': str(int(m.sent * 1000)),
+            'ApproximateReceiveCount': str(m.receive_count),
+            'ApproximateFirstReceiveTimestamp':
+                str(int(m.first_receive * 1000)),
+            }
+        for name, value in all_attributes.items():
+            if name in attributes or 'All' in attributes:
+                message.attributes[name] = value
+        if message_attributes:
+            for name, value in json.loads(m.message_attributes or '{}') \
+                    .items():
+                if name in message_attributes \
+                        or message_attributes & set(['All', '.*']):
+                    message.message_attributes[name] = value
+        # decode body like boto does when parsing a response
+        message.set_body(m.body)
+        message.endNode(None)
+        return message
+
+    def get_messages(self, num_messages=1, visibility_timeout=None,
+                     attributes=None, wait_time_seconds=None,
+                     message_attributes=None):
+        if not 1 <= num_messages <= MAX_MESSAGES:
+            raise _error('ReadCountOutOfRange',
+                         "Value %s for parameter MaxNumberOfMessages is"
+                         " invalid, must be between 1 and %d."
+                         % (num_messages, MAX_MESSAGES))
+        if not 0 <= (wait_time_seconds or 0) <= MAX_WAIT_TIME_SECONDS:
+            raise _error('InvalidParameterValue',
+                         "Value %s for parameter WaitTimeSeconds is"
+                         " invalid, must be between 0 and %d."
+                         % (wait_time_seconds, MAX_WAIT_TIME_SECONDS))
+        if visibility_timeout is None:
+            visibility_timeout = self.store.get_visibility_timeout(self.name)
+        visibility_timeout = self._check_timeout(visibility_timeout)
+        deadline = time.time() + (wait_time_seconds or 0)
+        while True:
+            mm = self.store.receive(self.name, num_messages,
+                                    visibility_timeout)
+            remaining = deadline - time.time()
+            if mm or remaining <= 0:
+                break
+            self.store.wait(self.name, remaining)
+        attributes = _names(attributes)
+        message_attributes = _names(message_attributes)
+        return [self._message(m, attributes, message_attributes)
+                for m in mm]
+
+    def read(self, visibility_timeout=None, wait_time_seconds=None,
+             message_attributes=None):
+        mm = self.get_messages(1, visibility_timeout,
+                               wait_time_seconds=wait_time_seconds,
+                               message_attributes=message_attributes)
+        if mm:
+            return mm[0]
+
+    def delete_message(self, message):
+        self.store.delete(self.name, [message.receipt_handle])
+        return True
+
+    def delete_message_batch(self, messages):
+        self._check_batch([(m.id, ) for m in messages])
+        return self._batch(messages, self.store.delete(
+            self.name, [m.receipt_handle for m in messages]))
+
+    def change_message_visibility_batch(self, messages):
+        """Change visibility of (message, visibility_timeout) pairs."""
+        self._check_batch([(m.id, ) for m, timeout in messages])
+        changes = []
+        invalid = {}
+        for m, timeout in messages:
+            try:
+                changes.append((m.receipt_handle,
+                                self._check_timeout(timeout)))
+            except boto.exception.SQSError, e:
+                invalid[m.id] = e
+        errors = self.store.change_visibility(self.name, changes)
+        rv = boto.sqs.batchresults.BatchResults(self)
+        errors = iter(errors)
+        for m, timeout in messages:
+            if m.id in invalid:
+                rv.errors.append(self._batch_error(
+                    m.id, invalid[m.id].error_code, invalid[m.id].message))
+            else:
+                self._add_result(rv, m.id, errors.next())
+        return rv
+
+    def _batch(self, messages, errors):
+        rv = boto.sqs.batchresults.BatchResults(self)
+        for m, error in zip(messages, errors):
+            self._add_result(rv, m.id, error)
+        return rv
+
+    def _add_result(self, rv, entry_id, error):
+        if error is None:
+            rv.results.append(self._result(entry_id))
+        else:
+            rv.errors.append(self._batch_error(entry_id, error))
+
+
+class LocalTransport(Transport):
+    """Transport with queues kept in a store (MemoryStore or SQLiteStore).
+
+    Transport is its own connection object.  Regions are ignored.
+    """
+
+    def __init__(self):
+        self.store = self.make_store()
+
+    def make_store(self):
+        raise NotImplementedError
+
+    def get_connection(self, region_name=None):
+        return self
+
+    def get_queue(self, queue_name, visibility_timeout=None,
+                  region_name=None):
+        self.store.create_queue(
+            queue_name, visibility_timeout or DEFAULT_VISIBILITY_TIMEOUT)
+        return LocalQueue(self, queue_name)
+
+    def change_message_visibility(self, queue, receipt_handle,
+                                  visibility_timeout):
+        [error] = queue.store.change_visibility(
+            queue.name, [(receipt_handle, visibility_timeout)])
+        if error is not None:
+            raise _error(error, error)
+        return True
+
+
+class MemoryTransport(LocalTransport):
+    """Queues kept in memory of the process."""
+
+    def make_store(self):
+        return MemoryStore()
+
+
+class SQLiteTransport(LocalTransport):
+    """Queues kept in SQLite database `path' (SQS_SQLITE_PATH)."""
+
+    def __init__(self, path=None):
+        self.path = path or SQLITE_PATH
+        if not self.path:
+            raise ImproperlyConfigured('Missing setting "SQS_SQLITE_PATH"')
+        super(SQLiteTransport, self).__init__()
+
+    def make_store(self):
+        return SQLiteStore(self.path)
@@ -1,16 +1,18 @@
 import time
 
 from django.http import HttpResponse
-from django.views.decorators.cache import cache_page
 
-import django_sqs
+from django_sqs import status as queue_status
 
-@cache_page(5*60)
 def status(request):
-    """Returns a simple plain text rendering of queue status."""
+    """Returns a simple plain text rendering of queue status.
+
+    With `format=json' GET parameter, returns status as JSON."""
+    statuses = queue_status.get_status()
+    if request.GET.get('format') == 'json':
+        return HttpResponse(queue_status.format_json(statuses),
+                            mimetype='application/json')
     response_text = ['Queue status as of %s GMT\n' % time.strftime("%F %T", time.gmtime())]
-    for label, queue in django_sqs.queues.items():
-        q = queue.get_queue()
-        response_text.append( "%s\t%s" % (label, q.count()) )
+    response_text.extend(queue_status.format_text(statuses))
     
     return HttpResponse('\n'.join(response_text), mimetype='text/plain')
@@ -0,0 +1,238 @@
+import ctypes
+import logging
+import signal
+import sys
+import threading
+
+try:
+    from django.db import connections
+    def _all_connections():
+        return connections.all()
+except ImportError:
+    from django.db import connection
+    def _all_connections():
+        return (connection, )
+
+
+class _NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+
+def close_connections():
+    """Close current thread's database connections."""
+    for conn in _all_connections():
+        conn.close()
+
+
+def in_main_thread():
+    return isinstance(threading.current_thread(), threading._MainThread)
+
+
+def in_greenlet():
+    """True if running in a greenlet spawned by gevent (or other library)."""
+    greenlet = sys.modules.get('greenlet')
+    return greenlet is not None and greenlet.getcurrent().parent is not None
+
+
+def make_timeout(timeout, exception):
+    """Return a timeout object suitable for the current thread.
+
+    The object has `start()' and `cancel()' methods; after `start()',
+    `exception' is raised in current thread if `cancel()' isn't called
+    within `timeout' seconds.  Its `fired' attribute tells if that
+    happened; the exception may then reach the thread a little later,
+    even when it isn't running the code that was timed out anymore.
+    """
+    if in_greenlet():
+        import gevent
+        return gevent.Timeout(timeout, exception)
+    if in_main_thread():
+        return AlarmTimeout(timeout, exception)
+    return ThreadTimeout(timeout, exception)
+
+
+class AlarmTimeout(object):
+    """Raises `exception' after `timeout' seconds using SIGALRM.
+
+    Works only in the main thread.
+    """
+
+    def __init__(self, timeout, exception):
+        self.timeout = timeout
+        self.exception = exception
+        self.fired = False
+
+    def _handler(self, signum, frame):
+        self.fired = True
+        raise self.exception()
+
+    def start(self):
+        signal.alarm(self.timeout)
+        signal.signal(signal.SIGALRM, self._handler)
+
+    def cancel(self):
+        try:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        except self.exception:
+            # possible race condition if we don't cancel the
+            # alarm in time.  Now there is no race condition
+            # threat, since alarm already rang.
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+
+
+def _set_async_exc(thread_id, exc_class):
+    """Raise `exc_class' in thread `thread_id' (None clears pending one)."""
+    if exc_class is None:
+        exc = ctypes.c_void_p()
+    else:
+        exc = ctypes.py_object(exc_class)
+    return ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_long(thread_id), exc)
+
+
+class ThreadTimeout(object):
+    """Raises `exception' in current thread after `timeout' seconds.
+
+    This is a replacement of SIGALRM-based timeout for threads other
+    than the main one, which can't receive signals.  The exception is
+    raised asynchronously, so it interrupts only Python code: a
+    receiver blocked in a long C call (e.g. a socket read without
+    timeout) will see it only after the call returns.
+
+    Use as:
+        timeout = ThreadTimeout(30, TimedOut)
+        timeout.start()
+        try:
+            ...
+        finally:
+            timeout.cancel()
+    """
+
+    def __init__(self, timeout, exception):
+        self.timeout = timeout
+        self.exception = exception
+        self._thread_id = None
+        self._lock = threading.Lock()
+        self._done = False
+        self.fired = False
+        self._timer = None
+
+    def start(self):
+        self._thread_id = threading.current_thread().ident
+        self._timer = threading.Timer(self.timeout, self._fire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _fire(self):
+        with self._lock:
+            if not self._done:
+                self.fired = True
+                _set_async_exc(self._thread_id, self.exception)
+
+    def cancel(self):
+        try:
+            with self._lock:
+                self._done = True
+                if self.fired:
+                    # timeout fired, but exception may still be pending
+                    # if the thread didn't get to run Python code since.
+                    _set_async_exc(self._thread_id, None)
+            self._timer.cancel()
+        except self.exception:
+            # possible race condition: exception was delivered right
+            # before we got to clear it.  Timeout already rang, so
+            # there is nothing more to cancel.
+            pass
+
+
+class WorkerPool(object):
+    """Fixed-size pool of threads running submitted jobs.
+
+    Jobs should be submitted only when a thread is free to run them
+    (see `wait_for_slot()'), so that no job waits in line - for SQS
+    messages this means that no message is kept invisible in the
+    queue while nobody is processing it.
+
+    Each thread closes its database connections before exiting.
+    """
+
+    # Waiting for a condition without timeout can't be interrupted by
+    # a signal in the main thread, so we wake up every now and then.
+    WAIT_INTERVAL = 1
+
+    def __init__(self, size, name='django_sqs-worker', log=None):
+        if size < 1:
+            raise ValueError("pool size must be positive, not %r" % size)
+        self.size = size
+        if log is None:
+            log = logging.getLogger('django_sqs.workers')
+            log.addHandler(_NullHandler())
+        self._log = log
+        self._cond = threading.Condition()
+        self._jobs = []
+        self._busy = 0
+        self._closed = False
+        self._threads = []
+        for i in range(size):
+            t = threading.Thread(target=self._run, name='%s-%d' % (name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def free_slots(self):
+        with self._cond:
+            return self.size - self._busy
+
+    def wait_for_slot(self):
+        """Block until a thread is free, return number of free threads."""
+        with self._cond:
+            while self._busy >= self.size:
+                self._cond.wait(self.WAIT_INTERVAL)
+            return self.size - self._busy
+
+    def submit(self, fn, *args, **kwargs):
+        with self._cond:
+            if self._closed:
+                raise ValueError("%r is closed" % self)
+            self._busy += 1
+            self._jobs.append((fn, args, kwargs))
+            self._cond.notify_all()
+
+    def join(self):
+        """Wait until all submitted jobs are done."""
+        with self._cond:
+            while self._busy:
+                self._cond.wait(self.WAIT_INTERVAL)
+
+    def shutdown(self):
+        """Wait for submitted jobs and stop the threads."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for t in self._threads:
+            while t.is_alive():
+                t.join(self.WAIT_INTERVAL)
+        self._threads = []
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._jobs and not self._closed:
+                        self._cond.wait()
+                    if not self._jobs:
+                        return
+                    fn, args, kwargs = self._jobs.pop(0)
+                try:
+                    fn(*args, **kwargs)
+                except:
+                    self._log.exception("Uncaught exception in worker thread")
+                finally:
+                    with self._cond:
+                        self._busy -= 1
+                        self._cond.notify_all()
+        finally:
+            close_connections()